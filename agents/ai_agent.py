@@ -1,22 +1,98 @@
 from typing import List, Dict, Optional
-import requests
+import asyncio
+import datetime
 import json
 import os
+import time
 from env_secrets import config
 # from smolagents import CodeAgent, LiteLLMModel
 
 from db.vector_db import get_chroma_collection
+from fastapi.concurrency import run_in_threadpool
+from agents.knn_classifier import KnnClassifier
+from db.classification_cache import ClassificationCache, get_classification_cache, cache_key, exact_key
+from models.vector_schema import MailRecord
+from models.relational_models import Expense, Income, Event, Setting
+from utils.normalise import normalise_body, estimate_tokens
+from utils.attachments import get_attachment_store
+from utils.llm_client import get_llm_client
+from utils.rules import CompiledRules
+
+# process wide, agents are created per notification
+BATCH_STATS = {"batches": 0, "batched_mails": 0, "rerun_mails": 0}
+PARSE_STATS = {"json_requests": 0, "parse_failures": 0, "repaired": 0, "unparsed": 0}
+ACTION_STATS = {"mails": 0, "dispatched": 0, "skipped": 0, "timeouts": 0, "errors": 0, "seconds": 0.0}
+
+# Setting flags of a user without a setting row, the column defaults
+DEFAULT_SETTINGS = {column.name: column.default.arg for column in Setting.__table__.columns
+                    if column.default is not None and isinstance(column.default.arg, bool)}
+# post classification actions and the Setting flags that enable them. create_draft does not enable the reply
+# while no Gmail draft is created from it, the text would only be thrown away
+ACTION_SETTINGS = {"finance": ("generate_report",), "reply": ("auto_response",), "event": ("schedule_event",)}
+
+
+
+def parse_stats() -> dict:
+    """ PARSE_STATS with the share of JSON answers that needed a repair and the share that stayed unusable """
+    requests = PARSE_STATS["json_requests"]
+    return {**PARSE_STATS,
+            "parse_failure_rate": round(PARSE_STATS["parse_failures"] / requests, 4) if requests else 0.0,
+            "unparsed_rate": round(PARSE_STATS["unparsed"] / requests, 4) if requests else 0.0}
+
+
+# Ollama `format` schemas (constrained decoding), fields of the Expense / Income and Event tables
+FINANCE_SCHEMA = {"anyOf": [{"type": "null"}, {
+    "type": "object",
+    "properties": {
+        "kind": {"enum": ["expense", "income"]},
+        "type": {"enum": ["item", "service"]},
+        "name": {"type": "string"},
+        "qty": {"type": "number"},
+        "price": {"type": "number"},
+        "gst": {"type": "number"},
+        "total": {"type": "number"},
+    },
+    "required": ["kind", "type", "name", "price", "total"],
+}]}
+EVENT_SCHEMA = {"anyOf": [{"type": "null"}, {
+    "type": "object",
+    "properties": {
+        "event_title": {"type": "string"},
+        "event_date": {"type": "string"},
+        "event_time": {"type": "string"},
+        "usability": {"type": "number"},
+        "urgency": {"type": "boolean"},
+    },
+    "required": ["event_title", "event_date", "event_time", "usability", "urgency"],
+}]}
+# labels whose mails are written to Expense / Income, on the per stage and the combined path
+FINANCE_LABELS = ("expense", "income")
+FINANCE_FIELDS = ("finance: the payment the email records as made or received, null for offers, discounts, "
+                  "quotes and anything not paid. kind expense|income, "
+                  "type item|service, name, qty, price and total as numbers, gst as a rate (0.18 = 18%).")
+EVENT_FIELDS = ("event: the meeting, appointment or deadline the email announces, null if none. event_title, "
+                "event_date (YYYY-MM-DD or empty), event_time (HH:MM or empty), usability (0-1), urgency (true|false).")
 
 
 class MailAgent:
-    def __init__(self, db_session, user_id:int, agent_url:str = config.AGENT_URL, agent_model:str = config.AGENT_MODEL):
+    def __init__(self, db_session, user_id:int, agent_url:str = config.AGENT_URL, agent_model:str = config.AGENT_MODEL,
+                 cache: ClassificationCache = None, knn: KnnClassifier = None, rules: CompiledRules = None,
+                 settings: dict = None, use_knn: bool = config.KNN_CLASSIFIER, batch_size: int = config.AGENT_BATCH_SIZE):
         self.db_session = db_session
         self.user_id = user_id
         self.agent_url = agent_url
         self.agent_model = agent_model
+        self.cache = cache or get_classification_cache()
+        self.knn = knn if knn is not None else (KnnClassifier(user_id) if use_knn else None)
+        self.rules = rules
+        self.batch_size = batch_size                    # most mails per classify_batch request
+        self.batch_limit = batch_size                   # adapted to how well the model keeps up with batches
+        self.settings = settings                        # the user's Setting flags, read on first use
+        self._db_lock = asyncio.Lock()                  # concurrent actions share one session
     
 
-    async def _agent_generate(self, prompt:str, max_tokens:int = 512, temperature:float = 0.0) -> str:
+    async def _agent_generate(self, prompt:str, max_tokens:int = 512, temperature:float = 0.0, options: dict = None,
+                              system: str = None, schema: dict = None) -> str:
         # model = LiteLLMModel(
         #     model_id = self.agent_model,
         #     api_base = self.agent_url, 
@@ -31,60 +107,293 @@ class MailAgent:
         
         
         
-        headers = {
-            "Content-Type": "application/json",
-        }
         payload = {
             "model": self.agent_model,
             "prompt": prompt,
-            "max_tokens": max_tokens,
-            "temperature": temperature,
         }
-        response = requests.post(f"{self.agent_url}/api/generate", headers=headers, data=json.dumps(payload), stream=True)
-        
-        if response.status_code == 200:
-            output = ""
-            for line in response.iter_lines():
-                if line:
-                    try:
-                        chunk = json.loads(line.decode("utf-8"))
-                        output += chunk.get("response", "")
-                    except json.JSONDecodeError as e:
-                        print("Failed to decode chunk:", line)
-            print(output)
-            return output
-
-            # result = response.json()
-            # return result.get("text", "").strip()
-        else:
-            raise Exception(f"Agent API request failed with status code {response.status_code}: {response.text}")
+        # Ollama reads sampling and the answer cap from options only.
+        # one num_ctx for every request, a different one makes the server reload the model
+        payload["options"] = {"num_ctx": await self._context_tokens(), "num_predict": max_tokens,
+                              "temperature": temperature, **(options or {})}
+        # stable per user prefix first, the server reuses its KV cache while the model stays loaded
+        if system:
+            payload["system"] = system
+        # JSON schema the server constrains the answer to
+        if schema:
+            payload["format"] = schema
+        if config.AGENT_KEEP_ALIVE:
+            payload["keep_alive"] = config.AGENT_KEEP_ALIVE
+        # pooled, bounded per backend; raises LLMError on a non 200 answer
+        # a constrained answer is complete once its JSON closes, nothing after it is generated
+        output = await get_llm_client(self.agent_url).generate(payload, stop_at_json=bool(schema))
+        print(output)
+        return output
     
 
+    async def _generate_json(self, prompt: str, schema: dict, max_tokens: int, system: str = None, check=None):
+        """ Schema constrained answer parsed as JSON, asked again with a repair prompt when it is unusable
+        Args:
+            check: Raises ValueError when the parsed answer can not be used (a label that is not the user's ...)
+        Returns the parsed answer, None when the repaired answer is unusable too
+        """
+        PARSE_STATS["json_requests"] += 1
+        raw = await self._agent_generate(prompt, max_tokens=max_tokens, system=system, schema=schema)
+        try:
+            parsed = json.loads(raw)
+            if check is not None:
+                check(parsed)
+            return parsed
+        except (ValueError, TypeError, KeyError, AttributeError) as e:
+            error = e
+        PARSE_STATS["parse_failures"] += 1
+        print("Unusable model answer, asking for a repair:", error)
+
+        # a cut off answer gets more room
+        repair = (
+            f"{prompt}\n\nYour previous answer could not be used ({error}):\n{raw[:1000]}\n\n"
+            "Answer again with complete JSON in the requested format. Respond ONLY with JSON."
+        )
+        raw = await self._agent_generate(repair, max_tokens=max_tokens * 2, system=system, schema=schema)
+        try:
+            parsed = json.loads(raw)
+            if check is not None:
+                check(parsed)
+        except (ValueError, TypeError, KeyError, AttributeError) as e:
+            PARSE_STATS["unparsed"] += 1
+            print("Repaired model answer unusable too:", e)
+            return None
+        PARSE_STATS["repaired"] += 1
+        return parsed
+
     # ---------------------
     # Classification
     # ---------------------
+    @staticmethod
+    def classifier_prefix(user_labels: List[dict]) -> str:
+        """ Instructions and labels, byte for byte the same for every mail of a user (and for single and batched prompts) """
+        labels = sorted(({"label_name": label.get("label_name"), "label_description": label.get("label_description")}
+                         for label in user_labels), key=lambda label: str(label["label_name"]))
+        return (
+            "You are an email classifier. For the email(s) in the user message choose the best label\n"
+            f"from the user-provided labels and their details: {json.dumps(labels, ensure_ascii=False)}"
+        )
+
+    @staticmethod
+    def classification_schema(user_labels: List[dict]) -> dict:
+        """ Format of a classification, the label limited to the user's labels """
+        label_names = sorted(str(label.get("label_name")) for label in user_labels)
+        return {
+            "type": "object",
+            "properties": {
+                "label": {"enum": label_names} if label_names else {"type": "string"},
+                "confidence": {"type": "number"},
+                "reason": {"type": "string"},
+            },
+            "required": ["label", "confidence", "reason"],
+        }
+
+    @staticmethod
+    def _check_classification(parsed: dict, user_labels: List[dict]):
+        """ Raise ValueError unless parsed is a classification into one of user_labels """
+        label_names = {label.get("label_name") for label in user_labels}
+        if not isinstance(parsed, dict) or not isinstance(parsed.get("label"), str):
+            raise ValueError("no label")
+        if label_names and parsed["label"] not in label_names:
+            raise ValueError(f"{parsed['label']!r} is not one of the labels")
+        parsed["confidence"] = float(parsed.get("confidence") or 0.0)
+
     async def classify_email(self, subject: str, body: str, user_labels: List[dict]) -> Dict:
         """
         Classify the email into one of user_labels.
         Returns dict: { "label": <label>, "confidence": <float>, "reason": <str> }
         """
         prompt = (
-            "You are a classifier. Given an email SUBJECT and BODY, choose the best label\n"
-            f"from the user-provided labels and their details as key value pairs: {user_labels}\n\n"
             "Output a JSON object with keys: label, confidence (0-1), reason.\n\n"
             f"SUBJECT:\n{subject}\n\nBODY:\n{body}\n\n"
             "Respond ONLY with JSON."
         )
-        raw = await self._agent_generate(prompt, max_tokens=256)
-        # Try to parse JSON robustly
+        # same template, same labels: no LLM call
+        key = cache_key(subject, body, user_labels, self.agent_model)
+        cached = await self.cache.get(key)
+        if cached is not None:
+            return cached
+
+        # nearest labelled mails agree: no LLM call either
+        if self.knn is not None:
+            fast = await run_in_threadpool(self.knn.predict, subject, body, user_labels)
+            if fast is not None:
+                return fast
+
+        started = time.perf_counter()
+        parsed = await self._generate_json(prompt, self.classification_schema(user_labels), max_tokens=256,
+                                           system=self.classifier_prefix(user_labels),
+                                           check=lambda answer: self._check_classification(answer, user_labels))
+        if parsed is None:
+            # left unlabelled rather than put under a label the model never gave, not cached
+            return {"label": "", "confidence": 0.0, "reason": "no usable answer from the model", "source": "unparsed"}
+        await self.cache.set(key, parsed, time.perf_counter() - started)
+        return parsed
+
+    @staticmethod
+    def extraction_schema(user_labels: List[dict]) -> dict:
+        """ Format of the combined answer, the label limited to the user's labels """
+        label_names = sorted(str(label.get("label_name")) for label in user_labels)
+        return {
+            "type": "object",
+            "properties": {
+                "label": {"enum": label_names} if label_names else {"type": "string"},
+                "confidence": {"type": "number"},
+                "reason": {"type": "string"},
+                "finance": FINANCE_SCHEMA,
+                "event": EVENT_SCHEMA,
+            },
+            "required": ["label", "confidence", "reason", "finance", "event"],
+        }
+
+    async def extract(self, subject: str, body: str, user_labels: List[dict], attachment_text: str = "") -> Dict:
+        """
+        Label, finance and event fields of the email in one LLM request instead of one per stage.
+        Returns dict: { "classification": {label, confidence, reason}, "finance": dict | None, "event": dict | None }
+        """
+        # finance and event fields hold the mail's amounts and dates, two copies of a template must not share them
+        key = exact_key(subject, body + "\0" + attachment_text, user_labels, f"{self.agent_model}:extract")
+        cached = await self.cache.get(key)
+        if cached is not None:
+            return cached
+
+        prompt = (
+            "Output a JSON object with keys: label, confidence (0-1), reason, finance, event.\n"
+            f"{FINANCE_FIELDS}\n{EVENT_FIELDS}\n\n"
+            f"SUBJECT:\n{subject}\n\nBODY:\n{body}\n\n"
+            + (f"ATTACHMENTS:\n{attachment_text}\n\n" if attachment_text else "")
+            + "Respond ONLY with JSON."
+        )
+        started = time.perf_counter()
+        parsed = await self._generate_json(prompt, self.extraction_schema(user_labels), max_tokens=400,
+                                           system=self.classifier_prefix(user_labels),
+                                           check=lambda answer: self._check_classification(answer, user_labels))
+        if parsed is None:
+            print("Combined extraction failed, classifying only")
+            return {"classification": await self.classify_email(subject, body, user_labels), "finance": None, "event": None}
+        classification = {"label": parsed["label"], "confidence": parsed["confidence"], "reason": str(parsed.get("reason") or "")}
+        elapsed = time.perf_counter() - started
+        result = {"classification": classification,
+                  "finance": parsed.get("finance") if isinstance(parsed.get("finance"), dict) else None,
+                  "event": parsed.get("event") if isinstance(parsed.get("event"), dict) else None}
+        await self.cache.set(key, result, elapsed)
+        # later classify_email calls of the same mail get the label without a request
+        await self.cache.set(cache_key(subject, body, user_labels, self.agent_model), classification, elapsed)
+        return result
+    
+
+    def _batch_prompt(self, items: list) -> str:
+        """ Variable part of a batched request, the prefix goes in as system (classifier_prefix) """
+        emails = "".join(f"### EMAIL mail_id={mail_id}\nSUBJECT:\n{subject}\n\nBODY:\n{body}\n\n"
+                         for mail_id, subject, body in items)
+        return (
+            "Output a JSON array with one object per EMAIL, keys: mail_id, label, confidence (0-1), "
+            "reason (at most 12 words).\n\n"
+            f"{emails}"
+            "Respond ONLY with the JSON array."
+        )
+
+    async def _context_tokens(self) -> int:
+        """ Context window requested from the server (num_ctx), prompt + answer tokens of a request """
+        context = await get_llm_client(self.agent_url).context_length(self.agent_model)
+        return min(context or config.AGENT_CONTEXT_TOKENS, config.AGENT_CONTEXT_TOKENS)
+
+    def _pack(self, items: list, user_labels: List[dict], budget: int) -> list:
+        """ Split items into batches that fit the context window and the current batch limit """
+        empty = estimate_tokens(self._batch_prompt([]))
+        fixed = estimate_tokens(self.classifier_prefix(user_labels)) + empty
+        batches, batch, used = [], [], fixed
+        for item in items:
+            cost = estimate_tokens(self._batch_prompt([item])) - empty + config.AGENT_BATCH_OUTPUT_TOKENS
+            if batch and (used + cost > budget or len(batch) >= self.batch_limit):
+                batches.append(batch)
+                batch, used = [], fixed
+            batch.append(item)
+            used += cost
+        if batch:
+            batches.append(batch)
+        return batches
+
+    @staticmethod
+    def _parse_batch(raw: str, mail_ids: set, label_names: set) -> dict:
+        """ Valid classifications of a batched answer by mail_id, invalid or missing items are left out """
+        start, end = raw.find("["), raw.rfind("]")
         try:
-            parsed = json.loads(raw)
-        except Exception:
-            # fallback simple parsing: try to find label word
-            parsed = {"label": user_labels[0] if user_labels else "uncategorized",
-                      "confidence": 0.0,
-                      "reason": raw[:300]}
+            items = json.loads(raw[start:end + 1]) if 0 <= start < end else []
+        except json.JSONDecodeError:
+            return {}
+        parsed = {}
+        for item in items if isinstance(items, list) else []:
+            if not isinstance(item, dict) or str(item.get("mail_id")) not in mail_ids:
+                continue
+            label = item.get("label")
+            if not isinstance(label, str) or (label_names and label not in label_names):
+                continue
+            try:
+                confidence = float(item.get("confidence", 0.0))
+            except (TypeError, ValueError):
+                continue
+            parsed[str(item["mail_id"])] = {"label": label, "confidence": confidence,
+                                            "reason": str(item.get("reason") or "")}
         return parsed
+
+    async def _classify_one_batch(self, batch: list, user_labels: List[dict], keys: dict) -> dict:
+        started = time.perf_counter()
+        item = self.classification_schema(user_labels)
+        item["properties"] = {"mail_id": {"enum": [mail_id for mail_id, _, _ in batch]}, **item["properties"]}
+        item["required"].insert(0, "mail_id")
+        raw = await self._agent_generate(self._batch_prompt(batch), max_tokens=config.AGENT_BATCH_OUTPUT_TOKENS * len(batch),
+                                         system=self.classifier_prefix(user_labels), schema={"type": "array", "items": item})
+        elapsed = time.perf_counter() - started
+        results = self._parse_batch(raw, {mail_id for mail_id, _, _ in batch},
+                                    {label.get("label_name") for label in user_labels})
+        for mail_id, classification in results.items():
+            await self.cache.set(keys[mail_id], classification, elapsed / len(batch))
+
+        # fewer mails per request while the model drops or mangles items, back up while it copes
+        if len(results) < len(batch) / 2:
+            self.batch_limit = max(2, len(batch) // 2)
+        elif len(results) == len(batch):
+            self.batch_limit = min(self.batch_size, self.batch_limit + 1)
+        BATCH_STATS["batches"] += 1
+        BATCH_STATS["batched_mails"] += len(batch)
+        BATCH_STATS["rerun_mails"] += len(batch) - len(results)
+
+        # only the mails the batch got wrong go through the single mail path
+        for mail_id, subject, body in batch:
+            if mail_id not in results:
+                results[mail_id] = await self.classify_email(subject, body, user_labels)
+        return results
+
+    async def classify_batch(self, items: list, user_labels: List[dict]) -> Dict[str, dict]:
+        """
+        Classify several emails with as few LLM requests as the context window allows.
+        items: (mail_id, subject, body) tuples, body already normalised.
+        Returns dict: { mail_id: classification } with the keys of classify_email.
+        """
+        results, pending, keys = {}, [], {}
+        for mail_id, subject, body in items:
+            keys[mail_id] = cache_key(subject, body, user_labels, self.agent_model)
+            cached = await self.cache.get(keys[mail_id])
+            if cached is None and self.knn is not None:
+                cached = await run_in_threadpool(self.knn.predict, subject, body, user_labels)
+            if cached is not None:
+                results[mail_id] = cached
+            else:
+                pending.append((mail_id, subject, body))
+
+        budget = await self._context_tokens()
+        for batch in self._pack(pending, user_labels, budget):
+            if len(batch) == 1:
+                mail_id, subject, body = batch[0]
+                results[mail_id] = await self.classify_email(subject, body, user_labels)
+            else:
+                results.update(await self._classify_one_batch(batch, user_labels, keys))
+        return results
     
 
     # ---------------------
@@ -111,54 +420,100 @@ class MailAgent:
         )
     
 
+    # ---------------------
+    # Attachments
+    # ---------------------
+    def attachment_text(self, mail: MailRecord) -> str:
+        """ Text of the mail's stored attachments, extracted on first use and cached by the attachment store """
+        store = get_attachment_store()
+        if store is None:
+            return ""
+        return "\n\n".join(
+            f"[{ref.filename}]\n{store.text(ref.sha256, ref.mime_type)}"
+            for ref in mail.attachments if ref.sha256
+        )
+
     # ---------------------
     # Finance management
     # ---------------------
-    def manage_finance(self, subject: str, body: str, label: str) -> Optional[dict]:
+    async def manage_finance(self, subject: str, body: str, label: str, attachment_text: str = "",
+                             extracted: dict = None, mail_id: str = None) -> Optional[dict]:
         """
         If label indicates expense/income, extract structured details and store to relational DB.
+        attachment_text is the text of invoices / receipts attached to the mail (attachment_text()).
+        extracted is the finance object of extract(), no LLM request is made when it is given.
+        Either way only mails labelled expense / income are written.
         Returns stored record data (dict) or None.
         """
-        if label.lower() not in ("expense", "income"):
+        if label.lower() not in FINANCE_LABELS:
+            return None
+        if extracted is None:
+            prompt = (
+                f"Output a JSON object with key finance.\n{FINANCE_FIELDS}\n\n"
+                "EMAIL SUBJECT:\n"
+                f"{subject}\n\nEMAIL BODY:\n{body}\n\n"
+                + (f"ATTACHMENTS:\n{attachment_text}\n\n" if attachment_text else "")
+                + "Respond only with JSON."
+            )
+            parsed = await self._generate_json(prompt, {"type": "object", "properties": {"finance": FINANCE_SCHEMA},
+                                                        "required": ["finance"]}, max_tokens=200)
+            if not isinstance(parsed, dict):
+                return None
+            extracted = parsed.get("finance")
+        if not isinstance(extracted, dict):
             return None
+        if mail_id is None or self.db_session is None:
+            return extracted
+        async with self._db_lock:
+            return await run_in_threadpool(self.save_finance, mail_id, extracted)
 
-        prompt = (
-            "Extract a JSON object with keys: type (expense|income), amount (number), currency, "
-            "date (YYYY-MM-DD or best guess), vendor, category, notes.\n\n"
-            "EMAIL SUBJECT:\n"
-            f"{subject}\n\nEMAIL BODY:\n{body}\n\nRespond only with JSON."
-        )
-        raw = self._agent_generate(prompt, max_tokens=200)
+    def save_finance(self, mail_id: str, finance: dict) -> Optional[dict]:
+        """ Expense / Income row of the extracted finance fields. Blocking, run it in a thread """
+        table = {"expense": Expense, "income": Income}.get(str(finance.get("kind")).lower())
         try:
-            data = json.loads(raw)
-        except Exception:
-            # minimal fallback
-            data = {"type": label, "amount": None, "currency": None, "date": None, "vendor": None, "category": None, "notes": raw[:300]}
+            price = float(finance["price"])
+            qty = float(finance.get("qty") or 1)
+            gst = float(finance.get("gst") or 0)
+            # gst given as a percentage (18) instead of a fraction (0.18)
+            if gst > 1:
+                gst /= 100
+            total = float(finance.get("total") or price * qty * (1 + gst))
+        except (KeyError, TypeError, ValueError):
+            return None
+        if table is None:
+            return None
+        # Numeric(5, 2) price and qty, Numeric(2, 2) gst, Numeric(10, 2) total: reported as finance_error
+        # instead of overflowing the column
+        for field, value, limit in (("price", price, 999.99), ("qty", qty, 999.99), ("gst", gst, 0.99),
+                                    ("total", total, 99999999.99)):
+            if not 0 <= round(value, 2) <= limit:
+                raise ValueError(f"{field} {value} is outside the column range 0 to {limit}")
+        # the queue and backfills deliver at least once, a mail already written is not written again
+        for written in (Expense, Income):
+            existing = self.db_session.query(written).filter(written.user_id == self.user_id,
+                                                              written.mail_id == mail_id).first()
+            if existing is not None:
+                return existing.to_dict()
 
-        # Example: persist to DB (adjust model and fields to your schema)
+        row = table(
+            type=finance.get("type") if finance.get("type") in ("item", "service") else "item",
+            name=str(finance.get("name") or "")[:255] or "unknown",
+            qty=round(qty, 2), price=round(price, 2), gst=round(gst, 2), total=round(total, 2),
+            mail_id=mail_id, user_id=self.user_id
+        )
         try:
-            # finance = FinanceEntry(
-            #     user_id=self.user_id,
-            #     type=data.get("type"),
-            #     amount=data.get("amount"),
-            #     currency=data.get("currency"),
-            #     date=data.get("date"),
-            #     vendor=data.get("vendor"),
-            #     category=data.get("category"),
-            #     notes=data.get("notes")
-            # )
-            # self.db.add(finance)
-            # self.db.commit()
-            # return {"id": finance.id, **data}
-            return data  # placeholder: replace with actual DB save
-        except Exception as e:
-            # self.db.rollback()
+            self.db_session.add(row)
+            self.db_session.commit()
+            self.db_session.refresh(row)
+            return row.to_dict()
+        except Exception:
+            self.db_session.rollback()
             raise
 
     # ---------------------
     # Response generation
     # ---------------------
-    def generate_response(self, subject: str, body: str, user_role: str, label: str, tone: str = "polite") -> Optional[str]:
+    async def generate_response(self, subject: str, body: str, user_role: str, label: str, tone: str = "polite") -> Optional[str]:
         """
         If email requires response (based on label + role), generate reply text.
         user_role: e.g., "owner", "student", "recruiter", "customer_service"
@@ -173,100 +528,214 @@ class MailAgent:
             "Include greeting, concise body addressing the customer's points, and a polite closing.\n\n"
             "ORIGINAL SUBJECT:\n" + subject + "\n\nORIGINAL BODY:\n" + body + "\n\nRespond only with the email body text (no JSON)."
         )
-        reply = self._agent_generate(prompt, max_tokens=400)
+        reply = await self._agent_generate(prompt, max_tokens=400)
         return reply.strip()
 
     # ---------------------
     # Calendar scheduling
     # ---------------------
-    def schedule_event(self, subject: str, body: str, label: str) -> Optional[dict]:
+    async def schedule_event(self, subject: str, body: str, label: str, extracted: dict = None,
+                             mail_id: str = None) -> Optional[dict]:
         """
         If the content contains an event, extract event info + priority/usability and persist.
+        extracted is the event object of extract(), no LLM request is made when it is given.
         Returns event dict or None.
         """
-        prompt = (
-            "Extract event information (if any) from the email. Output JSON with keys: "
-            "title, start (ISO or best guess), end (ISO or best guess or null), location, "
-            "description, priority (low|medium|high), usability (0-1) . If no event, return {\"event\": null}.\n\n"
-            f"SUBJECT:\n{subject}\n\nBODY:\n{body}\n\nRespond only with JSON."
-        )
-        raw = self._agent_generate(prompt, max_tokens=200)
-        try:
-            parsed = json.loads(raw)
-        except Exception:
-            parsed = {"event": None}
-
-        event = parsed.get("event") or parsed
-        if not event or event.get("title") is None:
+        if extracted is None:
+            prompt = (
+                f"Extract event information (if any) from the email. Output a JSON object with key event.\n{EVENT_FIELDS}\n\n"
+                f"SUBJECT:\n{subject}\n\nBODY:\n{body}\n\nRespond only with JSON."
+            )
+            parsed = await self._generate_json(prompt, {"type": "object", "properties": {"event": EVENT_SCHEMA},
+                                                        "required": ["event"]}, max_tokens=200)
+            if not isinstance(parsed, dict):
+                return None
+            extracted = parsed.get("event")
+        if not isinstance(extracted, dict) or not extracted.get("event_title"):
             return None
+        if mail_id is None or self.db_session is None:
+            return extracted
+        async with self._db_lock:
+            return await run_in_threadpool(self.save_event, mail_id, extracted)
 
-        # Persist to DB / calendar (placeholder)
+    def save_event(self, mail_id: str, event: dict) -> Optional[dict]:
+        """ Event row of the extracted event fields. Blocking, run it in a thread """
+        # the queue and backfills deliver at least once, a mail already written is not written again
+        existing = self.db_session.query(Event).filter(Event.user_id == self.user_id, Event.mail_id == mail_id).first()
+        if existing is not None:
+            return existing.to_dict()
+        try:
+            event_date = datetime.date.fromisoformat(event["event_date"]) if event.get("event_date") else None
+        except (TypeError, ValueError):
+            event_date = None
         try:
-            # calendar = CalendarEvent(
-            #     user_id=self.user_id,
-            #     title=event["title"],
-            #     start=event.get("start"),
-            #     end=event.get("end"),
-            #     location=event.get("location"),
-            #     description=event.get("description"),
-            #     priority=event.get("priority"),
-            #     usability=event.get("usability")
-            # )
-            # self.db.add(calendar)
-            # self.db.commit()
-            # return {"id": calendar.id, **event}
-            return event  # placeholder
+            event_time = datetime.time.fromisoformat(event["event_time"]) if event.get("event_time") else None
+        except (TypeError, ValueError):
+            event_time = None
+        try:
+            usability = float(event.get("usability") or 0)
+        except (TypeError, ValueError):
+            usability = 0.0
+
+        row = Event(
+            event_title=str(event["event_title"])[:255],
+            related="mail",
+            # Numeric(1, 1)
+            usability=round(min(max(usability, 0.0), 0.9), 1),
+            urgency=bool(event.get("urgency")),
+            event_date=event_date,
+            event_time=event_time,
+            mail_id=mail_id, user_id=self.user_id
+        )
+        try:
+            self.db_session.add(row)
+            self.db_session.commit()
+            self.db_session.refresh(row)
+            return row.to_dict()
         except Exception:
-            # self.db.rollback()
+            self.db_session.rollback()
             raise
 
     # ---------------------
     # Orchestration
     # ---------------------
-    async def run(self, data: dict, user_labels: List[dict], user_role: str= "owner") -> Dict:
+    async def load_settings(self) -> dict:
+        """ The user's Setting flags, read once per agent """
+        if self.settings is None:
+            row = None
+            if self.db_session is not None:
+                async with self._db_lock:
+                    row = await run_in_threadpool(
+                        lambda: self.db_session.query(Setting).filter(Setting.user_id == self.user_id).first())
+            self.settings = {**DEFAULT_SETTINGS, **(row.to_dict() if row is not None else {})}
+        return self.settings
+
+    def enabled_actions(self, settings: dict) -> List[str]:
+        """ Actions of ACTION_SETTINGS with at least one of their flags set """
+        return [action for action, flags in ACTION_SETTINGS.items() if any(settings.get(flag) for flag in flags)]
+
+    async def _use_extraction(self) -> bool:
+        """ Whether unlabelled mails go through extract(): combined mode and an action that needs its fields """
+        enabled = self.enabled_actions(await self.load_settings())
+        return config.AGENT_COMBINED_EXTRACTION and bool({"finance", "event"} & set(enabled))
+
+    async def _run_action(self, name: str, action, timeout: float) -> dict:
+        """ One action with its own timeout, the error instead of the result when it fails """
+        try:
+            return {name: await asyncio.wait_for(action, timeout)}
+        except asyncio.TimeoutError:
+            ACTION_STATS["timeouts"] += 1
+            return {f"{name}_error": f"timed out after {timeout}s"}
+        except Exception as e:
+            ACTION_STATS["errors"] += 1
+            return {f"{name}_error": str(e)}
+
+    async def dispatch_actions(self, data: MailRecord, label: str, user_role: str, extraction: dict = None,
+                               body: str = None) -> dict:
+        """
+        Finance, reply and event actions the user's settings enable, run concurrently.
+        extraction is the result of extract(), its finance and event fields replace those requests.
+        body is the normalised body when the caller already has it.
+        Returns the summary entries of the actions (results, <action>_error, skipped_actions).
         """
-        Full pipeline: classify, store, finance, response, schedule.
+        settings = await self.load_settings()
+        enabled = self.enabled_actions(settings)
+        if body is None:
+            body = normalise_body(data.document)
+        subject, mail_id = data.subject, data.mail_id
+        label = str(label or "")
+
+        # coroutines are only created for enabled actions, disabled ones never build a prompt
+        actions = {}
+        if ("finance" in enabled and label.lower() in FINANCE_LABELS
+                and not (extraction is not None and extraction["finance"] is None)):
+            actions["finance"] = self.manage_finance(
+                subject, body, label,
+                await run_in_threadpool(self.attachment_text, data) if extraction is None else "",
+                extracted=extraction["finance"] if extraction is not None else None, mail_id=mail_id)
+        if "reply" in enabled:
+            actions["reply"] = self.generate_response(subject, body, user_role, label)
+        if "event" in enabled and not (extraction is not None and extraction["event"] is None):
+            actions["event"] = self.schedule_event(subject, body, label,
+                                                   extracted=extraction["event"] if extraction is not None else None,
+                                                   mail_id=mail_id)
+
+        ACTION_STATS["mails"] += 1
+        ACTION_STATS["dispatched"] += len(actions)
+        ACTION_STATS["skipped"] += len(ACTION_SETTINGS) - len(actions)
+        summary = {"skipped_actions": [action for action in ACTION_SETTINGS if action not in actions]}
+        started = time.perf_counter()
+        # wall time of the slowest action, not the sum
+        for result in await asyncio.gather(*(self._run_action(name, action, config.AGENT_ACTION_TIMEOUT)
+                                             for name, action in actions.items())):
+            summary.update(result)
+        ACTION_STATS["seconds"] += time.perf_counter() - started
+        return summary
+
+    async def run(self, data: MailRecord, user_labels: List[dict], user_role: str= "owner", classification: Dict = None,
+                  body: str = None) -> Dict:
+        """
+        Full pipeline: classify, store, then finance, response and schedule as the user's settings allow.
+        classification is given when the mail was already classified in a batch (run_batch),
+        body when the body is already normalised.
         Returns a summary dict with actions taken.
         """
 
-        body = data.get("document", "")
-        metadata = data.get("metadata", {})
-        subject = metadata.get("subject", "")
-        mail_id = metadata.get("mail_id", "")
+        # quoted history, signatures and boilerplate only cost prompt tokens; chroma gets the same
+        # normalised form so the knn fast path queries and stores comparable documents
+        if body is None:
+            body = normalise_body(data.document)
+        subject = data.subject
+        mail_id = data.mail_id
         summary = {"mail_id": mail_id}
 
-        classification = await self.classify_email(subject, body, user_labels)
+        # the user's rules label deterministic mail (sender domain, list headers, subject patterns) without the model
+        if classification is None and self.rules is not None:
+            classification = self.rules.match(data)
+        extraction = None
+        if classification is None and await self._use_extraction():
+            # label, finance and event fields from one request instead of one per stage
+            # attachments only feed the finance fields
+            finance = "finance" in self.enabled_actions(await self.load_settings())
+            extraction = await self.extract(subject, body, user_labels,
+                                            await run_in_threadpool(self.attachment_text, data) if finance else "")
+            classification = extraction["classification"]
+        if classification is None:
+            classification = await self.classify_email(subject, body, user_labels)
         label = classification.get("label")
         summary["classification"] = classification
 
-        # store raw email + metadata in chroma
-        metadata.update({"label": label, "classification_reason": classification.get("reason")})
+        # store normalised email + metadata in chroma
+        data.label = str(label or "")
+        data.classification_reason = str(classification.get("reason") or "")
+        data.label_source = classification.get("source", "llm")
         try:
-            self.store_to_chromadb(mail_id, subject, body, metadata)
+            # embedding + upsert, blocking like the knn lookup
+            await run_in_threadpool(self.store_to_chromadb, mail_id, subject, body, data.chroma_metadata())
             summary["stored_chroma"] = True
         except Exception as e:
             summary["stored_chroma"] = False
             summary["chroma_error"] = str(e)
 
-        # # finance
-        # try:
-        #     fin = self.manage_finance(subject, body, label)
-        #     summary["finance"] = fin
-        # except Exception as e:
-        #     summary["finance_error"] = str(e)
-
-        # # response
-        # try:
-        #     reply = self.generate_response(subject, body, user_role, label)
-        #     summary["reply"] = reply
-        # except Exception as e:
-        #     summary["reply_error"] = str(e)
-
-        # # schedule
-        # try:
-        #     event = self.schedule_event(subject, body, label)
-        #     summary["event"] = event
-        # except Exception as e:
-        #     summary["event_error"] = str(e)
+        summary.update(await self.dispatch_actions(data, label, user_role, extraction, body))
 
         return summary
+
+    async def run_batch(self, mails: List[MailRecord], user_labels: List[dict], user_role: str = "owner") -> List[Dict]:
+        """
+        run() for several mails, the ones no rule matches are classified together (classify_batch).
+        With finance or event enabled they go through run()'s combined extraction instead, one request
+        per mail then covers the label and both actions.
+        Returns the summaries in the order of mails.
+        """
+        classifications = {}
+        for mail in mails:
+            if self.rules is not None and (matched := self.rules.match(mail)) is not None:
+                classifications[mail.mail_id] = matched
+        bodies = {mail.mail_id: normalise_body(mail.document) for mail in mails}
+        pending = [(mail.mail_id, mail.subject, bodies[mail.mail_id])
+                   for mail in mails if mail.mail_id not in classifications]
+        if len(pending) > 1 and not await self._use_extraction():
+            classifications.update(await self.classify_batch(pending, user_labels))
+        return [await self.run(mail, user_labels, user_role, classifications.get(mail.mail_id), bodies[mail.mail_id])
+                for mail in mails]
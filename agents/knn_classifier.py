@@ -0,0 +1,101 @@
+import time
+from collections import defaultdict
+from typing import Optional
+from env_secrets import config
+from db.vector_db import get_chroma_collection
+
+
+"""
+Nearest neighbour fast path in front of the LLM classifier.
+
+Every classified mail is stored in the user's Chroma collection with its
+label (MailAgent.store_to_chromadb). An incoming mail is embedded and its k
+nearest labelled neighbours vote, weighted by cosine similarity. A clear
+enough vote is the answer, anything else goes to the LLM. Mails labelled by
+this fast path are stored with label_source "knn" and never vote, so the
+neighbourhood only grows from LLM decisions and cannot drift on its own.
+
+The threshold is tuned offline with benchmarks/eval_knn_classifier.py.
+"""
+
+# process wide, agents are created per notification
+KNN_STATS = {"queries": 0, "answered": 0, "too_few_mails": 0, "errors": 0, "seconds": 0.0}
+
+
+class KnnClassifier:
+    """ Weighted k nearest neighbour vote over a user's labelled mails """
+
+    def __init__(self, user_id: int, collection=None, k: int = config.KNN_K,
+                 threshold: float = config.KNN_THRESHOLD, min_similarity: float = config.KNN_MIN_SIMILARITY,
+                 min_neighbours: int = config.KNN_MIN_NEIGHBOURS):
+        self.user_id = user_id
+        self._collection = collection
+        self.k = k
+        self.threshold = threshold                  # weighted vote share needed to skip the LLM
+        self.min_similarity = min_similarity        # neighbours further away do not vote
+        self.min_neighbours = min_neighbours
+
+    @property
+    def collection(self):
+        if self._collection is None:
+            self._collection = get_chroma_collection(self.user_id)
+        return self._collection
+
+    def neighbours(self, query_texts: list = None, query_embeddings: list = None, exclude_id: str = None) -> list:
+        """ (label, similarity) of the k nearest LLM labelled mails
+        Args:
+            query_texts list: One document, embedded by the collection's embedding function
+            query_embeddings list: One precomputed embedding instead of query_texts
+            exclude_id str: Mail to leave out (the mail itself, for offline evaluation)
+        """
+        # room for neighbours that are skipped below
+        result = self.collection.query(query_texts=query_texts, query_embeddings=query_embeddings,
+                                       n_results=self.k * 2 + 1, include=["metadatas", "distances"])
+        found = []
+        for mail_id, metadata, distance in zip(result["ids"][0], result["metadatas"][0], result["distances"][0]):
+            metadata = metadata or {}
+            if mail_id == exclude_id or not metadata.get("label") or metadata.get("label_source") == "knn":
+                continue
+            found.append((metadata["label"], 1.0 - distance))
+            if len(found) == self.k:
+                break
+        return found
+
+    def vote(self, neighbours: list, user_labels: list) -> Optional[dict]:
+        """ Classification of the weighted vote, None when it is not clear enough """
+        label_names = {label.get("label_name") for label in user_labels}
+        # labels the user removed or renamed since do not count
+        voters = [(label, similarity) for label, similarity in neighbours
+                  if similarity >= self.min_similarity and label in label_names]
+        if len(voters) < self.min_neighbours:
+            return None
+        weights = defaultdict(float)
+        for label, similarity in voters:
+            weights[label] += similarity
+        label, weight = max(weights.items(), key=lambda item: item[1])
+        confidence = weight / sum(weights.values())
+        if confidence < self.threshold:
+            return None
+        agreeing = sum(1 for voter, _ in voters if voter == label)
+        return {"label": label, "confidence": round(confidence, 3), "source": "knn",
+                "reason": f"{agreeing} of the {len(voters)} most similar mails are labelled {label}"}
+
+    def predict(self, subject: str, body: str, user_labels: list) -> Optional[dict]:
+        """ Label of the mail from its neighbours, None to ask the LLM. Blocking (embedding), run it in a thread """
+        started = time.perf_counter()
+        KNN_STATS["queries"] += 1
+        try:
+            if self.collection.count() < max(self.min_neighbours, 1):
+                KNN_STATS["too_few_mails"] += 1
+                return None
+            # same document form as store_to_chromadb, body normalised on both sides
+            result = self.vote(self.neighbours(query_texts=[f"Subject: {subject}\n\n{body}"]), user_labels)
+        except Exception as e:
+            KNN_STATS["errors"] += 1
+            print("KNN classification failed:", e)
+            return None
+        finally:
+            KNN_STATS["seconds"] += time.perf_counter() - started
+        if result is not None:
+            KNN_STATS["answered"] += 1
+        return result
@@ -40,14 +40,14 @@ class AuthHandler:
 
 class GoogleAuthHandler:
     """ Handles Google OAuth2 authentication tasks """
-    def __init__(self):
+    def __init__(self, token_url: str = config.GOOGLE_TOKEN_URL):
         self.client_id = config.GOOGLE_CLIENT_ID
         self.client_secret = config.GOOGLE_CLIENT_SECRET
         self.redirect_uri = config.GOOGLE_REDIRECT_URI
+        self.token_url = token_url
     
     def get_token(self, code: str):
         """Exchange authorization code for access token and refresh token"""
-        token_url = "https://oauth2.googleapis.com/token"
         data = {
             "code": code,
             "client_id": config.GOOGLE_CLIENT_ID,
@@ -55,19 +55,18 @@ class GoogleAuthHandler:
             "redirect_uri": config.GOOGLE_REDIRECT_URI,
             "grant_type": "authorization_code"
         }
-        response = requests.post(token_url, data=data)
+        response = requests.post(self.token_url, data=data, timeout=30)
         return response.json()
     
     def get_new_token(self, refresh_token: str):
         """Get new access token using refresh token"""
-        token_url = "https://oauth2.googleapis.com/token"
         data = {
             "client_id": config.GOOGLE_CLIENT_ID,
             "client_secret": config.GOOGLE_CLIENT_SECRET,
             "refresh_token": refresh_token,
             "grant_type": "refresh_token"
         }
-        response = requests.post(token_url, data=data)
+        response = requests.post(self.token_url, data=data, timeout=30)
         return response.json() if response.status_code == 200 else None
     
     def user_info(self, access_token: str) -> dict:
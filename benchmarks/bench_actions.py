@@ -0,0 +1,84 @@
+""" Per-email wall time of the post classification actions: one after the other vs dispatch_actions
+
+Corpus: the synthetic mailbox (benchmarks/fake_gmail.py), classified first
+(not timed). Then per mail:
+
+    sequential   manage_finance, generate_response, schedule_event awaited in
+                 turn, regardless of settings (the stages of run() as written)
+    concurrent   MailAgent.dispatch_actions, every Setting flag on
+    defaults     MailAgent.dispatch_actions with the Setting column defaults,
+                 disabled actions are skipped before a prompt is built
+
+The fake Ollama server (benchmarks/fake_ollama.py) generates --parallel
+requests at once like OLLAMA_NUM_PARALLEL. Cache and knn fast path are off,
+nothing is written to the database.
+
+    python -m benchmarks.bench_actions
+"""
+import argparse
+import asyncio
+import contextlib
+import io
+import time
+
+from benchmarks.common import FINANCE_LABELS, agent, mails as synthetic_mails
+from benchmarks.fake_gmail import serve_in_thread
+from benchmarks.fake_ollama import FakeOllama, create_app
+from agents.ai_agent import MailAgent, DEFAULT_SETTINGS, ACTION_SETTINGS
+from utils.llm_client import close_llm_clients, get_llm_client
+from utils.normalise import normalise_body
+
+ALL_ON = {flag: True for flags in ACTION_SETTINGS.values() for flag in flags}
+
+
+async def sequential(mail_agent: MailAgent, mail, label: str) -> int:
+    subject, body = mail.subject, normalise_body(mail.document)
+    await mail_agent.manage_finance(subject, body, label)
+    await mail_agent.generate_response(subject, body, "owner", label)
+    await mail_agent.schedule_event(subject, body, label)
+    return 3
+
+
+async def dispatched(mail_agent: MailAgent, mail, label: str) -> int:
+    summary = await mail_agent.dispatch_actions(mail, label, "owner")
+    return len(ACTION_SETTINGS) - len(summary["skipped_actions"])
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--mails", type=int, default=16)
+    parser.add_argument("--parallel", type=int, default=4)
+    args = parser.parse_args()
+
+    fake = FakeOllama(prefill_ms=0.5, decode_ms=15, parallel=args.parallel)
+    server, url = serve_in_thread(create_app(fake))
+    mails = synthetic_mails(args.mails)
+    with contextlib.redirect_stdout(io.StringIO()):
+        labels = [(await agent(url, settings=ALL_ON).classify_email(mail.subject, normalise_body(mail.document),
+                                                                    FINANCE_LABELS))["label"]
+                  for mail in mails]
+
+    client = get_llm_client(url)
+    print(f"{'mode':<11} {'s/email':>8} {'max s':>6} {'actions/email':>14} {'requests/email':>15}")
+    baseline = None
+    for name, mode, settings in (("sequential", sequential, ALL_ON), ("concurrent", dispatched, ALL_ON),
+                                 ("defaults", dispatched, DEFAULT_SETTINGS)):
+        mail_agent = agent(url, settings=settings)
+        requests = client.stats["requests"]
+        times, actions = [], 0
+        with contextlib.redirect_stdout(io.StringIO()):
+            for mail, label in zip(mails, labels):
+                started = time.perf_counter()
+                actions += await mode(mail_agent, mail, label)
+                times.append(time.perf_counter() - started)
+        mean = sum(times) / len(times)
+        baseline = baseline or mean
+        print(f"{name:<11} {mean:>8.3f} {max(times):>6.2f} {actions / len(mails):>14.2f} "
+              f"{(client.stats['requests'] - requests) / len(mails):>15.2f}   {baseline / mean:.2f}x")
+
+    await close_llm_clients()
+    server.should_exit = True
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,89 @@
+""" Latency of 100 concurrent notifications: blocking discovery client vs asyncio client
+
+Each notification does what the hook pipeline does against Gmail: one
+history.list and a messages.get per new mail. The server is simulated in
+process with a fixed latency per call, so the numbers only show how much
+the event loop overlaps (or doesn't) the round trips.
+
+    python -m benchmarks.bench_async_gmail
+"""
+import asyncio
+import json
+import statistics
+import time
+
+import httplib2
+import httpx
+from googleapiclient.discovery import build_from_document
+
+from utils.gmail_async import AsyncGmailClient
+from utils.rate_limit import QuotaLimiter
+from utils.service_cache import get_discovery_document
+
+IN_FLIGHT = 100
+MAILS_PER_NOTIFICATION = 5
+LATENCY = 0.02
+
+
+def fake_body(path: str) -> dict:
+    if path.endswith("/history"):
+        return {"historyId": "2", "history": [
+            {"messagesAdded": [{"message": {"id": str(i)}}]} for i in range(MAILS_PER_NOTIFICATION)
+        ]}
+    return {"id": path.rsplit("/", 1)[-1], "payload": {"headers": []}}
+
+
+class SleepyHttp:
+    """ httplib2 stand-in answering like Gmail after LATENCY seconds (blocking) """
+
+    def request(self, uri, method="GET", body=None, headers=None, **kwargs):
+        time.sleep(LATENCY)
+        path = uri.split("?", 1)[0]
+        return httplib2.Response({"status": "200"}), json.dumps(fake_body(path)).encode()
+
+
+async def sleepy_handler(request: httpx.Request) -> httpx.Response:
+    await asyncio.sleep(LATENCY)
+    return httpx.Response(200, json=fake_body(request.url.path))
+
+
+def percentile(values, q):
+    return statistics.quantiles(values, n=100)[q - 1]
+
+
+async def blocking_notification(service, started, latencies):
+    history = service.users().history().list(userId="me", startHistoryId=1).execute()
+    for record in history["history"]:
+        for msg in record["messagesAdded"]:
+            service.users().messages().get(userId="me", id=msg["message"]["id"], format="full").execute()
+    latencies.append(time.perf_counter() - started)
+
+
+async def async_notification(client, started, latencies):
+    history = await client.history_list("token", 1)
+    ids = [msg["message"]["id"] for record in history["history"] for msg in record["messagesAdded"]]
+    await asyncio.gather(*[client.messages_get("token", mail_id) for mail_id in ids])
+    latencies.append(time.perf_counter() - started)
+
+
+async def run(label, make_task):
+    latencies = []
+    started = time.perf_counter()
+    await asyncio.gather(*[make_task(started, latencies) for _ in range(IN_FLIGHT)])
+    total = time.perf_counter() - started
+    print(f"{label:<28} p50 {percentile(latencies, 50) * 1000:8.0f} ms   p99 {percentile(latencies, 99) * 1000:8.0f} ms   total {total:6.2f} s")
+
+
+async def main():
+    print(f"{IN_FLIGHT} notifications in flight, 1 + {MAILS_PER_NOTIFICATION} calls each, {LATENCY * 1000:.0f} ms per call")
+    service = build_from_document(get_discovery_document("gmail", "v1"), http=SleepyHttp())
+    await run("discovery client on loop", lambda started, latencies: blocking_notification(service, started, latencies))
+
+    client = AsyncGmailClient(base_url="http://gmail.test", max_in_flight=64, transport=httpx.MockTransport(sleepy_handler),
+                             limiter=QuotaLimiter(user_rate=1e9, project_rate=1e9))     # measure transport, not quota
+    await run("asyncio client", lambda started, latencies: async_notification(client, started, latencies))
+    await client.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,92 @@
+""" Batched classification vs one LLM request per mail
+
+Corpus: the synthetic mailbox (benchmarks/fake_gmail.py), bodies normalised
+as in MailAgent.run. The per-mail path runs classify_email with the
+backfill's concurrency, the batched path MailAgent.classify_batch. The fake
+Ollama server (benchmarks/fake_ollama.py) generates one request at a time
+like a single local GPU; --batch-drop leaves items out of batched answers to
+exercise the per-mail re-run. Cache and knn fast path are off.
+
+    python -m benchmarks.bench_batch_classify
+    python -m benchmarks.bench_batch_classify --agent-url http://localhost:11434 --model llama3.2:3b
+"""
+import argparse
+import asyncio
+import contextlib
+import io
+import time
+
+from benchmarks.common import LABELS, agent, corpus
+from benchmarks.fake_gmail import serve_in_thread
+from benchmarks.fake_ollama import FakeOllama, create_app
+from agents.ai_agent import BATCH_STATS
+from env_secrets import config
+from utils.llm_client import close_llm_clients
+
+async def per_mail(url: str, model: str, items: list, concurrency: int) -> tuple:
+    mail_agent = agent(url, model)
+    queue = list(items)
+    labels = {}
+
+    async def worker():
+        while queue:
+            mail_id, subject, body = queue.pop()
+            labels[mail_id] = (await mail_agent.classify_email(subject, body, LABELS)).get("label")
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return time.perf_counter() - started, labels
+
+
+async def batched(url: str, model: str, items: list, batch_size: int, concurrency: int) -> tuple:
+    mail_agent = agent(url, model, batch_size=batch_size)
+    chunks = [items[start:start + batch_size * 2] for start in range(0, len(items), batch_size * 2)]
+    labels = {}
+
+    async def worker():
+        while chunks:
+            results = await mail_agent.classify_batch(chunks.pop(), LABELS)
+            labels.update({mail_id: result.get("label") for mail_id, result in results.items()})
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return time.perf_counter() - started, labels
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--agent-url", help="a real Ollama server instead of the fake one")
+    parser.add_argument("--model", default="fake")
+    parser.add_argument("--mails", type=int, default=96)
+    parser.add_argument("--concurrency", type=int, default=config.BACKFILL_CONCURRENCY)
+    parser.add_argument("--batch-drop", type=float, default=0.05)
+    args = parser.parse_args()
+
+    server = None
+    url = args.agent_url
+    if url is None:
+        fake = FakeOllama(prefill_ms=0.5, decode_ms=10, load_ms=20, parallel=1, batch_drop=args.batch_drop)
+        server, url = serve_in_thread(create_app(fake))
+    items = corpus(args.mails)
+
+    print(f"{'mode':<16} {'seconds':>8} {'mails/s':>8} {'speedup':>8} {'requests':>9} {'re-run':>7} {'agree':>6}")
+    with contextlib.redirect_stdout(io.StringIO()):
+        baseline, reference = await per_mail(url, args.model, items, args.concurrency)
+    print(f"{'per mail':<16} {baseline:>8.2f} {len(items) / baseline:>8.2f} {1:>7.2f}x {len(items):>9} {'-':>7} {'-':>6}")
+    for batch_size in (4, 8, 16):
+        before = dict(BATCH_STATS)
+        with contextlib.redirect_stdout(io.StringIO()):
+            elapsed, labels = await batched(url, args.model, items, batch_size, args.concurrency)
+        batches = BATCH_STATS["batches"] - before["batches"]
+        rerun = BATCH_STATS["rerun_mails"] - before["rerun_mails"]
+        agree = sum(labels.get(mail_id) == label for mail_id, label in reference.items()) / len(reference)
+        print(f"{f'batch of {batch_size}':<16} {elapsed:>8.2f} {len(items) / elapsed:>8.2f} {baseline / elapsed:>7.2f}x "
+              f"{batches + rerun:>9} {rerun:>7} {agree:>6.0%}")
+
+    await close_llm_clients()
+    if server is not None:
+        server.should_exit = True
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
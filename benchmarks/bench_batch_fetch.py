@@ -0,0 +1,65 @@
+""" Messages per second: one messages.get per HTTP request vs Gmail batch requests
+
+Runs the discovery client the way Services does against the local fake Gmail
+server (benchmarks/fake_gmail.py) with a fixed latency per HTTP request, so
+the gap is the round trips a batch saves.
+
+    python -m benchmarks.bench_batch_fetch
+"""
+import time
+
+from google.oauth2.credentials import Credentials
+from google_auth_httplib2 import AuthorizedHttp
+from googleapiclient.discovery import build_from_document
+from googleapiclient.http import build_http
+
+from benchmarks.fake_gmail import FakeGmail, FakeMailbox, create_app, serve_in_thread
+from utils.service_cache import get_discovery_document
+from utils import util
+
+MAILS = 300
+LATENCY = 0.02
+BATCH_SIZES = [10, 50, 100]
+
+
+def sequential(service, mail_ids) -> int:
+    for mail_id in mail_ids:
+        service.users().messages().get(userId="me", id=mail_id, format="full").execute()
+    return len(mail_ids)
+
+
+def batched(service, mail_ids, batch_size) -> int:
+    fetched = []
+    for chunk in util.chunked(mail_ids, batch_size):
+        batch = service.new_batch_http_request(callback=lambda request_id, response, exception: fetched.append(response))
+        for mail_id in chunk:
+            batch.add(service.users().messages().get(userId="me", id=mail_id, format="full"), request_id=mail_id)
+        batch.execute()
+    assert all(fetched), "batch item failed"
+    return len(fetched)
+
+
+def run(label, fetch):
+    started = time.perf_counter()
+    count = fetch()
+    elapsed = time.perf_counter() - started
+    print(f"{label:<22} {count / elapsed:8.1f} messages/s   ({elapsed:.2f} s)")
+
+
+def main():
+    fake = FakeGmail(FakeMailbox(MAILS), latency=LATENCY)
+    server, url = serve_in_thread(create_app(fake))
+    service = build_from_document(get_discovery_document("gmail", "v1", url + "/"),
+                                  http=AuthorizedHttp(Credentials(token="bench"), http=build_http()))
+    mail_ids = [fake.mailbox.mail_id(i) for i in range(MAILS)]
+
+    print(f"{MAILS} mails, {LATENCY * 1000:.0f} ms per HTTP request")
+    run("sequential", lambda: sequential(service, mail_ids))
+    for batch_size in BATCH_SIZES:
+        run(f"batch of {batch_size}", lambda: batched(service, mail_ids, batch_size))
+    print("fake server:", dict(fake.stats))
+    server.should_exit = True
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,39 @@
+""" Cost of getting a Gmail client: discovery build() vs the per user service cache
+
+    python -m benchmarks.bench_build_service
+"""
+import time
+
+from google.oauth2.credentials import Credentials
+from googleapiclient.discovery import build
+
+from utils.service_cache import ServiceCache, get_discovery_document
+
+ROUNDS = 200
+
+
+def timed(fn, rounds: int = ROUNDS) -> float:
+    started = time.perf_counter()
+    for _ in range(rounds):
+        fn()
+    return (time.perf_counter() - started) / rounds * 1000
+
+
+def main():
+    creds = Credentials(token="token", refresh_token="refresh", client_id="id", client_secret="secret",
+                        token_uri="http://localhost/token")
+    cache = ServiceCache(maxsize=ROUNDS)
+    get_discovery_document("gmail", "v1")
+    counter = iter(range(10 ** 9))
+
+    cold = timed(lambda: build("gmail", "v1", credentials=creds))
+    miss = timed(lambda: cache.get(next(counter), "gmail", "v1", lambda: creds, "fp"))
+    warm = timed(lambda: cache.get(0, "gmail", "v1", lambda: creds, "fp"))
+
+    print(f"build() from discovery doc   {cold:8.3f} ms")
+    print(f"cache miss (parsed doc)       {miss:8.3f} ms")
+    print(f"cache hit                     {warm:8.3f} ms")
+
+
+if __name__ == "__main__":
+    main()
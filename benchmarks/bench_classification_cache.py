@@ -0,0 +1,90 @@
+""" Classification cache: LLM calls and seconds saved on a template heavy inbox
+
+Corpus: bank alerts, OTPs and shipping notices (same template, different
+amounts, codes and order ids) mixed with one-off mails. Runs MailAgent
+classification against the fake Ollama server (benchmarks/fake_ollama.py)
+without cache, with a cold cache, after a restart (LRU empty, SQLite warm)
+and after a label edit (new label fingerprint, everything misses).
+
+    python -m benchmarks.bench_classification_cache
+"""
+import asyncio
+import contextlib
+import io
+import os
+import random
+import tempfile
+import time
+
+from benchmarks.fake_gmail import serve_in_thread
+from benchmarks.fake_ollama import FakeOllama, create_app
+from benchmarks.common import LABELS, agent as make_agent
+from agents.ai_agent import MailAgent
+from db.classification_cache import ClassificationCache, SQLiteCacheStore
+from utils.llm_client import close_llm_clients
+from utils.normalise import normalise_body
+
+TEMPLATES = [
+    ("Your account was debited", "Dear customer, INR {amount}.00 was debited from account XX{account} on {day}-03-2025. "
+     "Available balance INR {balance}.50. If this was not you call 1800-{account}."),
+    ("Your one time password", "{otp} is your OTP for the transaction at AMAZON. Valid for 10 minutes. Do not share it."),
+    ("Your order has shipped", "Order #{order} has shipped and arrives on {day} March. Track it with AWB {awb}."),
+]
+WORDS = ("budget roadmap hiring offsite migration invoice contract launch review onboarding security audit "
+         "design pricing partnership renewal workshop feedback quarterly planning").split()
+
+
+def corpus(size: int, unique_share: float, seed: int = 7) -> list[tuple[str, str]]:
+    rng = random.Random(seed)
+    mails = []
+    for n in range(size):
+        if rng.random() < unique_share:
+            topic = " ".join(rng.sample(WORDS, 6))
+            mails.append((f"Notes on {topic.split()[0]}", f"Hi, following up on {topic}, let me know what you think."))
+            continue
+        subject, body = rng.choice(TEMPLATES)
+        mails.append((subject, body.format(amount=rng.randint(10, 99999), account=rng.randint(1000, 9999),
+                                           day=rng.randint(1, 28), balance=rng.randint(100, 999999),
+                                           otp=rng.randint(100000, 999999), order=rng.randint(10**8, 10**9),
+                                           awb=rng.randint(10**9, 10**10))))
+    return mails
+
+
+async def classify(agent: MailAgent, mails: list, labels: list) -> float:
+    started = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        for subject, body in mails:
+            await agent.classify_email(subject, normalise_body(body), labels)
+    return time.perf_counter() - started
+
+
+async def main():
+    fake = FakeOllama(prefill_ms=0.5, decode_ms=5)
+    server, url = serve_in_thread(create_app(fake))
+    mails = corpus(300, unique_share=0.2)
+    path = os.path.join(tempfile.mkdtemp(), "classification_cache.db")
+
+    print(f"{'run':<30} {'seconds':>8} {'llm calls':>10} {'hit rate':>9} {'saved llm s':>12}")
+    runs = (
+        ("no cache", lambda: ClassificationCache(max_entries=0), LABELS),
+        ("cold cache", lambda: ClassificationCache(SQLiteCacheStore(path)), LABELS),
+        ("restart (sqlite warm)", lambda: ClassificationCache(SQLiteCacheStore(path)), LABELS),
+        ("labels edited", lambda: ClassificationCache(SQLiteCacheStore(path)),
+         LABELS + [{"label_name": "Receipts", "label_description": "Order confirmations and receipts"}]),
+    )
+    for name, make_cache, labels in runs:
+        cache = make_cache()
+        agent = make_agent(url, cache=cache)
+        calls = fake.stats["requests"]
+        elapsed = await classify(agent, mails, labels)
+        summary = cache.summary()
+        print(f"{name:<30} {elapsed:>8.2f} {int(fake.stats['requests'] - calls):>10} {summary['hit_rate']:>9.1%} "
+              f"{summary['saved_llm_seconds']:>12.2f}")
+        await cache.close()
+
+    await close_llm_clients()
+    server.should_exit = True
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,84 @@
+""" LLM seconds per email: one request per stage vs the combined extraction
+
+Corpus: the synthetic mailbox (benchmarks/fake_gmail.py), bodies normalised
+as in MailAgent.run. The per-stage path is what run() did before
+AGENT_COMBINED_EXTRACTION: classify_email, manage_finance when the label is
+Expense or Income, schedule_event. Every stage sends the subject and body
+again. The combined path is MailAgent.extract, one request constrained to a
+JSON schema holding the label, finance and event fields. The fake Ollama
+server (benchmarks/fake_ollama.py) generates one request at a time. Cache and
+knn fast path are off, nothing is written to the database.
+
+    python -m benchmarks.bench_extraction
+    python -m benchmarks.bench_extraction --agent-url http://localhost:11434 --model llama3.2:3b
+"""
+import argparse
+import asyncio
+import contextlib
+import io
+import time
+
+from benchmarks.common import FINANCE_LABELS as LABELS, agent, corpus
+from benchmarks.fake_gmail import serve_in_thread
+from benchmarks.fake_ollama import FakeOllama, create_app
+from agents.ai_agent import MailAgent
+from utils.llm_client import close_llm_clients, get_llm_client
+
+async def per_stage(mail_agent: MailAgent, subject: str, body: str) -> dict:
+    classification = await mail_agent.classify_email(subject, body, LABELS)
+    label = str(classification.get("label"))
+    return {"label": label,
+            "finance": await mail_agent.manage_finance(subject, body, label),
+            "event": await mail_agent.schedule_event(subject, body, label)}
+
+
+async def combined(mail_agent: MailAgent, subject: str, body: str) -> dict:
+    extraction = await mail_agent.extract(subject, body, LABELS)
+    return {"label": extraction["classification"]["label"], "finance": extraction["finance"], "event": extraction["event"]}
+
+
+async def measure(mode, mail_agent: MailAgent, items: list) -> tuple:
+    client = get_llm_client(mail_agent.agent_url)
+    requests = client.stats["requests"]
+    results = []
+    started = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        for _, subject, body in items:
+            results.append(await mode(mail_agent, subject, body))
+    return time.perf_counter() - started, client.stats["requests"] - requests, results
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--agent-url", help="a real Ollama server instead of the fake one")
+    parser.add_argument("--model", default="fake")
+    parser.add_argument("--mails", type=int, default=24)
+    args = parser.parse_args()
+
+    server = None
+    url = args.agent_url
+    if url is None:
+        fake = FakeOllama(prefill_ms=2.0, decode_ms=15, parallel=1)
+        server, url = serve_in_thread(create_app(fake))
+    items = corpus(args.mails)
+    mail_agent = agent(url, args.model)
+
+    print(f"{'mode':<12} {'llm s/email':>12} {'requests/email':>15} {'finance':>8} {'events':>7} {'agree':>6}")
+    reference = None
+    baseline = None
+    for name, mode in (("per stage", per_stage), ("combined", combined)):
+        elapsed, requests, results = await measure(mode, mail_agent, items)
+        reference = reference or results
+        baseline = baseline or elapsed
+        agree = sum(result["label"] == expected["label"] for result, expected in zip(results, reference)) / len(items)
+        print(f"{name:<12} {elapsed / len(items):>12.3f} {requests / len(items):>15.2f} "
+              f"{sum(result['finance'] is not None for result in results):>8} "
+              f"{sum(result['event'] is not None for result in results):>7} {agree:>6.0%}   {baseline / elapsed:.2f}x")
+
+    await close_llm_clients()
+    if server is not None:
+        server.should_exit = True
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
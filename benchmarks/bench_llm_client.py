@@ -0,0 +1,101 @@
+""" Concurrent classification throughput: blocking requests vs the pooled async client
+
+Every "user" is an asyncio task classifying its mails one after the other,
+the way the mail workers do. The old _agent_generate called requests.post
+inside the coroutine, so one classification blocked the event loop and every
+other user waited behind it. The pooled client (utils/llm_client.py) keeps
+the loop free and bounds requests in flight per backend.
+
+    python -m benchmarks.bench_llm_client
+"""
+import asyncio
+import contextlib
+import io
+import json
+import statistics
+import time
+
+import requests
+
+from benchmarks.fake_gmail import serve_in_thread
+from benchmarks.fake_ollama import FakeOllama, create_app
+from benchmarks.common import LABELS, agent as make_agent
+from agents.ai_agent import MailAgent
+from db.classification_cache import ClassificationCache
+from utils.llm_client import LLMClient, get_llm_client, close_llm_clients
+
+BODY = "Hi, please find the minutes of today's meeting below and let me know if anything is missing. " * 8
+
+
+class BlockingMailAgent(MailAgent):
+    """ MailAgent with the previous requests based _agent_generate """
+
+    async def _agent_generate(self, prompt: str, max_tokens: int = 512, temperature: float = 0.0, options: dict = None,
+                              system: str = None, schema: dict = None) -> str:
+        payload = {"model": self.agent_model, "prompt": prompt, "max_tokens": max_tokens, "temperature": temperature,
+                   "system": system, "format": schema}
+        response = requests.post(f"{self.agent_url}/api/generate", headers={"Content-Type": "application/json"},
+                                 data=json.dumps(payload), stream=True)
+        output = ""
+        for line in response.iter_lines():
+            if line:
+                output += json.loads(line.decode("utf-8")).get("response", "")
+        return output
+
+
+async def classify_all(agent_class, url: str, users: int, per_user: int) -> tuple[float, list[float]]:
+    latencies = []
+
+    async def user(user_id: int):
+        agent = agent_class(None, user_id, agent_url=url, agent_model="fake", cache=ClassificationCache(max_entries=0),
+                            use_knn=False)
+        for n in range(per_user):
+            started = time.perf_counter()
+            await agent.classify_email(f"Minutes {user_id}-{n}", BODY, LABELS)
+            latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        await asyncio.gather(*(user(user_id) for user_id in range(users)))
+    return time.perf_counter() - started, latencies
+
+
+async def cancellation(url: str) -> int:
+    """ Cancel classifications mid stream, the slots must come back """
+    client = get_llm_client(url)
+    agent = make_agent(url, user_id=0)
+    with contextlib.redirect_stdout(io.StringIO()):
+        tasks = [asyncio.create_task(agent.classify_email("Cancelled", BODY, LABELS)) for _ in range(4)]
+        await asyncio.sleep(0.05)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+    return client.stats["in_flight"]
+
+
+async def main():
+    fake = FakeOllama(prefill_ms=0.2, decode_ms=5)
+    server, url = serve_in_thread(create_app(fake))
+    users, per_user = 16, 4
+
+    print(f"{'client':<22} {'mails':>6} {'seconds':>8} {'mails/s':>8} {'p50 ms':>8} {'p99 ms':>8}")
+    for name, agent_class in (("requests (blocking)", BlockingMailAgent), ("pooled async client", MailAgent)):
+        elapsed, latencies = await classify_all(agent_class, url, users, per_user)
+        latencies.sort()
+        print(f"{name:<22} {len(latencies):>6} {elapsed:>8.2f} {len(latencies) / elapsed:>8.1f} "
+              f"{statistics.median(latencies) * 1000:>8.0f} {latencies[int(len(latencies) * 0.99) - 1] * 1000:>8.0f}")
+
+    for limit in (1, 4, 16):
+        bounded = LLMClient(url, max_in_flight=limit)
+        started = time.perf_counter()
+        await asyncio.gather(*(bounded.generate({"model": "fake", "prompt": f"{BODY}{n}"}) for n in range(32)))
+        print(f"max_in_flight={limit:<3} 32 requests in {time.perf_counter() - started:.2f}s")
+        await bounded.close()
+
+    print("in flight after cancelling 4 streams:", await cancellation(url))
+    await close_llm_clients()
+    server.should_exit = True
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,102 @@
+""" Nested dict mails vs MailRecord: memory per parsed mail and parse-to-store CPU
+
+Both versions run the same body extraction (utils/mime.py), so the gap is
+the header lookup (linear get_header scans vs one indexed pass) and the
+container (two dicts vs one slotted record). "Parse to store" is what the
+pipeline does per mail: parse, set the label, build the Chroma metadata and
+serialise for a queue.
+
+    python -m benchmarks.bench_mail_record
+"""
+import gc
+import json
+import time
+import tracemalloc
+from datetime import datetime
+
+from benchmarks.fake_gmail import FakeMailbox
+from utils.mime import extract_body
+from utils.util import ParseUtil
+
+MAILS = 5000
+
+
+def dict_mail(message: dict) -> dict:
+    """ The previous ParseUtil.gmail_messages output """
+    payload = message.get('payload', {})
+    headers = payload.get('headers', [])
+
+    def get_header(name):
+        for header in headers:
+            if header['name'].lower() == name.lower():
+                return header['value']
+        return None
+
+    document, truncated = extract_body(payload)
+    return {
+        "document": document,
+        "metadata": {
+            "mail_id": message.get('id'),
+            "history_id": message.get('historyId'),
+            "created_at": datetime.utcfromtimestamp(int(message.get('internalDate')) / 1000).strftime('%Y-%m-%d %H:%M:%S'),
+            "updated_at": datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S'),
+            "stored_at": datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S'),
+            "sent_by": get_header('From'),
+            "sent_to": get_header('To'),
+            "subject": get_header('Subject'),
+            "header": get_header('X-Header') or "",
+            "cc": get_header('Cc') or "",
+            "bcc": get_header('Bcc') or "",
+            "list_unsubscribe": get_header('List-Unsubscribe') or "",
+            "list_id": get_header('List-Id') or "",
+            "precedence": get_header('Precedence') or "",
+            "body_truncated": truncated,
+        }
+    }
+
+
+def dict_store(message: dict):
+    mail = dict_mail(message)
+    mail["metadata"]["user_id"] = 1
+    mail["metadata"].update({"label": "Work", "classification_reason": "project update"})
+    return dict(mail["metadata"]), json.dumps(mail)
+
+
+def record_store(message: dict, parser=ParseUtil()):
+    mail = parser.gmail_messages(message)
+    mail.user_id = 1
+    mail.label, mail.classification_reason = "Work", "project update"
+    return mail.chroma_metadata(), mail.to_json()
+
+
+def retained_bytes(parse, messages) -> float:
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    mails = [parse(message) for message in messages]
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del mails
+    return (after - before) / len(messages)
+
+
+def cpu_seconds(store, messages) -> float:
+    started = time.process_time()
+    for message in messages:
+        store(message)
+    return (time.process_time() - started) / len(messages)
+
+
+def main():
+    mailbox = FakeMailbox(MAILS)
+    messages = [mailbox.resource(i) for i in range(MAILS)]
+    parser = ParseUtil()
+    print(f"{MAILS} mails")
+    for label, parse, store in (("dict", dict_mail, dict_store), ("MailRecord", parser.gmail_messages, record_store)):
+        cpu_seconds(store, messages[:200])      # warm up
+        print(f"{label:<11} {retained_bytes(parse, messages):8.0f} bytes/mail retained   "
+              f"{cpu_seconds(store, messages) * 1e6:7.1f} us/mail parse to store")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,109 @@
+""" Body extraction over common real-world message shapes: old top-level decoder vs the MIME walker
+
+For every shape: characters of body found, time per parse and peak memory
+(tracemalloc) of the decode. Payloads are Gmail format='full' resources
+built the way Gmail lays them out (benchmarks/fake_gmail.py).
+
+    python -m benchmarks.bench_mime_parse
+"""
+import timeit
+import tracemalloc
+from base64 import urlsafe_b64decode
+from email.message import EmailMessage
+
+from benchmarks.fake_gmail import FakeMailbox
+from utils.mime import extract_body
+
+PARAGRAPH = "Hello team, the quarterly numbers are attached. Please review them before Friday's meeting. "
+
+
+def message(subject: str) -> EmailMessage:
+    msg = EmailMessage()
+    msg["From"] = "Sender <sender@example.com>"
+    msg["To"] = "me@example.com"
+    msg["Subject"] = subject
+    return msg
+
+
+def newsletter_html(size: int) -> str:
+    row = "<tr><td style='padding:8px'><a href='https://shop.example/p?id=1&amp;utm=x'>Deal</a> " + PARAGRAPH + "</td></tr>"
+    return "<html><head><style>td{color:red}</style></head><body><table>" + row * (size // len(row)) + "</table></body></html>"
+
+
+def corpus() -> dict:
+    shapes = {}
+
+    msg = message("plain only")
+    msg.set_content(PARAGRAPH * 10)
+    shapes["text/plain only"] = msg
+
+    msg = message("html only")
+    msg.set_content(newsletter_html(50_000), subtype="html")
+    shapes["text/html only (50 KB)"] = msg
+
+    msg = message("alternative")
+    msg.set_content(PARAGRAPH * 10)
+    msg.add_alternative(f"<p>{PARAGRAPH * 10}</p>", subtype="html")
+    shapes["alternative"] = msg
+
+    msg = message("mixed > alternative > related")
+    msg.set_content(PARAGRAPH * 10)
+    msg.add_alternative(f"<p>{PARAGRAPH * 10}<img src='cid:logo'></p>", subtype="html")
+    msg.get_payload()[1].add_related(b"\x89PNG" + b"\0" * 20_000, maintype="image", subtype="png", cid="<logo>")
+    msg.add_attachment(b"%PDF" + b"\0" * 2_000_000, maintype="application", subtype="pdf", filename="report.pdf")
+    shapes["mixed/alt/related + 2 MB pdf"] = msg
+
+    msg = message("forwarded")
+    msg.set_content("See the mail below.\n")
+    inner = message("original")
+    inner.set_content(PARAGRAPH * 5)
+    msg.add_attachment(inner, filename="original.eml")
+    shapes["forward as attachment"] = msg
+
+    msg = message("list footer")
+    msg.set_content(PARAGRAPH * 10)
+    msg.add_alternative(f"<p>{PARAGRAPH * 10}</p>", subtype="html")
+    msg.make_mixed()
+    footer = EmailMessage()
+    footer.set_content("--\nYou received this because you are subscribed to the list.")
+    msg.attach(footer)
+    shapes["mixed(alternative, footer)"] = msg
+
+    msg = message("huge newsletter")
+    msg.set_content(newsletter_html(20_000_000), subtype="html")
+    shapes["html only (20 MB)"] = msg
+
+    mailbox = FakeMailbox()
+    return {name: mailbox.payload(msg, "bench") for name, msg in shapes.items()}
+
+
+def legacy_body(payload: dict) -> str:
+    """ The previous ParseUtil decoder: top level body or a first level text/plain part """
+    if "data" in payload.get("body", {}):
+        return urlsafe_b64decode(payload["body"]["data"]).decode("utf-8", errors="ignore")
+    for part in payload.get("parts", []):
+        if part.get("mimeType") == "text/plain" and "data" in part.get("body", {}):
+            return urlsafe_b64decode(part["body"]["data"]).decode("utf-8", errors="ignore")
+    return ""
+
+
+def measure(parse, payload) -> tuple[int, float, int]:
+    tracemalloc.start()
+    body = parse(payload)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    timer = timeit.Timer(lambda: parse(payload))
+    number, _ = timer.autorange()
+    return len(body), min(timer.repeat(3, number)) / number, peak
+
+
+def main():
+    print(f"{'shape':<30} {'':>9} {'body chars':>11} {'per parse':>12} {'peak memory':>13}")
+    for name, payload in corpus().items():
+        for label, parse in (("old", legacy_body), ("walker", lambda p: extract_body(p)[0])):
+            chars, seconds, peak = measure(parse, payload)
+            print(f"{name if label == 'old' else '':<30} {label:>9} {chars:>11} {seconds * 1e6:>9.0f} us {peak / 1024:>10.0f} KB")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,90 @@
+""" Prompt tokens and classification latency: raw bodies vs normalise_body
+
+Corpus: synthetic mailbox mails (benchmarks/fake_gmail.py) plus long reply
+threads, tracking-link newsletters and invoices with the amount at the
+bottom. Classification runs MailAgent.classify_email against the fake
+Ollama server (benchmarks/fake_ollama.py), whose prompt evaluation time
+grows with the prompt like a real model's.
+
+    python -m benchmarks.bench_normalise
+"""
+import asyncio
+import contextlib
+import io
+import statistics
+import time
+
+from benchmarks.fake_gmail import serve_in_thread
+from benchmarks.fake_ollama import FakeOllama, create_app
+from benchmarks.common import LABELS, agent as make_agent, mails
+from agents.ai_agent import MailAgent
+from utils.llm_client import close_llm_clients
+from utils.normalise import normalise_body, estimate_tokens
+
+SENTENCE = "Thanks for the update on the migration, I went through the plan and left a few comments in the doc. "
+FOOTER = ("\n\nCONFIDENTIALITY NOTICE: This email and any attachments are confidential and intended for the "
+          "intended recipient only. If you received it in error please delete it.\n")
+
+
+def reply_thread(depth: int) -> str:
+    body = SENTENCE * 3
+    for n in range(depth):
+        quoted = "\n".join("> " + line for line in body.split("\n"))
+        body = f"{SENTENCE * 2}\n\nBest regards,\nAnna\n\nOn Mon, 3 Mar 2025 at 10:{n:02d}, Tom <tom@example.org> wrote:\n{quoted}{FOOTER}"
+    return body
+
+
+def newsletter(items: int) -> str:
+    link = "https://click.mailer.example/track/a8f3e9c0d1b2?u=12345&id=9f8e7d6c5b4a&utm_source=newsletter&utm_medium=email"
+    rows = [f"Deal {n}: 30% off headphones {link}&item={n}" for n in range(items)]
+    return "View this email in your browser\n\n" + "\n\n".join(rows) + "\n\nUnsubscribe | Manage preferences | Privacy policy"
+
+
+def invoice(paragraphs: int) -> str:
+    return (SENTENCE * 4 + "\n\n") * paragraphs + "Total due: $1,249.00 by 12 March 2025.\nInvoice date: 2025-02-26"
+
+
+def corpus() -> dict:
+    return {
+        "synthetic mailbox (200)": [mail.document for mail in mails(200)],
+        "reply thread, 8 deep": [reply_thread(8)] * 20,
+        "tracking newsletter": [newsletter(40)] * 20,
+        "long invoice": [invoice(30)] * 20,
+    }
+
+
+async def classify_latency(agent: MailAgent, bodies: list[str]) -> float:
+    latencies = []
+    with contextlib.redirect_stdout(io.StringIO()):
+        for body in bodies:
+            started = time.perf_counter()
+            await agent.classify_email("Update", body, LABELS)
+            latencies.append(time.perf_counter() - started)
+    return statistics.mean(latencies)
+
+
+async def main():
+    fake = FakeOllama(prefill_ms=0.5, decode_ms=5)
+    server, url = serve_in_thread(create_app(fake))
+    agent = make_agent(url)
+
+    print(f"{'shape':<26} {'tokens raw':>10} {'normalised':>10} {'reduction':>10} {'classify raw':>13} {'normalised':>11}")
+    total_raw = total_normalised = 0
+    for name, bodies in corpus().items():
+        normalised = [normalise_body(body) for body in bodies]
+        raw_tokens = sum(map(estimate_tokens, bodies))
+        normalised_tokens = sum(map(estimate_tokens, normalised))
+        total_raw += raw_tokens
+        total_normalised += normalised_tokens
+        sample = slice(0, 10)
+        print(f"{name:<26} {raw_tokens / len(bodies):>10.0f} {normalised_tokens / len(bodies):>10.0f} "
+              f"{1 - normalised_tokens / raw_tokens:>9.0%} {await classify_latency(agent, bodies[sample]) * 1000:>10.0f} ms "
+              f"{await classify_latency(agent, normalised[sample]) * 1000:>8.0f} ms")
+    print(f"overall token reduction {1 - total_normalised / total_raw:.0%}")
+    print("kept from the invoice tail:", normalise_body(invoice(30)).rsplit("...", 1)[-1].strip().replace("\n", " | "))
+    await close_llm_clients()
+    server.should_exit = True
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,116 @@
+""" Time to first token with and without reuse of the per-user prompt prefix
+
+Mails of the synthetic mailbox (benchmarks/fake_gmail.py) arrive in bursts
+separated by idle gaps, alternating between two users with different label
+sets, and go one by one through MailAgent.classify_email. The fake Ollama
+server (benchmarks/fake_ollama.py) keeps a prompt cache of --kv-slots prompts
+and unloads the model after its default keep_alive (--server-keep-alive
+seconds, a scaled down 5m); a cold request pays --cold-load-ms.
+
+    no reuse          every prompt evaluated in full, no keep_alive
+    prefix reuse      prompt cache on, the model is still unloaded between bursts
+    prefix+keep_alive prompt cache on and AGENT_KEEP_ALIVE sent with every request
+
+    python -m benchmarks.bench_prefix_cache
+    python -m benchmarks.bench_prefix_cache --agent-url http://localhost:11434 --model llama3.2:3b
+"""
+import argparse
+import asyncio
+import contextlib
+import io
+import statistics
+
+from benchmarks.common import agent, corpus
+from benchmarks.fake_gmail import serve_in_thread
+from benchmarks.fake_ollama import FakeOllama, create_app
+from env_secrets import config
+from utils.llm_client import close_llm_clients, get_llm_client
+
+USER_LABELS = {
+    1: [
+        {"label_name": "Finance", "label_description": "Bills, statements, invoices, payments, refunds, card and bank alerts"},
+        {"label_name": "Work", "label_description": "Colleagues, projects, tickets, meetings, reviews and release notes"},
+        {"label_name": "Personal", "label_description": "Friends and family, private plans, invitations and photos"},
+        {"label_name": "Promotions", "label_description": "Newsletters, offers, coupons, sales and marketing campaigns"},
+        {"label_name": "Travel", "label_description": "Flights, trains, hotels, bookings, boarding passes and itineraries"},
+        {"label_name": "Notifications", "label_description": "Automated account, security and service notifications"},
+    ],
+    2: [
+        {"label_name": "Clients", "label_description": "Requests, quotes and feedback from clients of the studio"},
+        {"label_name": "Invoices", "label_description": "Invoices sent and received, payment reminders and receipts"},
+        {"label_name": "Suppliers", "label_description": "Orders, deliveries and price lists from suppliers"},
+        {"label_name": "Hiring", "label_description": "Applications, interviews and recruiter messages"},
+        {"label_name": "Other", "label_description": "Everything else"},
+    ],
+}
+
+
+async def run(url: str, model: str, items: list, bursts: int, gap: float) -> dict:
+    """ first token seconds and prompt tokens evaluated of every request, in arrival order """
+    agents = {user_id: agent(url, model, user_id) for user_id in USER_LABELS}
+    client = get_llm_client(url)
+    per_burst = len(items) // bursts
+    first_token, evaluated = [], []
+    for burst in range(bursts):
+        if burst:
+            await asyncio.sleep(gap)
+        user_id = list(USER_LABELS)[burst % len(USER_LABELS)]
+        for _, subject, body in items[burst * per_burst:(burst + 1) * per_burst]:
+            before = dict(client.stats)
+            with contextlib.redirect_stdout(io.StringIO()):
+                await agents[user_id].classify_email(subject, body, USER_LABELS[user_id])
+            first_token.append(client.stats["first_token_seconds"] - before["first_token_seconds"])
+            evaluated.append(client.stats["prompt_eval_tokens"] - before["prompt_eval_tokens"])
+    return {"first_token": first_token, "evaluated": evaluated}
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--agent-url", help="a real Ollama server instead of the fake one (runs the keep_alive modes only)")
+    parser.add_argument("--model", default="fake")
+    parser.add_argument("--mails", type=int, default=24)
+    parser.add_argument("--bursts", type=int, default=4)
+    parser.add_argument("--gap", type=float, default=1.5, help="idle seconds between bursts")
+    parser.add_argument("--kv-slots", type=int, default=4)
+    parser.add_argument("--cold-load-ms", type=float, default=800)
+    parser.add_argument("--server-keep-alive", type=float, default=1.0)
+    args = parser.parse_args()
+
+    fake = None
+    server = None
+    url = args.agent_url
+    if url is None:
+        fake = FakeOllama(prefill_ms=2.0, decode_ms=15, parallel=1, cold_load_ms=args.cold_load_ms,
+                          keep_alive=args.server_keep_alive)
+        server, url = serve_in_thread(create_app(fake))
+    items = corpus(args.mails)
+    keep_alive = config.AGENT_KEEP_ALIVE or "30m"
+
+    modes = [("no reuse", 0, ""), ("prefix reuse", args.kv_slots, ""),
+             ("prefix+keep_alive", args.kv_slots, keep_alive)]
+    if fake is None:
+        modes = [("server default", None, ""), ("keep_alive", None, keep_alive)]
+
+    print(f"{'mode':<18} {'ttft p50 ms':>12} {'ttft mean ms':>13} {'ttft max ms':>12} {'prompt tokens':>14}")
+    baseline = None
+    for name, kv_slots, agent_keep_alive in modes:
+        if fake is not None:
+            # fresh server state: cold model, empty prompt cache
+            fake.kv_slots = kv_slots
+            fake._kv = []
+            fake._loaded_until = 0.0
+        config.AGENT_KEEP_ALIVE = agent_keep_alive
+        result = await run(url, args.model, items, args.bursts, args.gap)
+        mean = statistics.mean(result["first_token"])
+        baseline = baseline or mean
+        print(f"{name:<18} {statistics.median(result['first_token']) * 1000:>12.1f} {mean * 1000:>13.1f} "
+              f"{max(result['first_token']) * 1000:>12.1f} {sum(result['evaluated']):>14}"
+              f"   {baseline / mean:.2f}x")
+
+    await close_llm_clients()
+    if server is not None:
+        server.should_exit = True
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,103 @@
+""" Rule engine match time: compiled matcher vs checking every rule in turn
+
+Rules: sender domains, subject substrings and regexes, list ids and a
+List-Unsubscribe presence rule. Mails: the synthetic mailbox
+(benchmarks/fake_gmail.py) parsed into MailRecords. The compiled matcher
+(utils/rules.py) does a dict lookup for domains and one combined regex
+search per field; the naive loop runs one re.search per rule. Before timing,
+both must pick a rule of the same priority for every mail, including rules
+whose matches overlap ("new order" and "order 123" in "New order 123").
+
+    python -m benchmarks.bench_rules
+"""
+import random
+import re
+import time
+from types import SimpleNamespace
+
+from benchmarks.fake_gmail import FakeMailbox
+from utils.rules import CompiledRules, sender_domain
+from utils.util import ParseUtil
+
+WORDS = "invoice receipt order shipped statement payment alert meeting offer sale ticket booking report".split()
+
+
+def make_rules(count: int, seed: int = 3) -> list:
+    rng = random.Random(seed)
+    rules = [SimpleNamespace(id=1, field="list_unsubscribe", pattern="", is_regex=False, label_name="Promotions",
+                             priority=0, enabled=True)]
+    for rule_id in range(2, count + 1):
+        kind = rng.choice(("sender_domain", "subject", "subject_regex", "sender", "list_id"))
+        word = rng.choice(WORDS) + str(rule_id)
+        field, pattern, is_regex = {
+            "sender_domain": ("sender_domain", f"{word}.example.com", False),
+            "subject": ("subject", f"{word} #", False),
+            "subject_regex": ("subject", rf"{word}\s*#?\d+", True),
+            "sender": ("sender", f"{word}@", False),
+            "list_id": ("list_id", f"{word}.lists.example.com", False),
+        }[kind]
+        rules.append(SimpleNamespace(id=rule_id, field=field, pattern=pattern, is_regex=is_regex,
+                                     label_name=rng.choice(("Finance", "Work", "Promotions")),
+                                     priority=rng.randint(0, 5), enabled=True))
+    return rules
+
+
+def naive_match(rules: list, mail):
+    best = None
+    for rule in rules:
+        if rule.field == "sender_domain":
+            domain = sender_domain(mail.sent_by)
+            hit = domain == rule.pattern or domain.endswith("." + rule.pattern)
+        else:
+            value = getattr(mail, "sent_by" if rule.field == "sender" else rule.field)
+            pattern = rule.pattern if rule.is_regex else re.escape(rule.pattern)
+            hit = bool(value) and (not rule.pattern or re.search(pattern, value, re.I) is not None)
+        if hit and (best is None or rule.priority > best.priority):
+            best = rule
+    return best
+
+
+def check(rules: list, mails: list):
+    """ The compiled matcher finds the same best priority as the naive loop, for every mail """
+    compiled = CompiledRules(rules)
+    priorities = {rule.id: rule.priority for rule in rules}
+    for mail in mails:
+        expected = naive_match(rules, mail)
+        found = compiled.match(mail)
+        assert (found and priorities[found["rule_id"]]) == (expected and expected.priority), (mail.subject, found, expected)
+
+
+def check_overlapping():
+    rules = [SimpleNamespace(id=1, field="subject", pattern="new order", is_regex=False, label_name="Promotions",
+                             priority=1, enabled=True),
+             SimpleNamespace(id=2, field="subject", pattern=r"order \d+", is_regex=True, label_name="Finance",
+                             priority=5, enabled=True)]
+    mail = SimpleNamespace(sent_by="shop@example.com", subject="New order 123 placed", list_id="", list_unsubscribe="")
+    assert CompiledRules(rules).match(mail)["rule_id"] == 2
+    check(rules, [mail])
+
+
+def main():
+    mailbox = FakeMailbox(2000)
+    parser = ParseUtil()
+    mails = [parser.gmail_messages(mailbox.resource(index, "metadata")) for index in range(2000)]
+    check_overlapping()
+
+    print(f"{'rules':>6} {'naive us/mail':>14} {'compiled us/mail':>17} {'matched':>8}")
+    for count in (10, 100, 1000):
+        rules = make_rules(count)
+        check(rules, mails)
+        started = time.perf_counter()
+        for mail in mails:
+            naive_match(rules, mail)
+        naive = (time.perf_counter() - started) / len(mails)
+
+        compiled = CompiledRules(rules)
+        started = time.perf_counter()
+        matched = sum(compiled.match(mail) is not None for mail in mails)
+        fast = (time.perf_counter() - started) / len(mails)
+        print(f"{count:>6} {naive * 1e6:>14.1f} {fast * 1e6:>17.1f} {matched / len(mails):>8.0%}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,58 @@
+""" Throughput of the per user scheduler with a growing number of workers
+
+Every job simulates one notification (Gmail + LLM round trips) with a fixed
+sleep, so the numbers show how well the scheduler overlaps I/O across users
+while keeping each mailbox in history order.
+
+    python -m benchmarks.bench_scheduler
+"""
+import asyncio
+import random
+import time
+
+from utils.scheduler import UserScheduler
+
+JOBS = 2000
+JOB_SECONDS = 0.005
+USERS = [1, 10, 1000]
+WORKERS = [1, 4, 16, 64]
+
+
+async def run(users: int, workers: int) -> float:
+    last_seen = {}
+    done = asyncio.Event()
+    finished = 0
+
+    async def handler(user_id, history_id):
+        nonlocal finished
+        # strict order per mailbox
+        assert last_seen.get(user_id, -1) < history_id, "out of order"
+        last_seen[user_id] = history_id
+        await asyncio.sleep(JOB_SECONDS)
+        finished += 1
+        if finished == JOBS:
+            done.set()
+
+    scheduler = UserScheduler(handler, concurrency=workers, max_pending=JOBS)
+    scheduler.start()
+    rng = random.Random(7)
+    started = time.perf_counter()
+    for history_id in range(JOBS):
+        user_id = rng.randrange(users)
+        await scheduler.submit(user_id, history_id, history_id)
+    await done.wait()
+    elapsed = time.perf_counter() - started
+    await scheduler.stop()
+    return JOBS / elapsed
+
+
+async def main():
+    print(f"{JOBS} jobs of {JOB_SECONDS * 1000:.0f} ms each, jobs/sec")
+    print("users".ljust(8) + "".join(f"{w} workers".rjust(14) for w in WORKERS))
+    for users in USERS:
+        row = [await run(users, workers) for workers in WORKERS]
+        print(str(users).ljust(8) + "".join(f"{r:14.0f}" for r in row))
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
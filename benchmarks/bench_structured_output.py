@@ -0,0 +1,97 @@
+""" Classification answers: full stream + json.loads vs schema, early stop and repair
+
+Corpus: the synthetic mailbox (benchmarks/fake_gmail.py), bodies normalised
+as in MailAgent.run. The fake Ollama server (benchmarks/fake_ollama.py) keeps
+generating --trailing-tokens of whitespace after every answer, as a model does
+until it emits end of sequence, and cuts --malformed of the answers off half
+way, as a too small token cap does.
+
+    before   what classify_email did: top-level max_tokens (ignored by Ollama),
+             no schema, wait for the whole stream, json.loads, on failure the
+             first user label with confidence 0
+    after    MailAgent.classify_email: `format` schema, options.num_predict,
+             stream closed once the JSON object is complete, one repair
+             request for an unusable answer
+
+Cache and knn fast path are off.
+
+    python -m benchmarks.bench_structured_output
+"""
+import argparse
+import asyncio
+import contextlib
+import io
+import json
+import time
+
+from benchmarks.common import LABELS, agent, corpus
+from benchmarks.fake_gmail import serve_in_thread
+from benchmarks.fake_ollama import FakeOllama, create_app
+from agents.ai_agent import MailAgent, PARSE_STATS
+from utils.llm_client import close_llm_clients, get_llm_client
+
+async def before(mail_agent: MailAgent, subject: str, body: str) -> dict:
+    payload = {
+        "model": mail_agent.agent_model,
+        "system": mail_agent.classifier_prefix(LABELS),
+        "prompt": ("Output a JSON object with keys: label, confidence (0-1), reason.\n\n"
+                   f"SUBJECT:\n{subject}\n\nBODY:\n{body}\n\nRespond ONLY with JSON."),
+        "max_tokens": 256,
+        "temperature": 0.0,
+        "options": {"num_ctx": await mail_agent._context_tokens()},
+    }
+    raw = await get_llm_client(mail_agent.agent_url).generate(payload)
+    try:
+        return json.loads(raw)
+    except Exception:
+        return {"label": LABELS[0]["label_name"], "confidence": 0.0, "reason": raw[:300], "source": "unparsed"}
+
+
+async def after(mail_agent: MailAgent, subject: str, body: str) -> dict:
+    return await mail_agent.classify_email(subject, body, LABELS)
+
+
+async def measure(mode, mail_agent: MailAgent, items: list, fake: FakeOllama) -> dict:
+    client = get_llm_client(mail_agent.agent_url)
+    counters = dict(client.stats), dict(PARSE_STATS), dict(fake.stats)
+    started = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        results = [await mode(mail_agent, subject, body) for _, subject, body in items]
+    elapsed = time.perf_counter() - started
+    requests = client.stats["requests"] - counters[0]["requests"]
+    return {"seconds": elapsed, "requests": requests, "results": results,
+            "tokens": (fake.stats["streamed_tokens"] - counters[2].get("streamed_tokens", 0)) / requests,
+            "unusable": sum(result.get("source") == "unparsed" for result in results),
+            "repaired": PARSE_STATS["repaired"] - counters[1]["repaired"]}
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--mails", type=int, default=40)
+    parser.add_argument("--trailing-tokens", type=int, default=40)
+    parser.add_argument("--malformed", type=float, default=0.1)
+    args = parser.parse_args()
+
+    fake = FakeOllama(prefill_ms=0.5, decode_ms=15, parallel=1, trailing_tokens=args.trailing_tokens)
+    server, url = serve_in_thread(create_app(fake))
+    items = corpus(args.mails)
+    mail_agent = agent(url)
+    reference = [result["label"] for result in (await measure(after, mail_agent, items, fake))["results"]]
+
+    fake.malformed = args.malformed
+    print(f"{'mode':<8} {'s/mail':>7} {'requests':>9} {'tokens/request':>15} {'repaired':>9} {'unusable':>9} {'mislabelled':>12}")
+    baseline = None
+    for name, mode in (("before", before), ("after", after)):
+        report = await measure(mode, mail_agent, items, fake)
+        baseline = baseline or report["seconds"]
+        mislabelled = sum(result.get("label") not in ("", label)
+                          for result, label in zip(report["results"], reference))
+        print(f"{name:<8} {report['seconds'] / len(items):>7.3f} {report['requests']:>9} {report['tokens']:>15.1f} "
+              f"{report['repaired']:>9} {report['unusable']:>9} {mislabelled:>12}   {baseline / report['seconds']:.2f}x")
+
+    await close_llm_clients()
+    server.should_exit = True
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,39 @@
+""" Label sets, corpus and MailAgent setup shared by the benchmarks """
+from benchmarks.fake_gmail import FakeMailbox
+from agents.ai_agent import MailAgent
+from db.classification_cache import ClassificationCache
+from utils.normalise import normalise_body
+from utils.util import ParseUtil
+
+LABELS = [
+    {"label_name": "Finance", "label_description": "Bills, statements, invoices, payments and bank alerts"},
+    {"label_name": "Work", "label_description": "Colleagues, projects, tickets, meetings and reviews"},
+    {"label_name": "Personal", "label_description": "Friends and family, private plans"},
+    {"label_name": "Promotions", "label_description": "Newsletters, offers, sales and marketing"},
+    {"label_name": "Travel", "label_description": "Flights, hotels, bookings and itineraries"},
+    {"label_name": "Notifications", "label_description": "Automated account and service notifications"},
+]
+# Expense / Income instead of Finance, the labels the finance action writes for
+FINANCE_LABELS = [
+    {"label_name": "Expense", "label_description": "Bills, invoices and receipts of things the user paid for"},
+    {"label_name": "Income", "label_description": "Payments the user received"},
+    *LABELS[1:4],
+]
+
+
+def mails(size: int) -> list:
+    """ The first size mails of the synthetic mailbox (benchmarks/fake_gmail.py) as MailRecords """
+    mailbox = FakeMailbox(size)
+    parser = ParseUtil()
+    return [parser.gmail_messages(mailbox.resource(index)) for index in range(size)]
+
+
+def corpus(size: int) -> list:
+    """ (mail_id, subject, body) of the synthetic mailbox, bodies normalised as in MailAgent.run """
+    return [(mail.mail_id, mail.subject, normalise_body(mail.document)) for mail in mails(size)]
+
+
+def agent(url: str, model: str = "fake", user_id: int = 1, **kwargs) -> MailAgent:
+    """ MailAgent without database, classification cache or knn fast path, every classification asks the model """
+    kwargs.setdefault("cache", ClassificationCache(max_entries=0))
+    return MailAgent(None, user_id, agent_url=url, agent_model=model, use_knn=False, **kwargs)
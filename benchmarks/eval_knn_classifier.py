@@ -0,0 +1,147 @@
+""" Offline evaluation of the knn fast path (agents/knn_classifier.py)
+
+Leave-one-out over labelled mails: every mail is classified from its
+neighbours as if it had just arrived, and the vote is compared with the
+label the LLM gave it. For each threshold it reports the LLM-call reduction
+(share of mails the fast path answers) and the agreement rate (answers that
+match the LLM). Pick the lowest threshold whose agreement you accept and set
+KNN_THRESHOLD.
+
+    python -m benchmarks.eval_knn_classifier                  # synthetic corpus, offline
+    python -m benchmarks.eval_knn_classifier --user-id 3      # a user's Chroma collection
+
+The user mode reuses the embeddings stored in the collection, nothing is
+re-embedded. The synthetic mode embeds with a hashing bag of words so it runs
+without downloading a model.
+"""
+import argparse
+import hashlib
+import random
+import re
+import time
+
+import chromadb
+import numpy as np
+
+from agents.knn_classifier import KnnClassifier
+from db.vector_db import get_chroma_collection
+from env_secrets import config
+
+THRESHOLDS = (0.5, 0.6, 0.7, 0.75, 0.8, 0.85, 0.9, 0.95, 1.0)
+_WORDS = re.compile(r"[a-z]+")
+
+TEMPLATES = {
+    "Finance": ["your account was debited for a card transaction available balance updated",
+                "invoice for your subscription is attached payment due by the end of the month",
+                "your monthly statement is ready view your balance and recent transactions"],
+    "Work": ["agenda for the weekly project review meeting please add your items",
+             "release planning notes and open action items from the sprint review",
+             "reminder the deadline for the quarterly roadmap draft is friday"],
+    "Personal": ["are you free for dinner this weekend with the family",
+                 "photos from the birthday party are up have a look",
+                 "mom asked if we are coming home for the holiday"],
+    "Promotions": ["exclusive offer save on everything in the summer sale today only",
+                   "your coupon code inside free shipping on orders this week",
+                   "limited time deal new arrivals at special prices shop now"],
+    "Travel": ["your flight booking is confirmed itinerary and seat details inside",
+               "hotel reservation confirmation check in from two in the afternoon",
+               "boarding pass for your trip gate and boarding time inside"],
+}
+SLOTS = "alex priya berlin london monday tuesday march april visa amazon acme globex team north south q1 q2".split()
+
+
+def hashing_embedding(text: str, dims: int = 256) -> list:
+    """ L2 normalised hashed bag of words, a stand-in for a sentence embedding model """
+    vector = np.zeros(dims)
+    for word in _WORDS.findall(text.lower()):
+        vector[int(hashlib.md5(word.encode()).hexdigest()[:8], 16) % dims] += 1.0
+    norm = np.linalg.norm(vector)
+    return (vector / norm if norm else vector).tolist()
+
+
+def synthetic_mails(size: int, ambiguous_share: float, seed: int) -> list:
+    """ (mail_id, text, llm_label): a template of the label with a few varying words, some mails mix two labels """
+    rng = random.Random(seed)
+    labels = list(TEMPLATES)
+    mails = []
+    for n in range(size):
+        label = rng.choice(labels)
+        text = rng.choice(TEMPLATES[label]) + " " + " ".join(rng.choices(SLOTS, k=3))
+        if rng.random() < ambiguous_share:
+            other = rng.choice([name for name in labels if name != label])
+            text += " " + rng.choice(TEMPLATES[other])
+            # the LLM is not consistent on these either
+            label = rng.choice((label, other))
+        mails.append((f"mail-{n}", f"Subject: {' '.join(text.split()[:5])}\n\n{text}", label))
+    return mails
+
+
+def synthetic_collection(size: int, ambiguous_share: float, seed: int):
+    collection = chromadb.EphemeralClient().get_or_create_collection(
+        f"knn_eval_{seed}_{size}", metadata={"hnsw:space": "cosine"})
+    mails = synthetic_mails(size, ambiguous_share, seed)
+    for start in range(0, len(mails), 500):
+        chunk = mails[start:start + 500]
+        collection.add(ids=[mail_id for mail_id, _, _ in chunk],
+                       embeddings=[hashing_embedding(text) for _, text, _ in chunk],
+                       metadatas=[{"label": label, "label_source": "llm"} for _, _, label in chunk])
+    return collection
+
+
+def evaluate(collection, k: int, min_similarity: float, min_neighbours: int, limit: int = None) -> dict:
+    """ Neighbours of every LLM labelled mail once, then the vote at every threshold """
+    stored = collection.get(include=["embeddings", "metadatas"])
+    rows = [(mail_id, embedding, metadata["label"])
+            for mail_id, embedding, metadata in zip(stored["ids"], stored["embeddings"], stored["metadatas"])
+            if metadata and metadata.get("label") and metadata.get("label_source") != "knn"][:limit]
+    user_labels = [{"label_name": label} for label in {label for _, _, label in rows}]
+    classifier = KnnClassifier(None, collection=collection, k=k, min_similarity=min_similarity,
+                               min_neighbours=min_neighbours)
+
+    started = time.perf_counter()
+    neighbours = [(classifier.neighbours(query_embeddings=[list(embedding)], exclude_id=mail_id), label)
+                  for mail_id, embedding, label in rows]
+    query_ms = (time.perf_counter() - started) / max(len(rows), 1) * 1000
+
+    results = {}
+    for threshold in THRESHOLDS:
+        classifier.threshold = threshold
+        answered = agreed = 0
+        for found, label in neighbours:
+            vote = classifier.vote(found, user_labels)
+            if vote is not None:
+                answered += 1
+                agreed += vote["label"] == label
+        results[threshold] = (answered / len(rows), agreed / answered if answered else 1.0)
+    return {"mails": len(rows), "query_ms": query_ms, "results": results}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--user-id", type=int, help="evaluate this user's Chroma collection instead of a synthetic one")
+    parser.add_argument("--size", type=int, default=2000, help="synthetic mails")
+    parser.add_argument("--ambiguous", type=float, default=0.15, help="share of synthetic mails mixing two labels")
+    parser.add_argument("--limit", type=int, help="evaluate at most this many mails")
+    parser.add_argument("--k", type=int, default=config.KNN_K)
+    parser.add_argument("--min-similarity", type=float, default=config.KNN_MIN_SIMILARITY)
+    parser.add_argument("--min-neighbours", type=int, default=config.KNN_MIN_NEIGHBOURS)
+    parser.add_argument("--target", type=float, default=0.97, help="agreement rate to recommend a threshold for")
+    args = parser.parse_args()
+
+    collection = (get_chroma_collection(args.user_id) if args.user_id is not None
+                  else synthetic_collection(args.size, args.ambiguous, seed=7))
+    report = evaluate(collection, args.k, args.min_similarity, args.min_neighbours, args.limit)
+
+    print(f"{report['mails']} labelled mails, k={args.k}, min similarity {args.min_similarity}, "
+          f"{report['query_ms']:.2f} ms per neighbour query")
+    print(f"{'threshold':>9} {'llm calls saved':>16} {'agreement':>10}")
+    recommended = None
+    for threshold, (reduction, agreement) in report["results"].items():
+        print(f"{threshold:>9.2f} {reduction:>16.1%} {agreement:>10.1%}")
+        if recommended is None and agreement >= args.target:
+            recommended = threshold
+    print(f"lowest threshold with agreement >= {args.target:.0%}:", recommended)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,419 @@
+""" Local fake of the Gmail API for benchmarks and load tests
+
+Serves a synthetic mailbox of configurable size over the same REST paths as
+gmail.googleapis.com: history.list, messages.list, messages.get (minimal /
+metadata / full / raw), messages.attachments.get, messages.modify,
+drafts.create, watch, stop, the /batch endpoint and an OAuth /token
+endpoint. Latency, errors and per user quota (utils/rate_limit.METHOD_COSTS)
+can be injected.
+
+Point the app at it with
+
+    GMAIL_API_URL=http://localhost:8100 GOOGLE_TOKEN_URL=http://localhost:8100/token
+
+    python -m benchmarks.fake_gmail --size 10000 --latency 0.02 --error-rate 0.01 --quota 250
+
+Extra endpoints: POST /_fake/deliver?count=n adds new mail (and history),
+GET /_fake/stats returns request counters.
+"""
+import argparse
+import asyncio
+import base64
+import email.parser
+import email.policy
+import json
+import random
+import time
+import uuid
+from collections import defaultdict
+from email.message import EmailMessage
+from functools import lru_cache
+from urllib.parse import urlsplit, parse_qs
+
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, Response
+
+from utils.rate_limit import METHOD_COSTS
+
+HISTORY_BASE = 1000
+ID_BASE = 0x18c0000000000000         # mail ids look like Gmail's 16 hex digits
+SENDERS = {
+    "personal": ["Priya Sharma <priya.sharma@example.com>", "Tom Becker <tom@example.org>"],
+    "work": ["Jira <jira@company.example>", "Anna Lee <anna.lee@company.example>"],
+    "newsletter": ["The Weekly Digest <news@digest.example>", "Deals Daily <offers@shop.example>"],
+    "finance": ["Billing <billing@utility.example>", "HDFC Bank <alerts@bank.example>"],
+    "event": ["Google Calendar <calendar-notification@google.com>", "Meetup <info@meetup.example>"],
+}
+SUBJECTS = {
+    "personal": ["Dinner on {day}?", "Photos from the trip", "Happy birthday!"],
+    "work": ["[PROJ-{n}] Status update", "Review request: release {n}", "Re: quarterly planning"],
+    "newsletter": ["This week: {n} stories you missed", "{n}% off everything until {day}"],
+    "finance": ["Invoice #{n} for {amount}", "Payment received: {amount}", "Your statement is ready"],
+    "event": ["Invitation: Sync on {day} 10:00", "Reminder: Workshop #{n} on {day}"],
+}
+WORDS = ("the quick update about project budget meeting schedule please review attached "
+         "document let me know thanks regards team next week deadline payment account").split()
+DAYS = ["Monday", "Tuesday", "Wednesday", "Thursday", "Friday", "12 March", "3 April"]
+
+
+def b64url(data: bytes) -> str:
+    return base64.urlsafe_b64encode(data).decode()
+
+
+class FakeMailbox:
+    """ Synthetic mailbox, message n is generated from the seed on demand """
+
+    def __init__(self, size: int = 1000, seed: int = 7, email_address: str = "fake@example.com"):
+        self.size = size
+        self.seed = seed
+        self.email_address = email_address
+        self.labels = {}        # mail index -> label ids changed by modify
+        self.drafts = []
+        self.message = lru_cache(maxsize=4096)(self._message)
+
+    @property
+    def history_id(self) -> int:
+        return HISTORY_BASE + self.size
+
+    def deliver(self, count: int) -> int:
+        self.size += count
+        return self.history_id
+
+    def index(self, mail_id: str) -> int:
+        try:
+            index = int(mail_id, 16) - ID_BASE
+        except ValueError:
+            return None
+        return index if 0 <= index < self.size else None
+
+    def mail_id(self, index: int) -> str:
+        return f"{ID_BASE + index:016x}"
+
+    def label_ids(self, index: int, kind: str) -> list:
+        if index in self.labels:
+            return self.labels[index]
+        category = {"newsletter": "CATEGORY_PROMOTIONS", "event": "CATEGORY_UPDATES"}.get(kind, "CATEGORY_PERSONAL")
+        return ["INBOX", "UNREAD", category]
+
+    def _message(self, index: int) -> tuple[str, EmailMessage]:
+        rng = random.Random(self.seed * 1_000_003 + index)
+        kind = rng.choice(list(SENDERS))
+        fields = {"n": rng.randint(100, 9999), "day": rng.choice(DAYS), "amount": f"${rng.randint(5, 5000)}.{rng.randint(0, 99):02d}"}
+
+        paragraphs = [" ".join(rng.choice(WORDS) for _ in range(rng.randint(12, 60))).capitalize() + "."
+                      for _ in range(rng.randint(1, 6))]
+        if kind == "finance":
+            paragraphs.insert(0, f"Amount due: {fields['amount']}, payable by {fields['day']}.")
+        if kind == "event":
+            paragraphs.insert(0, f"When: {fields['day']} 10:00 - 11:00. Where: https://meet.example/{fields['n']}")
+        if rng.random() < 0.3:
+            paragraphs.append(f"On {fields['day']}, someone wrote:\n" + "\n".join("> " + line for line in paragraphs[:2]))
+        if kind in ("personal", "work"):
+            paragraphs.append("--\nBest regards,\nSender\n+1 555 0100")
+        plain = "\n\n".join(paragraphs)
+
+        message = EmailMessage()
+        message["From"] = rng.choice(SENDERS[kind])
+        message["To"] = self.email_address
+        message["Subject"] = rng.choice(SUBJECTS[kind]).format(**fields)
+        message["Date"] = time.strftime("%a, %d %b %Y %H:%M:%S +0000", time.gmtime(1_700_000_000 + index * 60))
+        message["Message-ID"] = f"<{index}.{self.seed}@fake.example>"
+        if kind == "newsletter":
+            message["List-Unsubscribe"] = "<https://digest.example/unsubscribe>"
+            message["List-Id"] = "digest.example"
+            message["Precedence"] = "bulk"
+        message.set_content(plain)
+        message.add_alternative("".join(f"<p>{p}</p>" for p in paragraphs).replace("\n", "<br>"), subtype="html")
+        if kind == "finance" and rng.random() < 0.5:
+            message.add_attachment(self.attachment_data(index), maintype="application", subtype="pdf", filename=f"invoice-{fields['n']}.pdf")
+        return kind, message
+
+    def attachment_data(self, index: int) -> bytes:
+        """ A small PDF, one of 5 so identical invoices show up again and again """
+        amount = f"${100 + index % 5 * 25}.00"
+        content = f"BT /F1 12 Tf 72 720 Td (Invoice {index % 5} total {amount}) Tj ET"
+        return (f"%PDF-1.4\n1 0 obj << /Length {len(content)} >>\nstream\n{content}\nendstream\nendobj\n"
+                + "%" + "0123456789abcdef" * 512 + "\n%%EOF\n").encode()
+
+    def payload(self, part: EmailMessage, mail_id: str, part_id: str = "") -> dict:
+        """ Gmail's representation of a MIME part """
+        payload = {
+            "partId": part_id,
+            "mimeType": part.get_content_type(),
+            "filename": part.get_filename() or "",
+            "headers": [{"name": name, "value": str(value)} for name, value in part.items()],
+        }
+        if part.is_multipart():
+            payload["body"] = {"size": 0}
+            payload["parts"] = [self.payload(child, mail_id, f"{part_id}.{i}" if part_id else str(i))
+                                for i, child in enumerate(part.iter_parts())]
+        else:
+            data = part.get_payload(decode=True) or b""
+            if part.get_filename():
+                payload["body"] = {"attachmentId": f"att-{mail_id}-{part_id}", "size": len(data)}
+            else:
+                payload["body"] = {"size": len(data), "data": b64url(data)}
+        return payload
+
+    def resource(self, index: int, format: str = "full", metadata_headers: list = None) -> dict:
+        kind, message = self.message(index)
+        mail_id = self.mail_id(index)
+        raw = message.as_bytes()
+        resource = {
+            "id": mail_id,
+            "threadId": mail_id,
+            "labelIds": self.label_ids(index, kind),
+            "snippet": message.get_body(("plain",)).get_content()[:100],
+            "historyId": str(HISTORY_BASE + index + 1),
+            "internalDate": str((1_700_000_000 + index * 60) * 1000),
+            "sizeEstimate": len(raw),
+        }
+        if format == "raw":
+            resource["raw"] = b64url(raw)
+        elif format == "metadata":
+            wanted = {name.lower() for name in metadata_headers or []}
+            resource["payload"] = {
+                "mimeType": message.get_content_type(),
+                "headers": [{"name": name, "value": str(value)} for name, value in message.items()
+                            if not wanted or name.lower() in wanted],
+            }
+        elif format == "full":
+            resource["payload"] = self.payload(message, mail_id)
+        return resource
+
+
+class FakeGmail:
+    """ Request handling shared by the REST routes and the batch endpoint """
+
+    def __init__(self, mailbox: FakeMailbox, latency: float = 0.0, jitter: float = 0.0, error_rate: float = 0.0,
+                 error_status: int = 503, quota: float = None, seed: int = 7):
+        self.mailbox = mailbox
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.quota = quota                  # units per user per second, None for unlimited
+        self.rng = random.Random(seed)
+        self.stats = defaultdict(int)
+        self._buckets = {}                  # token -> (units left, last update)
+
+    async def delay(self):
+        if self.latency or self.jitter:
+            await asyncio.sleep(self.latency + self.rng.uniform(0, self.jitter))
+
+    def quota_method(self, method: str, path: list) -> str:
+        if path == ["history"]:
+            return "history.list"
+        if path == ["messages"]:
+            return "messages.list"
+        if path[:1] == ["messages"] and len(path) == 2:
+            return "messages.get"
+        if path[:1] == ["messages"] and path[2:3] == ["modify"]:
+            return "messages.modify"
+        if path[:1] == ["messages"] and path[2:3] == ["attachments"]:
+            return "messages.attachments.get"
+        return {"drafts": "drafts.create", "watch": "watch", "stop": "stop"}.get(path[0] if path else "", "unknown")
+
+    def charge(self, token: str, units: int) -> bool:
+        """ Spend units of the token's quota, False when over it. Like Gmail a moving average: bursts up to one second of quota """
+        if self.quota is None:
+            return True
+        now = time.monotonic()
+        tokens, updated = self._buckets.get(token, (self.quota, now))
+        tokens = min(self.quota, tokens + (now - updated) * self.quota)
+        if tokens < units:
+            self._buckets[token] = (tokens, now)
+            return False
+        self._buckets[token] = (tokens - units, now)
+        return True
+
+    def handle(self, method: str, path: str, params: dict, body: dict, token: str):
+        """ Answer one Gmail call, path is relative to /gmail/v1/users/me. Returns (status, content, headers) """
+        parts = [part for part in path.strip("/").split("/") if part]
+        name = self.quota_method(method, parts)
+        self.stats["calls"] += 1
+        self.stats[name] += 1
+
+        if not token:
+            return 401, {"error": {"code": 401, "message": "Request had invalid authentication credentials."}}, {}
+        if not self.charge(token, METHOD_COSTS.get(name, 5)):
+            self.stats["rate_limited"] += 1
+            return 429, {"error": {"code": 429, "message": "User-rate limit exceeded",
+                                   "errors": [{"reason": "userRateLimitExceeded"}]}}, {"Retry-After": "1"}
+        if self.error_rate and self.rng.random() < self.error_rate:
+            self.stats["injected_errors"] += 1
+            return self.error_status, {"error": {"code": self.error_status, "message": "Injected error",
+                                                 "errors": [{"reason": "backendError"}]}}, {}
+        self.stats["units"] += METHOD_COSTS.get(name, 5)
+
+        first = lambda key, default=None: params.get(key, [default])[0]
+        mailbox = self.mailbox
+        if name == "history.list":
+            start = int(first("startHistoryId", 0))
+            if "messageAdded" not in params.get("historyTypes", ["messageAdded"]):
+                return 200, {"historyId": str(mailbox.history_id)}, {}
+            offset = int(first("pageToken", 0))
+            limit = min(int(first("maxResults", 100)), 500)
+            begin = max(start - HISTORY_BASE, 0) + offset
+            end = min(begin + limit, mailbox.size)
+            records = []
+            for index in range(begin, end):
+                kind, _ = mailbox.message(index)
+                labels = mailbox.label_ids(index, kind)
+                if first("labelId") and first("labelId") not in labels:
+                    continue
+                ref = {"id": mailbox.mail_id(index), "threadId": mailbox.mail_id(index), "labelIds": labels}
+                records.append({"id": str(HISTORY_BASE + index + 1), "messages": [ref], "messagesAdded": [{"message": ref}]})
+            response = {"historyId": str(mailbox.history_id)}
+            if records:
+                response["history"] = records
+            if end < mailbox.size:
+                response["nextPageToken"] = str(offset + limit)
+            return 200, response, {}
+
+        if name == "messages.list":
+            offset = int(first("pageToken", 0))
+            limit = min(int(first("maxResults", 100)), 500)
+            # newest first, like Gmail
+            indexes = range(mailbox.size - 1 - offset, max(mailbox.size - 1 - offset - limit, -1), -1)
+            response = {"messages": [{"id": mailbox.mail_id(i), "threadId": mailbox.mail_id(i)} for i in indexes],
+                        "resultSizeEstimate": mailbox.size}
+            if offset + limit < mailbox.size:
+                response["nextPageToken"] = str(offset + limit)
+            return 200, response, {}
+
+        if name in ("messages.get", "messages.modify", "messages.attachments.get"):
+            index = mailbox.index(parts[1])
+            if index is None:
+                return 404, {"error": {"code": 404, "message": "Requested entity was not found.",
+                                       "errors": [{"reason": "notFound"}]}}, {}
+            if name == "messages.get":
+                format = first("format", "full")
+                self.stats[f"format_{format}"] += 1
+                return 200, mailbox.resource(index, format, params.get("metadataHeaders")), {}
+            if name == "messages.modify":
+                kind, _ = mailbox.message(index)
+                labels = [label for label in mailbox.label_ids(index, kind) if label not in (body or {}).get("removeLabelIds", [])]
+                labels += [label for label in (body or {}).get("addLabelIds", []) if label not in labels]
+                mailbox.labels[index] = labels
+                return 200, mailbox.resource(index, "minimal"), {}
+            data = mailbox.attachment_data(index)
+            return 200, {"attachmentId": parts[3], "size": len(data), "data": b64url(data)}, {}
+
+        if name == "drafts.create":
+            draft_id = f"r{len(mailbox.drafts) + 1}"
+            mailbox.drafts.append((draft_id, body))
+            return 200, {"id": draft_id, "message": {"id": uuid.uuid4().hex[:16], "labelIds": ["DRAFT"]}}, {}
+        if name == "watch":
+            return 200, {"historyId": str(mailbox.history_id), "expiration": str(int(time.time() * 1000) + 7 * 86400000)}, {}
+        if name == "stop":
+            return 204, None, {}
+        return 404, {"error": {"code": 404, "message": f"Unknown method {method} {path}"}}, {}
+
+    def handle_batch(self, content_type: str, body: bytes, token: str) -> tuple[str, bytes]:
+        """ Answer a multipart/mixed batch, every part is dispatched to handle() """
+        boundary = "batch_" + uuid.uuid4().hex
+        request = email.parser.BytesParser(policy=email.policy.HTTP).parsebytes(
+            f"Content-Type: {content_type}\r\n\r\n".encode() + body
+        )
+        answers = []
+        for part in request.iter_parts():
+            inner = part.get_payload()
+            head, _, inner_body = inner.replace("\r\n", "\n").partition("\n\n")
+            request_line, *header_lines = head.split("\n")
+            method, url, _ = request_line.split(" ", 2)
+            headers = dict(line.split(": ", 1) for line in header_lines if ": " in line)
+            part_token = (headers.get("authorization") or headers.get("Authorization") or f"Bearer {token}").split(" ", 1)[-1]
+            split = urlsplit(url)
+            path = split.path.split("/gmail/v1/users/me", 1)[-1]
+            code, content, extra = self.handle(method, path, parse_qs(split.query), json.loads(inner_body) if inner_body.strip() else None, part_token)
+            self.stats["batched"] += 1
+            response_headers = "".join(f"{key}: {value}\r\n" for key, value in extra.items())
+            answers.append(
+                f"--{boundary}\r\nContent-Type: application/http\r\nContent-ID: <response-{part['Content-ID'].strip('<>')}>\r\n\r\n"
+                f"HTTP/1.1 {code} {'OK' if code < 400 else 'Error'}\r\nContent-Type: application/json; charset=UTF-8\r\n{response_headers}\r\n"
+                f"{json.dumps(content) if content is not None else ''}\r\n"
+            )
+        return f"multipart/mixed; boundary={boundary}", ("".join(answers) + f"--{boundary}--\r\n").encode()
+
+
+def create_app(fake: FakeGmail) -> FastAPI:
+    app = FastAPI(title="Fake Gmail API")
+    app.state.fake = fake
+
+    def bearer(request: Request) -> str:
+        return request.headers.get("authorization", "").removeprefix("Bearer ").strip()
+
+    @app.api_route("/gmail/v1/users/me/{path:path}", methods=["GET", "POST"])
+    async def gmail(path: str, request: Request):
+        await fake.delay()
+        fake.stats["requests"] += 1
+        body = await request.body()
+        params = defaultdict(list)
+        for key, value in request.query_params.multi_items():
+            params[key].append(value)
+        code, content, headers = fake.handle(request.method, path, params, json.loads(body) if body else None, bearer(request))
+        if content is None:
+            return Response(status_code=code, headers=headers)
+        return JSONResponse(status_code=code, content=content, headers=headers)
+
+    @app.post("/batch")
+    @app.post("/batch/gmail/v1")
+    async def batch(request: Request):
+        await fake.delay()
+        fake.stats["requests"] += 1
+        content_type, body = fake.handle_batch(request.headers["content-type"], await request.body(), bearer(request))
+        return Response(content=body, media_type=content_type)
+
+    @app.post("/token")
+    async def token():
+        """ OAuth refresh endpoint, every refresh hands out a new token """
+        fake.stats["token_refreshes"] += 1
+        return {"access_token": f"fake-{uuid.uuid4().hex}", "expires_in": 3600, "token_type": "Bearer"}
+
+    @app.post("/_fake/deliver")
+    async def deliver(count: int = 1):
+        """ Add count new mails, historyId of the notification Gmail would push is returned """
+        start = fake.mailbox.history_id
+        return {"emailAddress": fake.mailbox.email_address, "startHistoryId": start, "historyId": fake.mailbox.deliver(count)}
+
+    @app.get("/_fake/stats")
+    async def stats():
+        return {"mailbox_size": fake.mailbox.size, "history_id": fake.mailbox.history_id, **fake.stats}
+
+    return app
+
+
+def serve_in_thread(app: FastAPI, port: int = 0):
+    """ Run a fake server app in a background thread (for blocking clients), returns (server, base_url) """
+    import socket
+    import threading
+    import uvicorn
+
+    sock = socket.socket()
+    sock.bind(("127.0.0.1", port))
+    server = uvicorn.Server(uvicorn.Config(app, log_level="warning"))
+    threading.Thread(target=server.run, kwargs={"sockets": [sock]}, daemon=True).start()
+    while not server.started:
+        time.sleep(0.01)
+    return server, f"http://127.0.0.1:{sock.getsockname()[1]}"
+
+
+if __name__ == "__main__":
+    import uvicorn
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--port", type=int, default=8100)
+    parser.add_argument("--size", type=int, default=1000, help="mails in the synthetic mailbox")
+    parser.add_argument("--seed", type=int, default=7)
+    parser.add_argument("--email", default="fake@example.com")
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds added to every HTTP request")
+    parser.add_argument("--jitter", type=float, default=0.0, help="extra random latency, up to this many seconds")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="share of calls answered with --error-status")
+    parser.add_argument("--error-status", type=int, default=503)
+    parser.add_argument("--quota", type=float, default=None, help="quota units per user per second")
+    args = parser.parse_args()
+
+    fake = FakeGmail(FakeMailbox(args.size, args.seed, args.email), latency=args.latency, jitter=args.jitter,
+                     error_rate=args.error_rate, error_status=args.error_status, quota=args.quota, seed=args.seed)
+    uvicorn.run(create_app(fake), host="127.0.0.1", port=args.port)
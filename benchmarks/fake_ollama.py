@@ -0,0 +1,250 @@
+""" Local fake of Ollama's /api/generate for benchmarks
+
+Latency follows the shape of a real model: prompt evaluation (prefill) costs
+--prefill-ms per prompt token before the first token is streamed, then every
+output token costs --decode-ms. Tokens are estimated as 4 characters.
+Classification prompts get a JSON answer picking one of the labels listed in
+the prompt, batched prompts (### EMAIL mail_id=...) a JSON array with one
+item per mail, requests with a `format` schema the label, finance and event
+fields it asks for, reply prompts a short reply. --trailing-tokens keeps generating after the answer,
+--malformed cuts answers off. --parallel limits requests generated at once like
+OLLAMA_NUM_PARALLEL on a single GPU. With --kv-slots the fake keeps a prompt
+cache (only the part after the longest cached prefix is evaluated) and
+unloads the model keep_alive seconds after the last request; the next one
+pays --cold-load-ms.
+
+    python -m benchmarks.fake_ollama --port 11435 --prefill-ms 0.5 --decode-ms 15
+
+then AGENT_URL=http://localhost:11435
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import re
+import time
+import zlib
+from collections import defaultdict
+
+from fastapi import FastAPI, Request
+from fastapi.responses import StreamingResponse
+
+_LABEL_NAMES = re.compile(r"""['"]label_name['"]:\s*['"]([^'"]+)['"]""")
+_BATCH_EMAIL = re.compile(r"### EMAIL mail_id=(\S+)")
+_AMOUNT = re.compile(r"\$(\d+(?:\.\d+)?)")
+_WHEN = re.compile(r"When: (.+?) (\d\d:\d\d)")
+
+
+def estimate_tokens(text: str) -> int:
+    return (len(text) + 3) // 4
+
+
+class FakeOllama:
+    """ Answers and timing of the fake model """
+
+    def __init__(self, prefill_ms: float = 0.5, decode_ms: float = 15.0, load_ms: float = 0.0,
+                 parallel: int = 0, context_length: int = 8192, batch_drop: float = 0.0, seed: int = 0,
+                 kv_slots: int = 0, cold_load_ms: float = 0.0, keep_alive: float = 300.0,
+                 trailing_tokens: int = 0, malformed: float = 0.0):
+        self.prefill = prefill_ms / 1000
+        self.decode = decode_ms / 1000
+        self.load = load_ms / 1000
+        # prompt cache: the last kv_slots prompts stay evaluated, a new prompt only pays for what follows
+        # its longest common prefix with one of them. 0 = every prompt is evaluated in full
+        self.kv_slots = kv_slots
+        self._kv = []
+        # the model is unloaded keep_alive seconds after its last request (or when num_ctx changes)
+        self.cold_load = cold_load_ms / 1000
+        self.keep_alive = keep_alive
+        self._loaded_until = 0.0
+        self._num_ctx = None
+        # like OLLAMA_NUM_PARALLEL: requests beyond it wait for a slot, 0 = unlimited
+        self._slots = asyncio.Semaphore(parallel) if parallel else None
+        self.context_length = context_length
+        self.batch_drop = batch_drop            # share of batch items left out of the answer
+        # whitespace generated after the answer until the model ends the sequence
+        self.trailing_tokens = trailing_tokens
+        self.malformed = malformed              # share of answers cut off half way
+        self._random = random.Random(seed)
+        self.stats = defaultdict(float)
+
+    def pick(self, text: str, labels: list) -> str:
+        # stable pick, same for a mail alone or in a batch: a label named in the mail, otherwise a hash of the subject
+        lowered = text.lower()
+        named = [label for label in labels if label.lower() in lowered]
+        subject = text.split("SUBJECT:", 1)[-1].strip().split("\n", 1)[0]
+        return named[0] if named else labels[zlib.crc32(subject.encode()) % len(labels)]
+
+    def structured(self, prompt: str, schema: dict) -> str:
+        """ Answer to a request with a `format` schema: label, finance and / or event, as far as the schema asks """
+        properties = schema.get("properties") or {}
+        text = "SUBJECT:" + prompt.split("SUBJECT:", 1)[-1]
+        subject = text[len("SUBJECT:"):].strip().split("\n", 1)[0]
+        answer = {}
+        if "label" in properties:
+            labels = properties["label"].get("enum") or _LABEL_NAMES.findall(prompt) or ["Personal"]
+            label = self.pick(text, labels)
+            answer.update({"label": label, "confidence": 0.8, "reason": f"The mail reads like {label.lower()} mail."})
+        if "finance" in properties:
+            amount = _AMOUNT.search(text)
+            answer["finance"] = None if amount is None else {
+                "kind": "expense", "type": "service", "name": subject, "qty": 1, "price": float(amount.group(1)),
+                "gst": 0.0, "total": float(amount.group(1))}
+        if "event" in properties:
+            when = _WHEN.search(text)
+            answer["event"] = None if when is None else {
+                "event_title": subject, "event_date": "", "event_time": when.group(2), "usability": 0.7, "urgency": False}
+        return json.dumps(answer)
+
+    def answer(self, prompt: str, schema: dict = None) -> str:
+        if isinstance(schema, dict) and schema.get("type") == "object":
+            return self.structured(prompt, schema)
+        if "email reply" in prompt:
+            return ("Hello,\n\nThank you for your message. I have gone through the details and will get back to you "
+                    "with a complete answer by the end of the week. Please let me know if anything changes "
+                    "in the meantime.\n\nBest regards")
+        labels = _LABEL_NAMES.findall(prompt) or ["Personal"]
+        emails = _BATCH_EMAIL.split(prompt)
+        if len(emails) > 1:
+            # batched prompt: [header, mail_id, text, mail_id, text, ...]
+            items = [{"mail_id": mail_id, "label": self.pick(text, labels), "confidence": 0.8, "reason": "Reads like it."}
+                     for mail_id, text in zip(emails[1::2], emails[2::2]) if self._random.random() >= self.batch_drop]
+            return json.dumps(items)
+        label = self.pick("SUBJECT:" + prompt.split("SUBJECT:", 1)[-1], labels)
+        return json.dumps({"label": label, "confidence": 0.8, "reason": f"The mail reads like {label.lower()} mail."})
+
+    def tokens(self, text: str):
+        """ The answer in ~4 character tokens """
+        return [text[i:i + 4] for i in range(0, len(text), 4)]
+
+    async def generate(self, body: dict):
+        if self._slots is None:
+            async for chunk in self._generate(body):
+                yield chunk
+            return
+        async with self._slots:
+            async for chunk in self._generate(body):
+                yield chunk
+
+    def _keep_alive(self, value) -> float:
+        """ Seconds of Ollama's keep_alive ("30m", "10s", 300, -1 = forever) """
+        if value is None or value == "":
+            return self.keep_alive
+        if isinstance(value, str) and value[-1:] in ("s", "m", "h"):
+            seconds = float(value[:-1]) * {"s": 1, "m": 60, "h": 3600}[value[-1]]
+        else:
+            seconds = float(value)
+        return float("inf") if seconds < 0 else seconds
+
+    def _cached_tokens(self, prompt: str) -> int:
+        """ Tokens of the prompt already in a KV slot, the prompt takes over the best slot """
+        if not self.kv_slots:
+            return 0
+        best = max(self._kv, key=lambda cached: len(os.path.commonprefix([cached, prompt])), default=None)
+        cached = len(os.path.commonprefix([best, prompt])) // 4 if best is not None else 0
+        if best is not None and cached:
+            self._kv.remove(best)
+        self._kv = (self._kv + [prompt])[-self.kv_slots:]
+        return cached
+
+    async def _generate(self, body: dict):
+        started = time.perf_counter()
+        # system first, as the model's template renders it
+        prompt = (body.get("system") or "") + body.get("prompt", "")
+        prompt_tokens = estimate_tokens(prompt)
+        answer = self.answer(prompt, body.get("format"))
+        if self._random.random() < self.malformed:
+            answer = answer[:len(answer) // 2]
+        output = self.tokens(answer) + ["\n"] * self.trailing_tokens
+        options = body.get("options") or {}
+        num_predict = options.get("num_predict")
+        if num_predict and num_predict > 0:
+            output = output[:num_predict]
+
+        load = self.load
+        if time.monotonic() > self._loaded_until or options.get("num_ctx") != self._num_ctx:
+            load += self.cold_load
+            self._kv = []
+            self._num_ctx = options.get("num_ctx")
+            self.stats["cold_loads"] += 1
+        evaluated = prompt_tokens - self._cached_tokens(prompt)
+
+        self.stats["requests"] += 1
+        self.stats["prompt_tokens"] += prompt_tokens
+        self.stats["evaluated_prompt_tokens"] += evaluated
+        self.stats["output_tokens"] += len(output)
+        self._loaded_until = float("inf")       # busy, not unloaded while generating
+        await asyncio.sleep(load + evaluated * self.prefill)
+        prompt_eval = time.perf_counter() - started
+
+        for token in output:
+            await asyncio.sleep(self.decode)
+            # not reached once the client closed the stream
+            self.stats["streamed_tokens"] += 1
+            yield {"model": body.get("model"), "response": token, "done": False}
+        total = time.perf_counter() - started
+        self._loaded_until = time.monotonic() + self._keep_alive(body.get("keep_alive"))
+        yield {
+            "model": body.get("model"), "response": "", "done": True, "done_reason": "stop",
+            "load_duration": int(load * 1e9), "prompt_eval_count": evaluated, "eval_count": len(output),
+            "prompt_eval_duration": int(prompt_eval * 1e9), "eval_duration": int((total - prompt_eval) * 1e9),
+            "total_duration": int(total * 1e9),
+        }
+
+
+def create_app(fake: FakeOllama) -> FastAPI:
+    app = FastAPI(title="Fake Ollama")
+    app.state.fake = fake
+
+    @app.post("/api/generate")
+    async def generate(request: Request):
+        body = json.loads(await request.body())
+        if body.get("stream", True) is False:
+            response = ""
+            async for chunk in fake.generate(body):
+                response += chunk["response"]
+            return {**chunk, "response": response}
+
+        async def lines():
+            async for chunk in fake.generate(body):
+                yield json.dumps(chunk) + "\n"
+        return StreamingResponse(lines(), media_type="application/x-ndjson")
+
+    @app.post("/api/show")
+    async def show(request: Request):
+        body = json.loads(await request.body())
+        return {"model_info": {"general.architecture": "fake", "fake.context_length": fake.context_length},
+                "details": {"family": "fake"}, "model": body.get("model")}
+
+    @app.get("/api/tags")
+    async def tags():
+        return {"models": [{"name": "fake"}]}
+
+    @app.get("/_fake/stats")
+    async def stats():
+        return dict(fake.stats)
+
+    return app
+
+
+if __name__ == "__main__":
+    import uvicorn
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--port", type=int, default=11435)
+    parser.add_argument("--prefill-ms", type=float, default=0.5, help="per prompt token")
+    parser.add_argument("--decode-ms", type=float, default=15.0, help="per output token")
+    parser.add_argument("--parallel", type=int, default=0, help="requests generated at once, 0 = unlimited")
+    parser.add_argument("--context-length", type=int, default=8192)
+    parser.add_argument("--batch-drop", type=float, default=0.0, help="share of batch items missing from answers")
+    parser.add_argument("--trailing-tokens", type=int, default=0, help="tokens generated after every answer")
+    parser.add_argument("--malformed", type=float, default=0.0, help="share of answers cut off half way")
+    parser.add_argument("--kv-slots", type=int, default=0, help="prompts kept in the prompt cache, 0 = none")
+    parser.add_argument("--cold-load-ms", type=float, default=0.0, help="model load after keep_alive expired")
+    parser.add_argument("--keep-alive", type=float, default=300.0, help="default keep_alive in seconds")
+    args = parser.parse_args()
+    fake = FakeOllama(args.prefill_ms, args.decode_ms, parallel=args.parallel, context_length=args.context_length,
+                      batch_drop=args.batch_drop, kv_slots=args.kv_slots, cold_load_ms=args.cold_load_ms,
+                      keep_alive=args.keep_alive, trailing_tokens=args.trailing_tokens, malformed=args.malformed)
+    uvicorn.run(create_app(fake), host="127.0.0.1", port=args.port)
@@ -0,0 +1,108 @@
+""" Feed Pub/Sub push payloads into /mail-hook at a fixed rate
+
+Payloads come from a capture (MAIL_HOOK_CAPTURE_PATH, one push body per
+line) or are synthesised: with --fake-gmail every notification first
+delivers new mail to the fake server (benchmarks/fake_gmail.py) so the
+history the app scans really holds --mails mails. The mailbox addresses must
+belong to users of the app with Google credentials.
+
+    python -m benchmarks.replay_hook --payloads captured.jsonl --rate 50
+    python -m benchmarks.replay_hook --synthetic 500 --email fake@example.com --fake-gmail http://localhost:8100 --rate 20
+"""
+import argparse
+import asyncio
+import base64
+import json
+import statistics
+import time
+from collections import Counter
+
+import httpx
+
+
+def push_body(email: str, history_id: int) -> dict:
+    """ Pub/Sub push body of a Gmail notification """
+    data = base64.b64encode(json.dumps({"emailAddress": email, "historyId": history_id}).encode()).decode()
+    return {"message": {"data": data, "messageId": str(history_id)}, "subscription": "projects/replay/subscriptions/replay"}
+
+
+async def synthetic_payloads(client: httpx.AsyncClient, count: int, emails: list[str], fake_gmail: str, mails: int):
+    for n in range(count):
+        email = emails[n % len(emails)]
+        if fake_gmail:
+            delivered = (await client.post(f"{fake_gmail}/_fake/deliver", params={"count": mails})).json()
+            # the app scans the history from the pushed id, so push where the new mail starts
+            yield push_body(email, delivered["startHistoryId"])
+        else:
+            yield push_body(email, 1000 + n)
+
+
+async def captured_payloads(path: str):
+    # read up front, the target may be appending to the same capture file
+    with open(path) as capture:
+        lines = capture.readlines()
+    for line in lines:
+        if line.strip():
+            yield json.loads(line)
+
+
+async def replay(target: str, payloads, rate: float, client: httpx.AsyncClient) -> dict:
+    latencies, statuses = [], Counter()
+    tasks = []
+
+    async def post(body):
+        started = time.perf_counter()
+        try:
+            response = await client.post(target, json=body)
+            statuses[response.status_code] += 1
+        except httpx.HTTPError as e:
+            statuses[type(e).__name__] += 1
+        latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    sent = 0
+    async for body in payloads:
+        # open loop: keep the schedule even when the target slows down
+        delay = started + sent / rate - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        tasks.append(asyncio.create_task(post(body)))
+        sent += 1
+    await asyncio.gather(*tasks)
+    elapsed = time.perf_counter() - started
+
+    quantiles = statistics.quantiles(latencies, n=100) if len(latencies) > 1 else latencies * 99
+    return {
+        "sent": sent,
+        "seconds": round(elapsed, 2),
+        "achieved_rate": round(sent / elapsed, 1) if elapsed else None,
+        "status": dict(statuses),
+        "p50_ms": round(quantiles[49] * 1000, 1),
+        "p99_ms": round(quantiles[98] * 1000, 1),
+    }
+
+
+async def main(args):
+    async with httpx.AsyncClient(timeout=30, limits=httpx.Limits(max_connections=args.concurrency)) as client:
+        if args.payloads:
+            payloads = captured_payloads(args.payloads)
+        else:
+            payloads = synthetic_payloads(client, args.synthetic, args.email, args.fake_gmail, args.mails)
+        print(json.dumps(await replay(args.target, payloads, args.rate, client), indent=2))
+        if args.fake_gmail:
+            print("fake gmail:", (await client.get(f"{args.fake_gmail}/_fake/stats")).json())
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--target", default="http://localhost:8000/mail-hook")
+    parser.add_argument("--payloads", help="captured push bodies, JSON lines")
+    parser.add_argument("--synthetic", type=int, default=100, help="notifications to synthesise when no capture is given")
+    parser.add_argument("--email", action="append", default=None, help="mailbox address, repeat for several users")
+    parser.add_argument("--fake-gmail", help="fake Gmail server to deliver mail to before each notification")
+    parser.add_argument("--mails", type=int, default=3, help="mails delivered per synthetic notification")
+    parser.add_argument("--rate", type=float, default=10.0, help="notifications per second")
+    parser.add_argument("--concurrency", type=int, default=100, help="max open connections to the target")
+    args = parser.parse_args()
+    args.email = args.email or ["fake@example.com"]
+    asyncio.run(main(args))
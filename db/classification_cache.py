@@ -0,0 +1,212 @@
+import asyncio
+import hashlib
+import json
+import re
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Optional
+from env_secrets import config
+
+try:
+    from redis import asyncio as aioredis
+except ImportError:
+    try:
+        import aioredis
+    except Exception:
+        aioredis = None
+
+
+"""
+Cache of classify_email results.
+
+Bank alerts, OTPs and shipping notices are the same template over and over,
+each copy used to cost a full LLM call. Results are keyed by a hash of the
+normalised subject and body, the model and a fingerprint of the user's
+labels: editing labels through /users/me/labels changes the fingerprint, old
+entries are simply never asked for again and age out. Results carrying the
+mail's own numbers (MailAgent.extract) use exact_key, which keeps digits.
+
+Two tiers: an in-process LRU in front of a persistent store selected by
+CLASSIFICATION_CACHE_URL (same scheme as MAIL_QUEUE_URL):
+    sqlite:///classification_cache.db   -> SQLiteCacheStore
+    redis://localhost:6379/1            -> RedisCacheStore
+    (empty)                             -> memory only
+"""
+
+_DIGITS = re.compile(r"\d+")
+_WHITESPACE = re.compile(r"\s+")
+
+
+def _canonical(text: str) -> str:
+    # numbers are what differs between two copies of a template (OTPs, amounts, dates, order ids)
+    return _WHITESPACE.sub(" ", _DIGITS.sub("0", (text or "").lower())).strip()
+
+
+def label_fingerprint(user_labels: list) -> str:
+    """ Order independent hash of the label names and descriptions """
+    labels = sorted((str(label.get("label_name")), str(label.get("label_description"))) for label in user_labels)
+    return hashlib.sha256(json.dumps(labels).encode()).hexdigest()[:16]
+
+
+def cache_key(subject: str, body: str, user_labels: list, model: str = "") -> str:
+    """ Key of a classification: normalised content + model + label set """
+    digest = hashlib.sha256()
+    for part in (model or "", label_fingerprint(user_labels), _canonical(subject), _canonical(body)):
+        digest.update(part.encode("utf-8", errors="ignore"))
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+
+def exact_key(subject: str, body: str, user_labels: list, model: str = "") -> str:
+    """ Key of a result that carries the mail's numbers (extracted amounts, dates): digits and case are kept """
+    digest = hashlib.sha256()
+    for part in ("exact", model or "", label_fingerprint(user_labels),
+                 _WHITESPACE.sub(" ", subject or "").strip(), _WHITESPACE.sub(" ", body or "").strip()):
+        digest.update(part.encode("utf-8", errors="ignore"))
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+
+class SQLiteCacheStore:
+    """ Persistent tier in a local SQLite file """
+
+    def __init__(self, path: str = "classification_cache.db", ttl: int = config.CLASSIFICATION_CACHE_TTL):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS classification_cache (
+                key TEXT PRIMARY KEY,
+                value TEXT NOT NULL,
+                created_at REAL NOT NULL
+            )
+            """
+        )
+
+    def _get(self, key: str) -> Optional[str]:
+        with self._lock:
+            row = self._conn.execute("SELECT value FROM classification_cache WHERE key = ? AND created_at > ?",
+                                     (key, time.time() - self.ttl)).fetchone()
+        return row[0] if row else None
+
+    def _set(self, key: str, value: str):
+        with self._lock:
+            self._conn.execute("INSERT OR REPLACE INTO classification_cache (key, value, created_at) VALUES (?, ?, ?)",
+                               (key, value, time.time()))
+
+    def _purge(self):
+        with self._lock:
+            self._conn.execute("DELETE FROM classification_cache WHERE created_at <= ?", (time.time() - self.ttl,))
+
+    async def get(self, key: str) -> Optional[str]:
+        return await asyncio.to_thread(self._get, key)
+
+    async def set(self, key: str, value: str):
+        await asyncio.to_thread(self._set, key, value)
+
+    async def purge(self):
+        """ Drop expired entries, entries of edited label sets end up here too """
+        await asyncio.to_thread(self._purge)
+
+    async def close(self):
+        self._conn.close()
+
+
+class RedisCacheStore:
+    """ Persistent tier on a Redis compatible server, entries expire after the TTL """
+
+    def __init__(self, url: str, prefix: str = "classification", ttl: int = config.CLASSIFICATION_CACHE_TTL):
+        if aioredis is None:
+            raise RuntimeError("redis not available; pip install redis")
+        self.client = aioredis.from_url(url)
+        self.prefix = prefix
+        self.ttl = ttl
+
+    async def get(self, key: str) -> Optional[str]:
+        value = await self.client.get(f"{self.prefix}:{key}")
+        return value.decode() if isinstance(value, bytes) else value
+
+    async def set(self, key: str, value: str):
+        await self.client.set(f"{self.prefix}:{key}", value, ex=self.ttl)
+
+    async def purge(self):
+        pass
+
+    async def close(self):
+        await self.client.aclose()
+
+
+class ClassificationCache:
+    """ LRU of recent results in front of the persistent store """
+
+    def __init__(self, store=None, max_entries: int = config.CLASSIFICATION_CACHE_SIZE):
+        self.store = store
+        self.max_entries = max_entries
+        self._lru = OrderedDict()
+        self.stats = {"memory_hits": 0, "store_hits": 0, "misses": 0, "saved_llm_seconds": 0.0}
+
+    def _remember(self, key: str, entry: dict):
+        self._lru[key] = entry
+        self._lru.move_to_end(key)
+        while len(self._lru) > self.max_entries:
+            self._lru.popitem(last=False)
+
+    async def get(self, key: str) -> Optional[dict]:
+        """ Cached classification of the key, None on a miss """
+        entry = self._lru.get(key)
+        if entry is not None:
+            self._lru.move_to_end(key)
+            self.stats["memory_hits"] += 1
+        elif self.store is not None and (raw := await self.store.get(key)) is not None:
+            entry = json.loads(raw)
+            self._remember(key, entry)
+            self.stats["store_hits"] += 1
+        else:
+            self.stats["misses"] += 1
+            return None
+        # what the LLM call took when the result was computed
+        self.stats["saved_llm_seconds"] += entry["seconds"]
+        return dict(entry["result"])
+
+    async def set(self, key: str, result: dict, seconds: float):
+        """ Cache a classification and the LLM seconds it cost """
+        entry = {"result": result, "seconds": round(seconds, 4)}
+        self._remember(key, entry)
+        if self.store is not None:
+            await self.store.set(key, json.dumps(entry))
+
+    def summary(self) -> dict:
+        lookups = self.stats["memory_hits"] + self.stats["store_hits"] + self.stats["misses"]
+        hits = lookups - self.stats["misses"]
+        return {**self.stats, "saved_llm_seconds": round(self.stats["saved_llm_seconds"], 2),
+                "entries_in_memory": len(self._lru), "hit_rate": round(hits / lookups, 4) if lookups else 0.0}
+
+    async def purge(self):
+        if self.store is not None:
+            await self.store.purge()
+
+    async def close(self):
+        if self.store is not None:
+            await self.store.close()
+
+
+_classification_cache = None
+
+def get_classification_cache(url: str = None) -> ClassificationCache:
+    """ Process wide cache built from CLASSIFICATION_CACHE_URL """
+    global _classification_cache
+    if _classification_cache is None:
+        url = config.CLASSIFICATION_CACHE_URL if url is None else url
+        if url.startswith("redis://") or url.startswith("rediss://"):
+            store = RedisCacheStore(url)
+        elif url:
+            store = SQLiteCacheStore(url.removeprefix("sqlite:///"))
+        else:
+            store = None
+        _classification_cache = ClassificationCache(store)
+    return _classification_cache
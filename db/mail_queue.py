@@ -0,0 +1,386 @@
+import asyncio
+import json
+import sqlite3
+import threading
+import time
+import uuid
+from dataclasses import dataclass
+from typing import Optional
+from env_secrets import config
+
+try:
+    from redis import asyncio as aioredis
+except ImportError:
+    try:
+        import aioredis
+    except Exception:
+        aioredis = None
+
+
+"""
+Durable queue of Gmail Pub/Sub notifications.
+
+The mail hook only persists the decoded {emailAddress, historyId} here and
+returns, the worker pool (utils/workers.py) drains it in the background.
+
+Backends are selected by MAIL_QUEUE_URL:
+    sqlite:///mail_queue.db      -> SQLiteMailQueue (default, works offline)
+    redis://localhost:6379/0     -> RedisMailQueue (any Redis compatible server)
+"""
+
+
+@dataclass(slots=True)
+class MailJob:
+    """ A queued notification waiting to be processed """
+    id: str
+    email: str
+    history_id: int
+    attempts: int = 0
+
+
+class SQLiteMailQueue:
+    """ Job queue persisted in a local SQLite file """
+
+    def __init__(self, path: str = "mail_queue.db", visibility_timeout: int = 300,
+                 max_attempts: int = 5, poll_interval: float = 0.5):
+        self.path = path
+        self.visibility_timeout = visibility_timeout    # seconds before a claimed job is handed out again
+        self.max_attempts = max_attempts
+        self.poll_interval = poll_interval
+        self._lock = threading.Lock()
+        self._wakeup = asyncio.Event()
+        self._held = set()      # ids of the jobs this process claimed and has not acked / nacked yet
+
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS mail_job (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                email TEXT NOT NULL,
+                history_id INTEGER NOT NULL,
+                status TEXT NOT NULL DEFAULT 'pending',
+                attempts INTEGER NOT NULL DEFAULT 0,
+                available_at REAL NOT NULL,
+                created_at REAL NOT NULL
+            )
+            """
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS ix_mail_job_status ON mail_job (status, available_at)")
+
+    def _enqueue(self, email: str, history_id: int) -> str:
+        now = time.time()
+        with self._lock:
+            cursor = self._conn.execute(
+                "INSERT INTO mail_job (email, history_id, available_at, created_at) VALUES (?, ?, ?, ?)",
+                (email, int(history_id), now, now)
+            )
+        return str(cursor.lastrowid)
+
+    def _claim(self) -> Optional[MailJob]:
+        now = time.time()
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                # pending jobs, or claimed jobs whose worker never acked (crash / timeout)
+                row = self._conn.execute(
+                    "SELECT id, email, history_id, attempts FROM mail_job "
+                    "WHERE status IN ('pending', 'processing') AND available_at <= ? "
+                    "ORDER BY id LIMIT 1",
+                    (now,)
+                ).fetchone()
+                if row:
+                    self._conn.execute(
+                        "UPDATE mail_job SET status = 'processing', available_at = ? WHERE id = ?",
+                        (now + self.visibility_timeout, row[0])
+                    )
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+        if not row:
+            return None
+        return MailJob(id=str(row[0]), email=row[1], history_id=row[2], attempts=row[3])
+
+    def _claim_for(self, email: str) -> list:
+        now = time.time()
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                rows = self._conn.execute(
+                    "SELECT id, email, history_id, attempts FROM mail_job "
+                    "WHERE email = ? AND status = 'pending' AND available_at <= ? ORDER BY id",
+                    (email, now)
+                ).fetchall()
+                self._conn.executemany(
+                    "UPDATE mail_job SET status = 'processing', available_at = ? WHERE id = ?",
+                    [(now + self.visibility_timeout, row[0]) for row in rows]
+                )
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+        return [MailJob(id=str(row[0]), email=row[1], history_id=row[2], attempts=row[3]) for row in rows]
+
+    def _extend(self, job_ids: list):
+        with self._lock:
+            self._conn.executemany(
+                "UPDATE mail_job SET available_at = ? WHERE id = ? AND status = 'processing'",
+                [(time.time() + self.visibility_timeout, int(job_id)) for job_id in job_ids]
+            )
+
+    def _ack(self, job_id: str):
+        with self._lock:
+            self._conn.execute("DELETE FROM mail_job WHERE id = ?", (int(job_id),))
+
+    def _nack(self, job_id: str, attempts: int):
+        attempts += 1
+        with self._lock:
+            if attempts >= self.max_attempts:
+                self._conn.execute("UPDATE mail_job SET status = 'failed', attempts = ? WHERE id = ?",
+                                   (attempts, int(job_id)))
+            else:
+                # simple exponential backoff before the job is visible again
+                self._conn.execute(
+                    "UPDATE mail_job SET status = 'pending', attempts = ?, available_at = ? WHERE id = ?",
+                    (attempts, time.time() + 2 ** attempts, int(job_id))
+                )
+
+    def _size(self) -> int:
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM mail_job WHERE status != 'failed'").fetchone()[0]
+
+    async def enqueue(self, email: str, history_id: int) -> str:
+        job_id = await asyncio.to_thread(self._enqueue, email, history_id)
+        self._wakeup.set()
+        return job_id
+
+    async def dequeue(self, timeout: float = 5.0) -> Optional[MailJob]:
+        """ Claim the oldest available job, waits up to timeout seconds """
+        deadline = time.monotonic() + timeout
+        while True:
+            job = await asyncio.to_thread(self._claim)
+            if job:
+                self._held.add(job.id)
+            if job or time.monotonic() >= deadline:
+                return job
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.poll_interval)
+            except asyncio.TimeoutError:
+                pass
+
+    async def claim_for(self, email: str) -> list:
+        """ Claim every other available job of the same mailbox """
+        jobs = await asyncio.to_thread(self._claim_for, email)
+        self._held.update(job.id for job in jobs)
+        return jobs
+
+    async def ack(self, job: MailJob):
+        self._held.discard(job.id)
+        await asyncio.to_thread(self._ack, job.id)
+
+    async def nack(self, job: MailJob):
+        self._held.discard(job.id)
+        await asyncio.to_thread(self._nack, job.id, job.attempts)
+
+    async def keep_alive(self):
+        """ Push the visibility timeout of every held job forward, call it well within visibility_timeout """
+        if self._held:
+            await asyncio.to_thread(self._extend, list(self._held))
+
+    async def recover(self):
+        """ Nothing to do: jobs of a crashed process come back once their visibility timeout passes
+        (live processes keep theirs with keep_alive), jobs of other processes sharing the file are left alone """
+
+    async def size(self) -> int:
+        return await asyncio.to_thread(self._size)
+
+    async def close(self):
+        self._conn.close()
+
+
+# Redis keys, <name> is the queue name:
+#   <name>:pending:<email>       jobs of one mailbox waiting to be taken
+#   <name>:ready                 mailboxes with pending jobs, taken round robin
+#   <name>:processing:<consumer> jobs claimed by one process, until acked
+#   <name>:consumers             consumer -> last heartbeat (keep_alive)
+#   <name>:delayed               nacked jobs -> time they are handed out again
+# A mailbox is pushed to ready when its pending list becomes non-empty and
+# pushed back after a take that left jobs behind, so claim_for only touches
+# the pending list of its mailbox.
+_ENQUEUE = """
+if redis.call('LPUSH', KEYS[1], ARGV[1]) == 1 then
+    redis.call('LPUSH', KEYS[2], ARGV[2])
+end
+"""
+_TAKE = """
+local raw = redis.call('LMOVE', KEYS[1], KEYS[3], 'RIGHT', 'LEFT')
+if raw and redis.call('LLEN', KEYS[1]) > 0 then
+    redis.call('LPUSH', KEYS[2], ARGV[1])
+end
+return raw
+"""
+_CLAIM_ALL = """
+local jobs = {}
+local raw = redis.call('LMOVE', KEYS[1], KEYS[2], 'RIGHT', 'LEFT')
+while raw do
+    table.insert(jobs, raw)
+    raw = redis.call('LMOVE', KEYS[1], KEYS[2], 'RIGHT', 'LEFT')
+end
+return jobs
+"""
+_PROMOTE = """
+local due = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[2], 'LIMIT', 0, 100)
+for _, raw in ipairs(due) do
+    if redis.call('ZREM', KEYS[1], raw) == 1 then
+        local email = cjson.decode(raw)['email']
+        if redis.call('LPUSH', ARGV[1] .. ':pending:' .. email, raw) == 1 then
+            redis.call('LPUSH', KEYS[2], email)
+        end
+    end
+end
+return #due
+"""
+_REQUEUE = """
+local raw = redis.call('RPOP', KEYS[1])
+if not raw then
+    return 0
+end
+local email = cjson.decode(raw)['email']
+if redis.call('LPUSH', ARGV[1] .. ':pending:' .. email, raw) == 1 then
+    redis.call('LPUSH', KEYS[2], email)
+end
+return 1
+"""
+
+
+class RedisMailQueue:
+    """ Job queue on a Redis compatible server (redis, valkey, keydb ...) """
+
+    def __init__(self, url: str, name: str = "mail_queue", max_attempts: int = 5,
+                 visibility_timeout: int = 300, reap_interval: float = 60.0):
+        if aioredis is None:
+            raise RuntimeError("redis not available; pip install redis")
+        self.client = aioredis.from_url(url)
+        self.name = name
+        self.consumer = uuid.uuid4().hex
+        self.ready_key = f"{name}:ready"
+        self.processing_key = f"{name}:processing:{self.consumer}"
+        self.consumers_key = f"{name}:consumers"
+        self.delayed_key = f"{name}:delayed"
+        self.count_key = f"{name}:count"
+        self.failed_key = f"{name}:failed"
+        self.max_attempts = max_attempts
+        self.visibility_timeout = visibility_timeout    # seconds without heartbeat before a consumer's jobs are handed out again
+        self.reap_interval = reap_interval
+        self._next_reap = 0.0
+        self._raw = {}      # job id -> raw payload, needed to remove it from the processing list
+        self._enqueue = self.client.register_script(_ENQUEUE)
+        self._take = self.client.register_script(_TAKE)
+        self._claim_all = self.client.register_script(_CLAIM_ALL)
+        self._promote = self.client.register_script(_PROMOTE)
+        self._requeue = self.client.register_script(_REQUEUE)
+
+    def _pending_key(self, email: str) -> str:
+        return f"{self.name}:pending:{email}"
+
+    async def enqueue(self, email: str, history_id: int) -> str:
+        job_id = uuid.uuid4().hex
+        payload = json.dumps({"id": job_id, "email": email, "history_id": int(history_id), "attempts": 0})
+        await self._enqueue(keys=[self._pending_key(email), self.ready_key], args=[payload, email])
+        await self.client.incr(self.count_key)
+        return job_id
+
+    async def keep_alive(self):
+        """ Heartbeat of this consumer, its jobs are handed out again once it stops for visibility_timeout """
+        await self.client.zadd(self.consumers_key, {self.consumer: time.time()})
+
+    async def dequeue(self, timeout: float = 5.0) -> Optional[MailJob]:
+        await self.keep_alive()
+        # nacked jobs whose backoff is over
+        await self._promote(keys=[self.delayed_key, self.ready_key], args=[self.name, time.time()])
+        if time.monotonic() >= self._next_reap:
+            self._next_reap = time.monotonic() + self.reap_interval
+            await self.recover()
+        deadline = time.monotonic() + timeout
+        while True:
+            popped = await self.client.brpop(self.ready_key, max(deadline - time.monotonic(), 0.01))
+            if popped is None:
+                return None
+            email = popped[1].decode() if isinstance(popped[1], bytes) else popped[1]
+            raw = await self._take(keys=[self._pending_key(email), self.ready_key, self.processing_key], args=[email])
+            # an emptied mailbox can still be listed in ready, claim_for took its jobs
+            if raw is not None:
+                job = MailJob(**json.loads(raw))
+                self._raw[job.id] = raw
+                return job
+
+    async def claim_for(self, email: str) -> list:
+        """ Claim every other pending job of the same mailbox """
+        jobs = []
+        for raw in await self._claim_all(keys=[self._pending_key(email), self.processing_key]):
+            job = MailJob(**json.loads(raw))
+            self._raw[job.id] = raw
+            jobs.append(job)
+        return jobs
+
+    async def ack(self, job: MailJob):
+        raw = self._raw.pop(job.id, None)
+        if raw is not None and await self.client.lrem(self.processing_key, 1, raw):
+            await self.client.decr(self.count_key)
+
+    async def nack(self, job: MailJob):
+        raw = self._raw.pop(job.id, None)
+        if raw is not None:
+            await self.client.lrem(self.processing_key, 1, raw)
+        job.attempts += 1
+        payload = json.dumps({"id": job.id, "email": job.email, "history_id": job.history_id, "attempts": job.attempts})
+        if job.attempts >= self.max_attempts:
+            await self.client.lpush(self.failed_key, payload)
+            await self.client.decr(self.count_key)
+        else:
+            # same exponential backoff as the SQLite queue
+            await self.client.zadd(self.delayed_key, {payload: time.time() + 2 ** job.attempts})
+
+    async def recover(self):
+        """ Hand out again the jobs of consumers that stopped asking for work (crashed processes),
+        jobs claimed by live consumers are left alone """
+        dead = await self.client.zrangebyscore(self.consumers_key, "-inf", time.time() - self.visibility_timeout)
+        for consumer in dead:
+            consumer = consumer.decode() if isinstance(consumer, bytes) else consumer
+            if consumer == self.consumer:
+                continue
+            processing_key = f"{self.name}:processing:{consumer}"
+            while await self._requeue(keys=[processing_key, self.ready_key], args=[self.name]):
+                pass
+            await self.client.zrem(self.consumers_key, consumer)
+
+    async def _release(self):
+        """ Put the jobs this process still holds back to their mailboxes """
+        while await self._requeue(keys=[self.processing_key, self.ready_key], args=[self.name]):
+            pass
+        self._raw.clear()
+
+    async def size(self) -> int:
+        return int(await self.client.get(self.count_key) or 0)
+
+    async def close(self):
+        await self._release()
+        await self.client.zrem(self.consumers_key, self.consumer)
+        await self.client.aclose()
+
+
+_mail_queue = None
+
+def get_mail_queue(url: str = None):
+    """ Process wide queue built from MAIL_QUEUE_URL """
+    global _mail_queue
+    if _mail_queue is None:
+        url = url or config.MAIL_QUEUE_URL
+        if url.startswith("redis://") or url.startswith("rediss://"):
+            _mail_queue = RedisMailQueue(url)
+        else:
+            _mail_queue = SQLiteMailQueue(url.removeprefix("sqlite:///"))
+    return _mail_queue
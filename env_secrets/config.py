@@ -11,6 +11,8 @@ VECTOR_DB_URL = os.getenv("VECTOR_DB_URL")
 GOOGLE_CLIENT_ID = os.getenv("GOOGLE_CLIENT_ID")
 GOOGLE_CLIENT_SECRET = os.getenv("GOOGLE_CLIENT_SECRET")
 GOOGLE_REDIRECT_URI = os.getenv("GOOGLE_REDIRECT_URI")
+GOOGLE_TOKEN_URL = os.getenv("GOOGLE_TOKEN_URL", "https://oauth2.googleapis.com/token")
+GOOGLE_TOKEN_REFRESH_MARGIN = int(os.getenv("GOOGLE_TOKEN_REFRESH_MARGIN", "300"))     # seconds before expiry tokens are refreshed
 
 # JWT Secrets
 SECRET_KEY = os.getenv("SECRET_KEY")
@@ -20,4 +22,46 @@ ACCESS_TOKEN_EXPIRE_TIME = int(os.getenv("ACCESS_TOKEN_EXPIRE_TIME", "600"))
 
 # AI Service Secrets
 AGENT_MODEL = os.getenv("AGENT_MODEL")
-AGENT_URL = os.getenv("AGENT_URL")
\ No newline at end of file
+AGENT_URL = os.getenv("AGENT_URL")
+AGENT_MAX_IN_FLIGHT = int(os.getenv("AGENT_MAX_IN_FLIGHT", "8"))        # concurrent generate requests per model server
+AGENT_TIMEOUT = float(os.getenv("AGENT_TIMEOUT", "120"))                # seconds without a streamed chunk before giving up
+AGENT_CONNECT_TIMEOUT = float(os.getenv("AGENT_CONNECT_TIMEOUT", "5"))
+AGENT_KEEP_ALIVE = os.getenv("AGENT_KEEP_ALIVE", "30m")       # keep the model (and its prompt cache) loaded between bursts, empty = server default
+AGENT_COMBINED_EXTRACTION = os.getenv("AGENT_COMBINED_EXTRACTION", "true").lower() == "true"     # label, finance and event fields of a mail from one LLM request
+AGENT_ACTION_TIMEOUT = float(os.getenv("AGENT_ACTION_TIMEOUT", "90"))    # seconds each post classification action (finance, reply, event) may take
+AGENT_BATCH_SIZE = int(os.getenv("AGENT_BATCH_SIZE", "8"))              # mails classified per LLM request in backfills and bursts, 1 disables batching
+AGENT_CONTEXT_TOKENS = int(os.getenv("AGENT_CONTEXT_TOKENS", "8192"))    # num_ctx of every request, capped by the model's own context length
+AGENT_BATCH_OUTPUT_TOKENS = int(os.getenv("AGENT_BATCH_OUTPUT_TOKENS", "64"))   # answer tokens reserved per mail of a batch
+CLASSIFICATION_CACHE_URL = os.getenv("CLASSIFICATION_CACHE_URL", "sqlite:///classification_cache.db")  # sqlite:///<file>, redis://<host>:<port>/<db> or empty for memory only
+CLASSIFICATION_CACHE_SIZE = int(os.getenv("CLASSIFICATION_CACHE_SIZE", "4096"))       # results kept in the in-process LRU
+CLASSIFICATION_CACHE_TTL = int(os.getenv("CLASSIFICATION_CACHE_TTL", str(30 * 24 * 3600)))   # seconds a persisted result stays valid
+KNN_CLASSIFIER = os.getenv("KNN_CLASSIFIER", "true").lower() == "true"      # label from the nearest stored mails before asking the LLM
+KNN_K = int(os.getenv("KNN_K", "7"))
+KNN_THRESHOLD = float(os.getenv("KNN_THRESHOLD", "0.85"))             # weighted vote share needed to skip the LLM, tune with benchmarks/eval_knn_classifier.py
+KNN_MIN_SIMILARITY = float(os.getenv("KNN_MIN_SIMILARITY", "0.75"))   # cosine similarity below which a neighbour does not vote
+KNN_MIN_NEIGHBOURS = int(os.getenv("KNN_MIN_NEIGHBOURS", "3"))
+
+# Mail Queue / Workers
+MAIL_QUEUE_URL = os.getenv("MAIL_QUEUE_URL", "sqlite:///mail_queue.db")   # sqlite:///<file> or redis://<host>:<port>/<db>
+MAIL_WORKERS = int(os.getenv("MAIL_WORKERS", "4"))
+MAIL_COALESCE_WINDOW = float(os.getenv("MAIL_COALESCE_WINDOW", "0.25"))     # seconds to wait for the rest of a notification burst
+MAIL_USER_QUANTUM = int(os.getenv("MAIL_USER_QUANTUM", "1"))    # notifications a mailbox may run before yielding its worker
+MAIL_HOOK_CAPTURE_PATH = os.getenv("MAIL_HOOK_CAPTURE_PATH", "")     # append every Pub/Sub push body here (JSON lines), for benchmarks/replay_hook.py
+
+# Gmail API
+GMAIL_BATCH_SIZE = int(os.getenv("GMAIL_BATCH_SIZE", "50"))     # messages.get per batch HTTP request, max 100
+GMAIL_SERVICE_CACHE_SIZE = int(os.getenv("GMAIL_SERVICE_CACHE_SIZE", "256"))     # authorized clients kept in memory
+GMAIL_TWO_PHASE_FETCH = os.getenv("GMAIL_TWO_PHASE_FETCH", "false").lower() == "true"     # fetch headers first, full body only when needed
+GMAIL_API_URL = os.getenv("GMAIL_API_URL", "https://gmail.googleapis.com")
+GMAIL_ASYNC_CLIENT = os.getenv("GMAIL_ASYNC_CLIENT", "false").lower() == "true"     # use the asyncio client instead of googleapiclient
+GMAIL_MAX_IN_FLIGHT = int(os.getenv("GMAIL_MAX_IN_FLIGHT", "32"))     # concurrent requests of the asyncio client
+GMAIL_USER_QUOTA_PER_SECOND = float(os.getenv("GMAIL_USER_QUOTA_PER_SECOND", "250"))     # quota units, Gmail allows 15,000 per user per minute
+GMAIL_PROJECT_QUOTA_PER_SECOND = float(os.getenv("GMAIL_PROJECT_QUOTA_PER_SECOND", "20000"))     # quota units, 1,200,000 per project per minute
+GMAIL_MAX_RETRIES = int(os.getenv("GMAIL_MAX_RETRIES", "5"))     # retries of rate limited / 5xx Gmail calls
+GMAIL_BACKOFF_BASE = float(os.getenv("GMAIL_BACKOFF_BASE", "0.5"))     # seconds, doubled on every retry
+GMAIL_BACKOFF_CAP = float(os.getenv("GMAIL_BACKOFF_CAP", "32"))
+BACKFILL_CONCURRENCY = int(os.getenv("BACKFILL_CONCURRENCY", "4"))     # mails of a backfill classified at the same time
+MAIL_MAX_BODY_BYTES = int(os.getenv("MAIL_MAX_BODY_BYTES", "262144"))     # body bytes decoded per mail, the rest is dropped
+MAIL_BODY_TOKEN_BUDGET = int(os.getenv("MAIL_BODY_TOKEN_BUDGET", "512"))     # tokens of body sent to the model, 0 for no limit
+ATTACHMENT_STORE_PATH = os.getenv("ATTACHMENT_STORE_PATH", ".attachments")     # content addressed attachment blobs, empty to not download attachments
+ATTACHMENT_MAX_BYTES = int(os.getenv("ATTACHMENT_MAX_BYTES", str(10 * 1024 * 1024)))     # larger attachments are not downloaded
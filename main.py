@@ -2,6 +2,12 @@ from env_secrets import config
 from fastapi import FastAPI, HTTPException, status
 from routers import endpoints, auth, users, google_api
 from db.relational_db import Base, engine
+from utils.workers import MailWorkerPool
+from utils.credentials import credential_manager
+from utils.gmail_async import get_async_gmail
+from utils.llm_client import close_llm_clients
+from db.classification_cache import get_classification_cache
+import asyncio
 
 app = FastAPI()
 
@@ -12,4 +18,21 @@ app.include_router(endpoints.router)
 
 @app.on_event("startup")
 def startup_event():
-    Base.metadata.create_all(bind=engine)
\ No newline at end of file
+    Base.metadata.create_all(bind=engine)
+
+@app.on_event("startup")
+async def start_mail_workers():
+    app.state.mail_workers = MailWorkerPool(workers=config.MAIL_WORKERS)
+    app.state.backfills = {}        # user_id -> (BackfillRunner, task)
+    await app.state.mail_workers.start()
+    app.state.token_refresher = asyncio.create_task(credential_manager.run())
+    await get_classification_cache().purge()
+
+@app.on_event("shutdown")
+async def stop_mail_workers():
+    await app.state.mail_workers.stop()
+    await app.state.mail_workers.queue.close()
+    app.state.token_refresher.cancel()
+    await get_async_gmail().close()
+    await close_llm_clients()
+    await get_classification_cache().close()
@@ -47,6 +47,8 @@ class User(Base):
     refresh_tokens = relationship("RefreshToken", back_populates="user", cascade="all, delete-orphan")
     watch_history = relationship("WatchHistory", back_populates="user", cascade="all, delete-orphan")
     user_label = relationship("UserLabels", back_populates="user", cascade="all, delete-orphan")
+    label_rules = relationship("LabelRule", back_populates="user", cascade="all, delete-orphan")
+    backfill_jobs = relationship("BackfillJob", back_populates="user", cascade="all, delete-orphan")
 
     def to_dict(self):
         return {
@@ -174,6 +176,39 @@ class WatchHistory(Base):
         }
 
 
+class BackfillJob(Base):
+    """ Progress of a mailbox backfill, checkpointed after every page of messages.list """
+    __tablename__ = "backfill_job"
+
+    id = Column(Integer, primary_key=True, index=True)
+    status = Column(String, nullable=False, default="running")      # running, done, failed
+    page_token = Column(String, nullable=True)                      # next messages.list page, None = start / finished
+    processed = Column(Integer, nullable=False, default=0)
+    failed = Column(Integer, nullable=False, default=0)
+    estimated_total = Column(Integer, nullable=True)                # resultSizeEstimate of messages.list
+    error = Column(String, nullable=True)
+
+    user_id = Column(Integer, ForeignKey("user_table.id"), nullable=False)
+    created_at = Column(DateTime, server_default=func.now())
+    updated_at = Column(DateTime, server_default=func.now(), onupdate=func.now())
+
+    user = relationship("User", back_populates="backfill_jobs", uselist=False)
+
+    def to_dict(self):
+        return {
+            "id": self.id,
+            "status": self.status,
+            "page_token": self.page_token,
+            "processed": self.processed,
+            "failed": self.failed,
+            "estimated_total": self.estimated_total,
+            "error": self.error,
+            "user_id": self.user_id,
+            "created_at": self.created_at,
+            "updated_at": self.updated_at
+        }
+
+
 class UserLabels(Base):
     __tablename__ = "user_label"
     id = Column(Integer, primary_key=True, index=True)
@@ -197,6 +232,39 @@ class UserLabels(Base):
         }
 
 
+class LabelRule(Base):
+    """ Deterministic labelling rule, matched before the mail reaches the model (utils/rules.py) """
+    __tablename__ = "label_rule"
+
+    id = Column(Integer, primary_key=True, index=True)
+    field = Column(String, nullable=False)                  # sender_domain, sender, subject, list_id, list_unsubscribe
+    pattern = Column(String, nullable=False, default="")    # empty = the field is present
+    is_regex = Column(Boolean, default=False)               # False = case insensitive substring
+    label_name = Column(String, nullable=False)
+    priority = Column(Integer, nullable=False, default=0)   # highest matching priority wins
+    enabled = Column(Boolean, default=True)
+
+    user_id = Column(Integer, ForeignKey("user_table.id"), nullable=False)
+    created_at = Column(DateTime, server_default=func.now())
+    updated_at = Column(DateTime, server_default=func.now(), onupdate=func.now())
+
+    user = relationship("User", back_populates="label_rules", uselist=False)
+
+    def to_dict(self):
+        return {
+            "id": self.id,
+            "field": self.field,
+            "pattern": self.pattern,
+            "is_regex": self.is_regex,
+            "label_name": self.label_name,
+            "priority": self.priority,
+            "enabled": self.enabled,
+            "user_id": self.user_id,
+            "created_at": self.created_at,
+            "updated_at": self.updated_at
+        }
+
+
 class Expense(Base):
     __tablename__ = "expense"
 
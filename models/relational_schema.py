@@ -36,4 +36,18 @@ class UserLabelSchema(BaseModel):
 
     class Config:
         from_attributes = True
-        orm_mode = True
\ No newline at end of file
+        orm_mode = True
+
+
+""" Label Rules Schema """
+class LabelRuleSchema(BaseModel):
+    id: Optional[int] = None
+    field: str
+    pattern: str = ""
+    is_regex: bool = False
+    label_name: str
+    priority: int = 0
+    enabled: bool = True
+
+    class Config:
+        from_attributes = True
@@ -1,22 +1,61 @@
-from pydantic import BaseModel
-from typing import List, Optional, Dict
-from datetime import datetime
+import json
+from dataclasses import dataclass, field, fields
+from typing import NamedTuple, Optional
 
 
-class MailMetadata(BaseModel):
+class AttachmentRef(NamedTuple):
+    """ Attachment of a mail, sha256 is set once it is in the attachment store """
+    attachment_id: str
+    filename: str
+    mime_type: str
+    size: int
+    sha256: str = ""
+
+
+@dataclass(slots=True)
+class MailRecord:
+    """ One mail as it moves through the pipeline: built once by ParseUtil,
+    labelled by MailAgent, stored to Chroma (document + metadata) """
     mail_id: str
-    user_id: str
-    created_at: datetime
-    updated_at: datetime
-    sent_by: str
-    sent_to: str
-    title: str
-    header: Optional[str] = None
-    footer: Optional[str] = None
-    labels: List[str] = []
-    cc: List[str] = []
-    bcc: List[str] = []
-
-class MailDocument(BaseModel):
-    document: str
-    metadata: MailMetadata
\ No newline at end of file
+    history_id: str = ""
+    user_id: Optional[int] = None
+    document: str = ""
+    created_at: str = ""
+    updated_at: str = ""
+    stored_at: str = ""
+    sent_by: str = ""
+    sent_to: str = ""
+    subject: str = ""
+    header: str = ""
+    cc: str = ""
+    bcc: str = ""
+    list_unsubscribe: str = ""
+    list_id: str = ""
+    precedence: str = ""
+    body_fetched: bool = True
+    body_truncated: bool = False
+    label: str = ""
+    classification_reason: str = ""
+    label_source: str = ""          # llm or knn
+    attachments: list[AttachmentRef] = field(default_factory=list)
+
+    def chroma_metadata(self) -> dict:
+        """ Every field but the document, Chroma only accepts str/int/float/bool values """
+        metadata = {name: value for name in METADATA_FIELDS if (value := getattr(self, name)) is not None}
+        if self.attachments:
+            metadata["attachments"] = ";".join(f"{ref.sha256}:{ref.filename}" for ref in self.attachments)
+        return metadata
+
+    def to_json(self) -> str:
+        """ Positional JSON array, the compact form for queues """
+        return json.dumps([getattr(self, name) for name in FIELDS])
+
+    @classmethod
+    def from_json(cls, data: str) -> "MailRecord":
+        record = cls(*json.loads(data))
+        record.attachments = [AttachmentRef(*ref) for ref in record.attachments]
+        return record
+
+
+FIELDS = tuple(field.name for field in fields(MailRecord))
+METADATA_FIELDS = tuple(name for name in FIELDS if name not in ("document", "attachments"))
@@ -13,6 +13,8 @@ from urllib.parse import urlencode
 
 import json
 from seed import seed_database
+from utils.credentials import credential_manager
+from utils.service_cache import service_cache
 
 
 router = APIRouter(tags=['Authentication'])
@@ -107,6 +109,9 @@ async def auth_google(code: str, db: Session = Depends(get_db)):
         db.add(user_secret)
         db.commit()
         db.refresh(user_secret)
+        # drop tokens and clients built from the previous grant
+        credential_manager.forget(user.id)
+        service_cache.invalidate(user.id)
         print("database written", user_secret.updated_at)
 
     return JSONResponse(status_code=status.HTTP_200_OK, content={"access_token": access_token, "refresh_token": refresh_token, "token_type": "bearer"}) # [user_info.json(), access_token]
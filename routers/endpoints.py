@@ -1,46 +1,56 @@
-from fastapi import APIRouter, status, Request, Depends, HTTPException, status
-from fastapi.concurrency import run_in_threadpool
-from utils.google import Services
+from fastapi import APIRouter, status, Request, HTTPException, Response
 from utils import util
-from db.relational_db import get_db
-from sqlalchemy.orm import Session
-from models.relational_models import User, UserLabels
-from models.relational_schema import UserLabelSchema
+from db.mail_queue import get_mail_queue
+from db.classification_cache import get_classification_cache
+from utils.normalise import NORMALISE_STATS
+from agents.knn_classifier import KNN_STATS
+from agents.ai_agent import BATCH_STATS, ACTION_STATS, parse_stats
+from utils.rules import rule_stats
+from utils.llm_client import llm_stats
+from env_secrets import config
+from fastapi.concurrency import run_in_threadpool
 import json
-from agents.ai_agent import MailAgent
 router = APIRouter(tags=['Web Hooks'])
 
+
+def capture_notification(body: dict):
+    """ Append the push body to MAIL_HOOK_CAPTURE_PATH, one JSON per line """
+    with open(config.MAIL_HOOK_CAPTURE_PATH, "a") as capture:
+        capture.write(json.dumps(body) + "\n")
+
 # WebHook to get the latest mail id
 # https://mail-management.ngrok.io/mail-hook
 # ngrok http 8000 --domain=mail-management.ngrok.io
 # ngrok http --url=openly-fluent-dogfish.ngrok-free.app 8000
-@router.post("/mail-hook")
-async def get_mail(request:Request, db:Session = Depends(get_db)):
+@router.post("/mail-hook", status_code=status.HTTP_204_NO_CONTENT)
+async def get_mail(request:Request):
+    """ Acknowledge the Pub/Sub push right away, mails are processed by the worker pool (utils/workers.py) """
     body = await request.json()
+    if config.MAIL_HOOK_CAPTURE_PATH:
+        await run_in_threadpool(capture_notification, body)
     message_data = body.get("message", {}).get("data")
     
     if message_data:
-        mail_details = json.loads(util.decode_mail(message_data))
+        try:
+            mail_details = json.loads(util.decode_mail(message_data))
+        except ValueError as e:
+            # not JSON: a 400 stops the Pub/Sub redelivery, a 500 would not
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
+        if not isinstance(mail_details, dict):
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid notification")
         email = mail_details.get("emailAddress")
         history_id = mail_details.get("historyId")
+        if not email or not history_id:
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid notification")
 
-        user = await run_in_threadpool(lambda:db.query(User).filter(User.email == email).first())
-        if not user:
-            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="User not found")
-
-        services = Services(db, user.id)
-        formatted_mails = services.manage_hook(history_id=19247)
+        await get_mail_queue().enqueue(email, history_id)
+    return Response(status_code=status.HTTP_204_NO_CONTENT)
 
-        user_labels = await run_in_threadpool(lambda: db.query(UserLabels).filter(UserLabels.user_id == user.id).all())
-        for mail in formatted_mails:
-            user_labels = [UserLabelSchema.from_orm(label).model_dump() for label in user_labels]
-            agent = MailAgent(db, user.id)
-            output = await agent.run(mail, user_labels=user_labels)
-            print("Mail processed:", output)
-            break
 
-        raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY)
-        # creds = google.get_google_credentials()
-        # print("\n\nFetching message ids....")
-        # message_id = google.mail_by_id(creds, decoded.get("historyId"))
-    return {"status": "received"}
+@router.get("/mail-hook/stats")
+async def mail_hook_stats(request:Request):
+    """ Queue size, notification coalescing counters of the worker pool, body token reduction, rule engine, classification cache, knn fast path, batched classification, LLM answers and post classification actions """
+    workers = request.app.state.mail_workers
+    return {"queued": await workers.queue.size(), **workers.stats, "normalise": NORMALISE_STATS, "rules": rule_stats(),
+            "classification_cache": get_classification_cache().summary(), "knn": KNN_STATS, "batches": BATCH_STATS,
+            "parsing": parse_stats(), "llm": llm_stats(), "actions": ACTION_STATS}
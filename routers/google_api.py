@@ -1,10 +1,14 @@
-from fastapi import APIRouter, HTTPException, Depends, status
+from fastapi import APIRouter, HTTPException, Depends, status, Request
 from db.relational_db import get_db
 from auth.dependency import get_current_user
 from sqlalchemy.orm import Session
 from fastapi.responses import JSONResponse, Response
 from env_secrets import config
-from utils.google import Services
+from utils.google import Services, TRANSFER_STATS
+from utils.credentials import credential_manager
+from utils.rate_limit import quota_limiter
+from utils.backfill import BackfillRunner
+import asyncio
 
 
 router = APIRouter(tags=["Google API's"])
@@ -23,4 +27,44 @@ def stop_watch(id: int, db:Session = Depends(get_db)):
     # print("The Response is", response)
     # return response
     db.rollback()
-    return "done"
\ No newline at end of file
+    return "done"
+
+@router.get("/service/token-stats")
+def token_stats():
+    """ OAuth token refresh counters, refresh_seconds is the total time spent on the token endpoint """
+    stats = dict(credential_manager.stats)
+    stats["avg_refresh_seconds"] = stats["refresh_seconds"] / stats["refreshes"] if stats["refreshes"] else 0.0
+    return stats
+
+
+@router.get("/service/transfer-stats")
+def transfer_stats():
+    """ Bytes received from Gmail per fetch format ('metadata' / 'full') """
+    return TRANSFER_STATS
+
+
+@router.get("/service/quota-stats")
+def quota_stats():
+    """ Gmail quota units spent, seconds callers waited for the buckets and retries of rate limited calls """
+    return quota_limiter.stats
+
+
+@router.post("/service/backfill")
+async def start_backfill(request: Request, current_user:Session = Depends(get_current_user)):
+    """ Start (or resume from its checkpoint) the backfill of the user's mailbox, runs below live webhook traffic """
+    backfills = request.app.state.backfills
+    if current_user.id in backfills and not backfills[current_user.id][1].done():
+        return backfills[current_user.id][0].progress
+
+    scheduler = request.app.state.mail_workers.scheduler
+    runner = BackfillRunner(current_user.id, yield_to=lambda: scheduler.pending > 0)
+    backfills[current_user.id] = (runner, asyncio.create_task(runner.run()))
+    return JSONResponse(status_code=status.HTTP_202_ACCEPTED, content={"detail": "Backfill started"})
+
+@router.get("/service/backfill")
+async def backfill_progress(request: Request, current_user:Session = Depends(get_current_user)):
+    """ Progress, throughput and ETA of the user's backfill """
+    backfill = request.app.state.backfills.get(current_user.id)
+    if not backfill:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="No backfill running")
+    return backfill[0].progress
@@ -12,7 +12,8 @@ import utils.google as google
 
 
 from fastapi.responses import RedirectResponse
-from models.relational_models import User, Setting, UserLabels
+from models.relational_models import User, Setting, UserLabels, LabelRule
+from utils.rules import validate_rule, invalidate_user_rules, rule_stats
 from dataclasses import asdict
 
 router = APIRouter(tags=['Users'])
@@ -140,6 +141,86 @@ def update_user_labels(label_id: int, label: UserLabelSchema,
 
 
 
+""" -----------------------User Label Rules Endpoints----------------------- """
+
+def _check_rule(rule: LabelRuleSchema, label_names: set):
+    try:
+        validate_rule(rule.field, rule.pattern, rule.is_regex)
+    except ValueError as e:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=f"Invalid rule: {e}")
+    # classification only answers the user's labels, rules must not bypass that
+    if rule.label_name not in label_names:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=f"Invalid rule: {rule.label_name!r} is not one of your labels")
+
+
+def _label_names(db: Session, user_id: int) -> set:
+    return {label.label_name for label in db.query(UserLabels.label_name).filter(UserLabels.user_id == user_id).all()}
+
+
+@router.get("/users/me/rules", response_model=List[LabelRuleSchema])
+def get_label_rules(current_user: Session = Depends(get_current_user),
+                    db: Session = Depends(get_db)):
+    """ Get the rules that label mails without the model """
+    return db.query(LabelRule).filter(LabelRule.user_id == current_user.id).order_by(LabelRule.priority.desc()).all()
+
+
+@router.post("/users/me/rules", response_model=List[LabelRuleSchema])
+def add_label_rules(rules: List[LabelRuleSchema],
+                    current_user: Session = Depends(get_current_user),
+                    db: Session = Depends(get_db)):
+    """ Add rules, e.g. {"field": "sender_domain", "pattern": "mybank.com", "label_name": "Finance"} """
+    label_names = _label_names(db, current_user.id)
+    for rule in rules:
+        _check_rule(rule, label_names)
+    new_rules = [LabelRule(**rule.model_dump(exclude={"id"}), user_id=current_user.id) for rule in rules]
+    db.add_all(new_rules)
+    db.commit()
+    for rule in new_rules:
+        db.refresh(rule)
+    invalidate_user_rules(current_user.id)
+    return new_rules
+
+
+@router.put("/users/me/rules/{rule_id}", response_model=LabelRuleSchema)
+def update_label_rule(rule_id: int, rule: LabelRuleSchema,
+                      current_user: Session = Depends(get_current_user),
+                      db: Session = Depends(get_db)):
+    """ Update a rule """
+    _check_rule(rule, _label_names(db, current_user.id))
+    db_rule = db.query(LabelRule).filter(LabelRule.user_id == current_user.id).filter(LabelRule.id == rule_id).first()
+    if not db_rule:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Rule not found")
+    for key, value in rule.model_dump(exclude={"id"}).items():
+        setattr(db_rule, key, value)
+    db.commit()
+    db.refresh(db_rule)
+    invalidate_user_rules(current_user.id)
+    return db_rule
+
+
+@router.delete("/users/me/rules/{rule_id}", status_code=status.HTTP_204_NO_CONTENT)
+def delete_label_rule(rule_id: int,
+                      current_user: Session = Depends(get_current_user),
+                      db: Session = Depends(get_db)):
+    """ Delete a rule """
+    db_rule = db.query(LabelRule).filter(LabelRule.user_id == current_user.id).filter(LabelRule.id == rule_id).first()
+    if not db_rule:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Rule not found")
+    db.delete(db_rule)
+    db.commit()
+    invalidate_user_rules(current_user.id)
+    return Response(status_code=status.HTTP_204_NO_CONTENT)
+
+
+@router.get("/users/me/rules/stats")
+def label_rule_stats(current_user: Session = Depends(get_current_user),
+                     db: Session = Depends(get_db)):
+    """ Hits per rule of the user and match time per message (all users, since start) """
+    rule_ids = [row.id for row in db.query(LabelRule.id).filter(LabelRule.user_id == current_user.id).all()]
+    return rule_stats(rule_ids)
+
+
+
 """ +++++++++++++++++++++++++++++ Testing API's +++++++++++++++++++++++++++++ """
 
 @router.get("/users/credentials")
@@ -0,0 +1,173 @@
+import base64
+import hashlib
+import os
+import tempfile
+import threading
+from utils.mime import html_to_text
+from env_secrets import config
+
+try:
+    from pypdf import PdfReader
+except ImportError:
+    PdfReader = None
+
+
+"""
+Content addressed attachment store.
+
+Blobs live on disk under <root>/<sha256[:2]>/<sha256>, so an invoice or a
+logo that arrives a thousand times is stored once. Attachments are streamed
+in: the base64 "data" field of messages.attachments.get is decoded chunk by
+chunk while it is hashed and written to a temporary file, nothing holds the
+whole attachment in memory. Text is extracted only when asked for and cached
+next to the blob (<sha256>.txt).
+"""
+
+
+class AttachmentDecoder:
+    """ Incremental decoder for the body of messages.attachments.get: finds the
+    "data" field of the JSON and base64url decodes it as the bytes come in """
+
+    def __init__(self):
+        self._state = "search"      # search -> data -> done
+        self._buffer = b""
+        self._pending = b""         # base64 characters not forming a full 4 character group yet
+
+    def feed(self, chunk: bytes) -> bytes:
+        if self._state == "search":
+            self._buffer += chunk
+            start = self._buffer.find(b'"data"')
+            if start < 0:
+                self._buffer = self._buffer[-8:]
+                return b""
+            quote = self._buffer.find(b'"', start + 6)
+            if quote < 0:
+                self._buffer = self._buffer[start:]
+                return b""
+            chunk, self._buffer, self._state = self._buffer[quote + 1:], b"", "data"
+        if self._state != "data":
+            return b""
+        end = chunk.find(b'"')
+        if end >= 0:
+            chunk, self._state = chunk[:end], "done"
+        data = self._pending + chunk
+        usable = len(data) - len(data) % 4
+        self._pending = data[usable:]
+        return base64.urlsafe_b64decode(data[:usable])
+
+    def close(self) -> bytes:
+        if self._state == "search":
+            raise ValueError("No data field in the attachment response")
+        data, self._pending = self._pending, b""
+        return base64.urlsafe_b64decode(data + b"=" * (-len(data) % 4)) if data else b""
+
+
+class BlobWriter:
+    """ Temporary file that becomes a blob of the store on commit """
+
+    def __init__(self, store: "AttachmentStore"):
+        self.store = store
+        self.sha256 = hashlib.sha256()
+        self.size = 0
+        self._file = tempfile.NamedTemporaryFile(dir=store.tmp_dir, delete=False)
+
+    def write(self, data: bytes):
+        if data:
+            self.sha256.update(data)
+            self.size += len(data)
+            self._file.write(data)
+
+    def commit(self) -> str:
+        """ Move the blob to its content address, returns the sha256 hex digest """
+        self._file.close()
+        digest = self.sha256.hexdigest()
+        path = self.store.path(digest)
+        if os.path.exists(path):
+            os.unlink(self._file.name)
+            self.store.stats["deduplicated"] += 1
+        else:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            os.replace(self._file.name, path)
+            self.store.stats["stored"] += 1
+            self.store.stats["bytes_stored"] += self.size
+        return digest
+
+    def abort(self):
+        self._file.close()
+        if os.path.exists(self._file.name):
+            os.unlink(self._file.name)
+
+
+class AttachmentStore:
+    """ Blobs keyed by sha256 with lazily extracted, cached text """
+
+    def __init__(self, root: str = config.ATTACHMENT_STORE_PATH, max_text_chars: int = 65536):
+        self.root = root
+        self.tmp_dir = os.path.join(root, "tmp")
+        self.max_text_chars = max_text_chars
+        self.stats = {"stored": 0, "deduplicated": 0, "bytes_stored": 0, "extractions": 0, "text_cache_hits": 0}
+        self._locks = {}
+        self._lock = threading.Lock()
+        os.makedirs(self.tmp_dir, exist_ok=True)
+
+    def path(self, sha256: str) -> str:
+        return os.path.join(self.root, sha256[:2], sha256)
+
+    def exists(self, sha256: str) -> bool:
+        return os.path.exists(self.path(sha256))
+
+    def writer(self) -> BlobWriter:
+        return BlobWriter(self)
+
+    def put_bytes(self, data: bytes) -> str:
+        writer = self.writer()
+        writer.write(data)
+        return writer.commit()
+
+    def text(self, sha256: str, mime_type: str) -> str:
+        """ Text of the blob, extracted on first use and cached next to it """
+        cache = self.path(sha256) + ".txt"
+        if os.path.exists(cache):
+            self.stats["text_cache_hits"] += 1
+            with open(cache, encoding="utf-8") as cached:
+                return cached.read()
+
+        with self._lock:
+            lock = self._locks.setdefault(sha256, threading.Lock())
+        with lock:      # one extraction per blob, concurrent callers wait for it
+            if not os.path.exists(cache):
+                text = extract_text(self.path(sha256), mime_type)[:self.max_text_chars]
+                self.stats["extractions"] += 1
+                with open(cache + ".tmp", "w", encoding="utf-8") as out:
+                    out.write(text)
+                os.replace(cache + ".tmp", cache)
+        self._locks.pop(sha256, None)
+        with open(cache, encoding="utf-8") as cached:
+            return cached.read()
+
+
+def extract_text(path: str, mime_type: str) -> str:
+    """ Plain text of a stored attachment, empty for types without text """
+    mime_type = (mime_type or "").lower()
+    if mime_type == "application/pdf":
+        # hex strings and CID fonts need a real PDF parser, without pypdf PDFs are skipped
+        if PdfReader is None:
+            return ""
+        return "\n".join(page.extract_text() or "" for page in PdfReader(path).pages)
+    if mime_type.startswith("text/") or mime_type in ("application/json", "application/xml", "application/csv"):
+        with open(path, "rb") as blob:
+            text = blob.read().decode("utf-8", errors="ignore")
+        return html_to_text(text) if mime_type == "text/html" else text
+    return ""
+
+
+_attachment_store = None
+_attachment_store_lock = threading.Lock()
+
+def get_attachment_store():
+    """ Process wide store under ATTACHMENT_STORE_PATH, created on first use, None when attachments are not stored """
+    global _attachment_store
+    with _attachment_store_lock:
+        if _attachment_store is None and config.ATTACHMENT_STORE_PATH:
+            _attachment_store = AttachmentStore()
+    return _attachment_store
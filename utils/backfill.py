@@ -0,0 +1,148 @@
+import asyncio
+import sys
+import time
+from fastapi.concurrency import run_in_threadpool
+from db.relational_db import SessionLocal
+from models.relational_models import BackfillJob, UserLabels
+from models.relational_schema import UserLabelSchema
+from utils.google import Services
+from utils.gmail_async import get_async_gmail
+from agents.ai_agent import MailAgent
+from utils.rules import get_user_rules
+from env_secrets import config
+
+
+class BackfillRunner:
+    """ Import the existing mailbox of a user: page messages.list, fetch, classify and store
+
+    Mails stream through a bounded pipeline (fetch -> queue -> classify/store
+    workers). The messages.list page token is checkpointed in BackfillJob once
+    every mail of a page went through, so a crashed backfill resumes at the
+    page it was on. Before every mail the runner waits while `yield_to()` is
+    true, which lets live webhook traffic go first.
+    """
+
+    def __init__(self, user_id: int, concurrency: int = config.BACKFILL_CONCURRENCY, page_size: int = 100,
+                 labels: list[str] = ["INBOX"], yield_to=None):
+        self.user_id = user_id
+        self.concurrency = concurrency
+        self.page_size = page_size
+        self.labels = labels
+        self.yield_to = yield_to or (lambda: False)
+        self.started = None
+        self.processed_this_run = 0
+        self.job = None
+
+    @property
+    def progress(self) -> dict:
+        """ Checkpointed counters plus throughput and ETA of the current run """
+        if self.job is None:
+            return {"user_id": self.user_id, "status": "pending"}
+        elapsed = time.monotonic() - self.started if self.started else 0
+        rate = self.processed_this_run / elapsed if elapsed else 0.0
+        remaining = max((self.job.estimated_total or 0) - self.job.processed, 0)
+        return {
+            **{key: value for key, value in self.job.to_dict().items() if key not in ("created_at", "updated_at")},
+            "messages_per_second": round(rate, 2),
+            "eta_seconds": round(remaining / rate) if rate else None
+        }
+
+    async def run(self) -> dict:
+        db = SessionLocal()
+        try:
+            self.job = await run_in_threadpool(self._load_job, db)
+            if self.job.status == "done":
+                return self.progress
+
+            services = await run_in_threadpool(Services, db, self.user_id)
+            user_labels = await run_in_threadpool(lambda: db.query(UserLabels).filter(UserLabels.user_id == self.user_id).all())
+            user_labels = [UserLabelSchema.from_orm(label).model_dump() for label in user_labels]
+            rules = await run_in_threadpool(get_user_rules, db, self.user_id)
+            agent = MailAgent(db, self.user_id, rules=rules)
+            client = get_async_gmail()
+            self.started = time.monotonic()
+
+            while True:
+                page = await client.messages_list(
+                    await services._token(), label_ids=self.labels,
+                    page_token=self.job.page_token, max_results=self.page_size, user_id=self.user_id
+                )
+                mail_ids = [message["id"] for message in page.get("messages", [])]
+                processed, failed = await self._process_page(services, agent, user_labels, mail_ids)
+
+                self.processed_this_run += processed
+                self.job.processed += processed
+                self.job.failed += failed
+                self.job.estimated_total = max(page.get("resultSizeEstimate") or 0, self.job.processed)
+                self.job.page_token = page.get("nextPageToken")
+                if not self.job.page_token:
+                    self.job.status = "done"
+                await run_in_threadpool(db.commit)      # checkpoint
+                print("Backfill progress:", self.progress)
+                if self.job.status == "done":
+                    return self.progress
+        except Exception as e:
+            if self.job is not None:
+                self.job.status = "failed"
+                self.job.error = str(e)[:500]
+                await run_in_threadpool(db.commit)
+            raise
+        finally:
+            db.close()
+
+    def _load_job(self, db) -> BackfillJob:
+        """ Latest backfill of the user (a finished one is returned as it is), or a new one """
+        job = db.query(BackfillJob).filter(BackfillJob.user_id == self.user_id)\
+                .order_by(BackfillJob.id.desc()).first()
+        if job is not None and job.status == "done":
+            return job
+        if job is None:
+            job = BackfillJob(user_id=self.user_id, status="running", processed=0, failed=0)
+            db.add(job)
+        job.status = "running"
+        job.error = None
+        db.commit()
+        db.refresh(job)
+        return job
+
+    async def _process_page(self, services, agent, user_labels, mail_ids) -> tuple[int, int]:
+        queue = asyncio.Queue(maxsize=self.concurrency * 2)
+        counts = {"processed": 0, "failed": 0}
+
+        async def classify():
+            done = False
+            while not done:
+                mails = [await queue.get()]
+                # whatever else is already fetched goes into the same batched LLM request
+                while mails[-1] is not None and len(mails) < agent.batch_size and not queue.empty():
+                    mails.append(queue.get_nowait())
+                if mails[-1] is None:
+                    done = True
+                    mails.pop()
+                if not mails:
+                    continue
+                while self.yield_to():
+                    await asyncio.sleep(0.5)
+                try:
+                    await agent.run_batch(mails, user_labels=user_labels)
+                    counts["processed"] += len(mails)
+                except Exception as e:
+                    print("Backfill mails failed:", [mail.mail_id for mail in mails], str(e))
+                    counts["failed"] += len(mails)
+
+        workers = [asyncio.create_task(classify()) for _ in range(self.concurrency)]
+        errors_before = len(services.fetch_errors)
+        try:
+            async for mail in services.aiter_mails(mail_ids):
+                await queue.put(mail)
+        finally:
+            for _ in workers:
+                await queue.put(None)
+            await asyncio.gather(*workers)
+        counts["failed"] += len(services.fetch_errors) - errors_before
+        return counts["processed"], counts["failed"]
+
+
+# python -m utils.backfill <user_id>
+if __name__ == "__main__":
+    print(asyncio.run(BackfillRunner(int(sys.argv[1])).run()))
@@ -0,0 +1,97 @@
+import asyncio
+from dataclasses import dataclass, field
+from db.mail_queue import MailJob
+
+
+@dataclass(slots=True)
+class CoalescedNotification:
+    """ Pending notifications of one mailbox folded into a single history scan """
+    email: str
+    start_history_id: int      # lowest unprocessed history id, the scan starts here
+    end_history_id: int        # highest history id seen, the cursor moves here
+    jobs: list = field(default_factory=list)
+
+
+class NotificationCoalescer:
+    """ Fold queued Pub/Sub notifications of the same user into one Gmail fetch
+
+    Gmail usually sends a burst of notifications for one change set, each of
+    them would otherwise scan an overlapping history range. The first
+    notification of a mailbox opens a window of `window` seconds, others of the
+    same mailbox taken off the queue meanwhile join it, and when it closes the
+    rest is claimed from the queue and handed to on_ready. The wait is per
+    mailbox, the dispatcher goes on taking notifications of other mailboxes.
+    """
+
+    def __init__(self, queue, on_ready, window: float = 0.0, max_open: int = 64):
+        self.queue = queue
+        self.on_ready = on_ready    # async callable taking a CoalescedNotification
+        self.window = window        # seconds to wait for the rest of a burst before claiming it
+        self._open = {}             # email -> jobs taken during its window
+        self._tasks = set()
+        # open windows, including bursts waiting for on_ready: bounds what is claimed but not yet scheduled
+        self._room = asyncio.Semaphore(max_open)
+        self.stats = {
+            "notifications": 0,     # notifications taken from the queue
+            "merged": 0,            # notifications folded into another one's fetch
+            "fetches": 0,           # history scans actually issued
+            "claim_failures": 0,    # bursts nacked because the rest could not be claimed
+        }
+
+    async def add(self, job: MailJob):
+        """ Hold a dequeued job in its mailbox's window, opening one if there is none.
+        Only waits while max_open windows are open, never for the window itself """
+        if job.email in self._open:
+            self._open[job.email].append(job)
+            return
+        await self._room.acquire()
+        if job.email in self._open:
+            # opened while waiting for room
+            self._room.release()
+            self._open[job.email].append(job)
+            return
+        self._open[job.email] = [job]
+        task = asyncio.create_task(self._close(job.email))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _close(self, email: str):
+        try:
+            await self._close_window(email)
+        finally:
+            self._room.release()
+
+    async def _close_window(self, email: str):
+        if self.window:
+            await asyncio.sleep(self.window)
+        jobs = self._open.pop(email)
+        try:
+            jobs += await self.queue.claim_for(email)
+        except Exception as e:
+            # queue unavailable (database is locked, redis disconnect): back to the queue, retried later
+            print(f"{email}: claiming the notification burst failed", str(e))
+            self.stats["claim_failures"] += 1
+            for job in jobs:
+                try:
+                    await self.queue.nack(job)
+                except Exception as nack_error:
+                    print(f"{email}: nack failed, the visibility timeout returns the job", str(nack_error))
+            return
+        history_ids = [int(j.history_id) for j in jobs]
+
+        self.stats["notifications"] += len(jobs)
+        self.stats["merged"] += len(jobs) - 1
+        self.stats["fetches"] += 1
+        await self.on_ready(CoalescedNotification(
+            email=email,
+            start_history_id=min(history_ids),
+            end_history_id=max(history_ids),
+            jobs=jobs
+        ))
+
+    async def stop(self):
+        """ Cancel open windows, their jobs stay claimed until the queue's visibility timeout returns them """
+        for task in list(self._tasks):
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._open.clear()
@@ -0,0 +1,125 @@
+import asyncio
+import threading
+import time
+from collections import defaultdict
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+from typing import Optional
+from auth.handlers import GoogleAuthHandler
+from db.relational_db import SessionLocal
+from models.relational_models import UserSecret
+from env_secrets import config
+
+
+@dataclass(slots=True)
+class TokenState:
+    """ Google OAuth tokens of one user held in memory """
+    token: str
+    refresh_token: str
+    expires_at: Optional[datetime]      # naive UTC, as stored in UserSecret
+
+    def expires_within(self, seconds: int) -> bool:
+        if self.expires_at is None:
+            return False
+        return self.expires_at - datetime.utcnow() <= timedelta(seconds=seconds)
+
+
+class CredentialManager:
+    """ Hold Google access tokens in memory and refresh them before they expire
+
+    Concurrent refreshes of one user are collapsed into a single call to the
+    token endpoint (single flight): whoever gets the user lock refreshes and
+    persists, everybody waiting on it picks up the new token.
+    """
+
+    def __init__(self, refresh_margin: int = config.GOOGLE_TOKEN_REFRESH_MARGIN, token_url: str = config.GOOGLE_TOKEN_URL):
+        self.refresh_margin = refresh_margin    # seconds before expiry a token gets refreshed
+        self.auth_handler = GoogleAuthHandler(token_url=token_url)
+        self.stats = {"refreshes": 0, "refresh_failures": 0, "coalesced": 0, "refresh_seconds": 0.0}
+        self._tokens = {}                       # user_id -> TokenState
+        self._locks = defaultdict(threading.Lock)
+
+    def get(self, user_id: int, secret: UserSecret = None) -> TokenState:
+        """ Valid tokens of the user, refreshed first when close to expiry
+        Args:
+            user_id int: Owner of the tokens
+            secret UserSecret: Stored secret, used the first time the user is seen
+        """
+        state = self._tokens.get(user_id)
+        if state is None:
+            if secret is None:
+                secret = self._load(user_id)
+            # setdefault, a concurrent caller may have loaded (and refreshed) it meanwhile
+            state = self._tokens.setdefault(user_id, TokenState(secret.client_token, secret.refresh_token, secret.expires_at))
+        if state.expires_within(self.refresh_margin):
+            state = self.refresh(user_id, state.token)
+        return state
+
+    def forget(self, user_id: int):
+        """ Drop the user's tokens, eg. after re-authentication """
+        self._tokens.pop(user_id, None)
+
+    def refresh(self, user_id: int, stale_token: str) -> TokenState:
+        """ Refresh the user's token unless somebody else already replaced stale_token """
+        with self._locks[user_id]:
+            state = self._tokens[user_id]
+            if state.token != stale_token:
+                self.stats["coalesced"] += 1
+                return state
+
+            started = time.perf_counter()
+            response = self.auth_handler.get_new_token(state.refresh_token)
+            self.stats["refresh_seconds"] += time.perf_counter() - started
+            if not response or not response.get("access_token"):
+                self.stats["refresh_failures"] += 1
+                raise RuntimeError(f"Token refresh failed for user {user_id}")
+            self.stats["refreshes"] += 1
+
+            expires_in = response.get("expires_in")
+            state = TokenState(
+                token=response["access_token"],
+                refresh_token=response.get("refresh_token") or state.refresh_token,
+                expires_at=datetime.utcnow() + timedelta(seconds=expires_in) if expires_in else None
+            )
+            self._persist(user_id, state)
+            self._tokens[user_id] = state
+            return state
+
+    async def run(self, interval: int = 60):
+        """ Background task refreshing every known token that expires within the margin """
+        while True:
+            for user_id, state in list(self._tokens.items()):
+                if state.expires_within(self.refresh_margin + interval):
+                    try:
+                        await asyncio.to_thread(self.refresh, user_id, state.token)
+                    except Exception as e:
+                        print(f"Background token refresh failed for user {user_id}:", str(e))
+            await asyncio.sleep(interval)
+
+    def _load(self, user_id: int) -> UserSecret:
+        db = SessionLocal()
+        try:
+            secret = db.query(UserSecret).filter(UserSecret.user_id == user_id).first()
+            if not secret or not secret.refresh_token:
+                raise RuntimeError(f"No Google credentials for user {user_id}")
+            return secret
+        finally:
+            db.close()
+
+    def _persist(self, user_id: int, state: TokenState):
+        db = SessionLocal()
+        try:
+            secret = db.query(UserSecret).filter(UserSecret.user_id == user_id).first()
+            if secret:
+                secret.client_token = state.token
+                secret.refresh_token = state.refresh_token
+                secret.expires_at = state.expires_at
+                db.commit()
+        except Exception:
+            db.rollback()
+            raise
+        finally:
+            db.close()
+
+
+credential_manager = CredentialManager()
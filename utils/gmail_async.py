@@ -0,0 +1,155 @@
+import asyncio
+import httpx
+from utils.rate_limit import QuotaLimiter, quota_limiter, is_retryable, retry_after_seconds
+from env_secrets import config
+
+
+"""
+Asyncio Gmail REST client.
+
+One pooled httpx.AsyncClient (keep-alive connections) is shared by the
+whole process, every user's call passes its own bearer token. In-flight
+requests are bounded by a semaphore, so a burst can't open an unbounded
+number of sockets. Used by Services' async methods instead of the blocking
+discovery client.
+
+Every call pays its quota units to the shared QuotaLimiter first, rate
+limited and 5xx answers are retried with backoff before GmailAPIError is
+raised.
+"""
+
+
+class GmailAPIError(Exception):
+    """ Non 2xx answer of the Gmail API """
+
+    def __init__(self, status_code: int, detail: str, retry_after: float = None):
+        super().__init__(f"Gmail API error {status_code}: {detail}")
+        self.status_code = status_code
+        self.detail = detail
+        self.retry_after = retry_after
+
+
+class AsyncGmailClient:
+    """ Async transport for the Gmail endpoints the pipeline uses """
+
+    def __init__(self, base_url: str = config.GMAIL_API_URL, max_in_flight: int = config.GMAIL_MAX_IN_FLIGHT,
+                 timeout: float = 30.0, transport: httpx.AsyncBaseTransport = None,
+                 limiter: QuotaLimiter = quota_limiter, max_retries: int = config.GMAIL_MAX_RETRIES):
+        self.base_url = base_url.rstrip("/")
+        self._client = httpx.AsyncClient(
+            base_url=f"{self.base_url}/gmail/v1/users/me",
+            timeout=timeout,
+            limits=httpx.Limits(max_connections=max_in_flight, max_keepalive_connections=max_in_flight),
+            transport=transport
+        )
+        self._in_flight = asyncio.Semaphore(max_in_flight)
+        self.limiter = limiter
+        self.max_retries = max_retries
+
+    async def request(self, token: str, method: str, path: str, params: dict = None, json: dict = None,
+                      quota_method: str = "messages.get", user_id: int = None, sizes: list = None) -> dict:
+        """ Call the API, paying the quota of quota_method in the bucket of user_id (the token when not given).
+        The size of every response body received is appended to sizes when given """
+        for attempt in range(self.max_retries + 1):
+            await self.limiter.aacquire(token if user_id is None else user_id, quota_method)
+            async with self._in_flight:
+                response = await self._client.request(
+                    method, path, params=params, json=json,
+                    headers={"Authorization": f"Bearer {token}"}
+                )
+            if sizes is not None:
+                sizes.append(len(response.content))
+            if response.status_code < 400:
+                break
+            error = GmailAPIError(
+                response.status_code, response.text[:500],
+                retry_after=retry_after_seconds(response.headers.get("Retry-After"))
+            )
+            if attempt == self.max_retries or not is_retryable(error.status_code, error.detail):
+                raise error
+            await asyncio.sleep(self.limiter.backoff(attempt, error.retry_after, error.status_code))
+        if not response.content:
+            return {}
+        return response.json()
+
+    async def history_list(self, token: str, start_history_id: int, history_types: list[str] = None,
+                           label_id: str = None, page_token: str = None, max_results: int = 500, user_id: int = None) -> dict:
+        params = {"startHistoryId": start_history_id, "maxResults": max_results}
+        if history_types:
+            params["historyTypes"] = history_types
+        if label_id:
+            params["labelId"] = label_id
+        if page_token:
+            params["pageToken"] = page_token
+        return await self.request(token, "GET", "/history", params=params, quota_method="history.list", user_id=user_id)
+
+    async def messages_list(self, token: str, label_ids: list[str] = None, query: str = None,
+                            page_token: str = None, max_results: int = 500, user_id: int = None) -> dict:
+        params = {"maxResults": max_results}
+        if label_ids:
+            params["labelIds"] = label_ids
+        if query:
+            params["q"] = query
+        if page_token:
+            params["pageToken"] = page_token
+        return await self.request(token, "GET", "/messages", params=params, quota_method="messages.list", user_id=user_id)
+
+    async def messages_get(self, token: str, message_id: str, format: str = "full", metadata_headers: list[str] = None,
+                           user_id: int = None, sizes: list = None) -> dict:
+        params = {"format": format}
+        if metadata_headers:
+            params["metadataHeaders"] = metadata_headers
+        return await self.request(token, "GET", f"/messages/{message_id}", params=params, quota_method="messages.get",
+                                  user_id=user_id, sizes=sizes)
+
+    async def stream_attachment(self, token: str, message_id: str, attachment_id: str, user_id: int = None):
+        """ messages.attachments.get as raw response chunks, the body is never held in memory as a whole """
+        path = f"/messages/{message_id}/attachments/{attachment_id}"
+        for attempt in range(self.max_retries + 1):
+            await self.limiter.aacquire(token if user_id is None else user_id, "messages.attachments.get")
+            async with self._in_flight:
+                async with self._client.stream("GET", path, headers={"Authorization": f"Bearer {token}"}) as response:
+                    if response.status_code < 400:
+                        async for chunk in response.aiter_bytes():
+                            yield chunk
+                        return
+                    await response.aread()
+            error = GmailAPIError(
+                response.status_code, response.text[:500],
+                retry_after=retry_after_seconds(response.headers.get("Retry-After"))
+            )
+            if attempt == self.max_retries or not is_retryable(error.status_code, error.detail):
+                raise error
+            await asyncio.sleep(self.limiter.backoff(attempt, error.retry_after, error.status_code))
+
+    async def messages_modify(self, token: str, message_id: str, add_label_ids: list[str] = None, remove_label_ids: list[str] = None,
+                              user_id: int = None) -> dict:
+        body = {"addLabelIds": add_label_ids or [], "removeLabelIds": remove_label_ids or []}
+        return await self.request(token, "POST", f"/messages/{message_id}/modify", json=body, quota_method="messages.modify", user_id=user_id)
+
+    async def drafts_create(self, token: str, raw: str, thread_id: str = None, user_id: int = None) -> dict:
+        """ Create a draft from a base64url encoded RFC 2822 message """
+        message = {"raw": raw}
+        if thread_id:
+            message["threadId"] = thread_id
+        return await self.request(token, "POST", "/drafts", json={"message": message}, quota_method="drafts.create", user_id=user_id)
+
+    async def watch(self, token: str, topic_name: str, label_ids: list[str] = ["INBOX"], user_id: int = None) -> dict:
+        return await self.request(token, "POST", "/watch", json={"labelIds": label_ids, "topicName": topic_name},
+                                  quota_method="watch", user_id=user_id)
+
+    async def stop(self, token: str, user_id: int = None) -> dict:
+        return await self.request(token, "POST", "/stop", quota_method="stop", user_id=user_id)
+
+    async def close(self):
+        await self._client.aclose()
+
+
+_gmail_client = None
+
+def get_async_gmail() -> AsyncGmailClient:
+    """ Process wide client, created on first use inside the running loop """
+    global _gmail_client
+    if _gmail_client is None:
+        _gmail_client = AsyncGmailClient()
+    return _gmail_client
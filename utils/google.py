@@ -4,19 +4,48 @@ import utils.util as util
 from google.auth.transport.requests import Request
 from google.oauth2.credentials import Credentials
 from googleapiclient.discovery import build
+from googleapiclient.errors import HttpError
+from utils.service_cache import service_cache
+from utils.credentials import credential_manager
+from utils.gmail_async import get_async_gmail, GmailAPIError
+from utils.rate_limit import quota_limiter, is_retryable, retry_after_seconds
+from utils.attachments import get_attachment_store, AttachmentDecoder
+from fastapi.concurrency import run_in_threadpool
+import asyncio
+import httpx
+import time
 from models.relational_models import UserSecret, WatchHistory
+from models.vector_schema import MailRecord
 from env_secrets import config
 from fastapi import HTTPException, status
 
 from urllib.parse import urlencode
-from base64 import b64decode
+from base64 import b64decode, urlsafe_b64decode
 from typing import List
+from collections import OrderedDict
 from sqlalchemy.exc import SQLAlchemyError
 
 SCOPES = ['https://mail.google.com/']
 TOPIC_NAME = "projects/project-use-a/topics/new_mail"
-TOKEN_URL = "https://oauth2.googleapis.com/token"
-
+TOKEN_URL = config.GOOGLE_TOKEN_URL
+# Headers requested by the metadata phase of the two phase fetch
+METADATA_HEADERS = ["From", "To", "Cc", "Bcc", "Subject", "Date", "List-Unsubscribe", "List-Id", "Precedence", "X-Header"]
+# Bytes received per fetch format, process wide
+TRANSFER_STATS = {}
+
+
+def gmail_http_exception(e: Exception) -> HTTPException:
+    """ HTTPException for a failed Gmail call, rate limits and outages stay retryable (429 / 503) instead of becoming a 400 """
+    if isinstance(e, HttpError):
+        code, detail = e.resp.status, str(e.content)
+    elif isinstance(e, GmailAPIError):
+        code, detail = e.status_code, e.detail
+    else:
+        return HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
+    if is_retryable(code, detail):
+        code = status.HTTP_429_TOO_MANY_REQUESTS if code in (403, 429) else status.HTTP_503_SERVICE_UNAVAILABLE
+        return HTTPException(status_code=code, detail=str(e))
+    return HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
 
 
 class Services:
@@ -24,18 +53,20 @@ class Services:
         self.db = db
         self.user_id = user_id
         self.services = None
+        self.fetch_errors = []
+        self.transfer_stats = {}        # bytes received per fetch format
         
         # Elegibility check of the  user,
         # eligible if have token and refresh token
-        secret = db.query(UserSecret).filter(UserSecret.user_id == user_id).first()
-        if secret.client_token and secret.refresh_token:
+        self.secret = db.query(UserSecret).filter(UserSecret.user_id == user_id).first()
+        if self.secret and self.secret.client_token and self.secret.refresh_token:
             self.valid = True
         else: 
             self.valid = False
     
 
     def subscribe_service(self) -> str:
-        credentials = self.db.query(UserSecret).filter(UserSecret.user_id == self.user_id).first()
+        credentials = self.secret
         email = ""
         if credentials:
             email = credentials.user.email
@@ -54,25 +85,20 @@ class Services:
         return {"Authentication URL": url}
 
     def get_credentials(self)-> Credentials:
-        credentials = self.db.query(UserSecret).filter(UserSecret.user_id == self.user_id).first()
         try:
             # Check if credentials exist and valid
-            if credentials and self.valid:
+            if self.secret and self.valid:
+                # tokens are held and refreshed ahead of expiry by the credential manager
+                tokens = credential_manager.get(self.user_id, self.secret)
                 creds = Credentials(
-                    token=credentials.client_token,
-                    refresh_token=credentials.refresh_token,
+                    token=tokens.token,
+                    refresh_token=tokens.refresh_token,
                     token_uri=TOKEN_URL,
                     client_id=config.GOOGLE_CLIENT_ID,
-                    expiry= credentials.expires_at,
+                    expiry= tokens.expires_at,
                     client_secret=config.GOOGLE_CLIENT_SECRET,
                     scopes=SCOPES
                 )
-
-                # Stores token if refreshed
-                if credentials.client_token != creds.token:
-                    credentials.client_token = creds.token
-                    self.db.add(credentials)
-                    self.db.commit()
             
             return creds
         except Exception as e:
@@ -83,7 +109,9 @@ class Services:
     def build_service(self, service_name, version):
         if self.valid:
             try:
-                self.services = build(service_name, version, credentials=self.get_credentials())
+                # reuse the client built for the current token, rebuilt once the token is refreshed
+                tokens = credential_manager.get(self.user_id, self.secret)
+                self.services = service_cache.get(self.user_id, service_name, version, self.get_credentials, tokens.token)
                 return self.services
             except Exception as e:
                 print(3 , str(e))
@@ -98,15 +126,101 @@ class Services:
             'topicName': TOPIC_NAME,
         }
 
-        response = services.users().watch(userId='me', body=request_body).execute()
+        response = self._execute(services.users().watch(userId='me', body=request_body), 'watch')
 
         return {"service_start":"watch", **response}
 
     def stop_watch(self) -> dict:
         services = self.services or self.build_service("gmail", "v1")
-        response = services.users().stop(userId='me').execute()
+        response = self._execute(services.users().stop(userId='me'), 'stop')
         return response
+
+    def _execute(self, request, quota_method: str, count: int = 1):
+        """ Execute a discovery request (or batch) within the user's quota, rate limited and 5xx answers are retried
+        Args:
+            request: HttpRequest or BatchHttpRequest
+            quota_method str: Gmail method the quota units are charged for, see rate_limit.METHOD_COSTS
+            count int: Calls in the request, the size of a batch
+        """
+        for attempt in range(config.GMAIL_MAX_RETRIES + 1):
+            quota_limiter.acquire(self.user_id, quota_method, count)
+            try:
+                return request.execute()
+            except HttpError as e:
+                if attempt == config.GMAIL_MAX_RETRIES or not is_retryable(e.resp.status, str(e.content)):
+                    raise
+                time.sleep(quota_limiter.backoff(attempt, retry_after_seconds(e.resp.get('retry-after')), e.resp.status))
     
+    def iter_mail_ids(self, history_id: int, labels: list[str] = ["INBOX"], seen_limit: int = 10000):
+        """ Walk every page of the history from history id and yield added mail ids as they are found
+        Args:
+            history_id int: History Id sent by the pubsub to get the email ids
+            labels list[str]: Only mails added with one of these labels
+            seen_limit int: Ids remembered for de-duplication, keeps memory bounded on large gaps
+        Yields:
+            str: Mail id, once per mail
+        """
+        services = self.services or self.build_service("gmail", "v1")
+        # history.list filters on a single label, more than one is filtered here
+        label_filter = None if len(labels) == 1 else set(labels)
+        seen = OrderedDict()
+        found = False
+        page_token = None
+        try:
+            while True:
+                results = self._execute(services.users().history().list(
+                    userId='me',
+                    startHistoryId=history_id,
+                    historyTypes=['messageAdded'],
+                    labelId=labels[0] if label_filter is None else None,
+                    pageToken=page_token,
+                    maxResults=500
+                ), 'history.list')
+
+                for message_id in self._added_ids(results, seen, label_filter, seen_limit):
+                    found = True
+                    yield message_id
+
+                page_token = results.get('nextPageToken')
+                if not page_token:
+                    break
+        except HTTPException:
+            raise
+        except Exception as e:
+            print(5, str(e))
+            raise gmail_http_exception(e)
+
+        if not found:
+            self.record_idle_history(results.get('historyId'))
+
+    def _added_ids(self, results: dict, seen: OrderedDict, label_filter: set, seen_limit: int):
+        """ New mail ids of one history.list page, de-duplicated against seen """
+        for record in results.get('history', []):
+            for msg in record.get('messagesAdded', []):
+                message = msg['message']
+                message_id = message['id']
+                if message_id in seen:
+                    continue
+                if label_filter and not label_filter.intersection(message.get('labelIds', [])):
+                    continue
+                seen[message_id] = None
+                if len(seen) > seen_limit:
+                    seen.popitem(last=False)
+                yield message_id
+
+    def record_idle_history(self, new_history_id):
+        """ No new mail in the scanned history, remember the latest history id """
+        check_duplicate = self.db.query(WatchHistory).filter(WatchHistory.history_id==new_history_id).filter(WatchHistory.user_id == self.user_id).first()
+        if not check_duplicate:
+            print("No new mail found, updating history id to ", new_history_id)
+            add_history = WatchHistory(
+                history_id = new_history_id,
+                added_by = "hook",
+                user_id = self.user_id
+            )
+            self.db.add(add_history)
+            self.db.commit()
+
     def get_mail_ids(self, history_id: int) -> list:
         """ Fetch mail ids from history id
         Args:
@@ -114,65 +228,158 @@ class Services:
         Returns:
             list: List of mail ids
         """
+        return list(self.iter_mail_ids(history_id))
+    
+
+    def iter_mails(self, mail_ids, batch_size: int = config.GMAIL_BATCH_SIZE, format: str = 'full'):
+        """
+        Fetch mails with Gmail batch requests and yield them in chromadb format.
+        Every sub-response is parsed as soon as its batch comes back, a failed
+        item is recorded in self.fetch_errors instead of failing the batch.
+        Items Gmail rate limited are retried in a follow up batch.
+
+        args:
+            mail_ids (Iterable[str]): Mail ids, may be a generator
+            batch_size (int): Gets per HTTP request, Gmail allows up to 100
+            format (str): 'full', or 'metadata' for the METADATA_HEADERS only
+        """
         services = self.services or self.build_service("gmail", "v1")
+        parser = util.ParseUtil()
+        transfer = getattr(services, 'transfer', None)
+
+        for chunk in util.chunked(mail_ids, batch_size):
+            received = transfer.bytes_received if transfer else 0
+            parsed = self._fetch_batch(services, parser, list(dict.fromkeys(chunk)), format)   # request ids must be unique within a batch
+            if transfer:
+                self.transfer_stats[format] = self.transfer_stats.get(format, 0) + transfer.bytes_received - received
+                TRANSFER_STATS[format] = TRANSFER_STATS.get(format, 0) + transfer.bytes_received - received
+            for mail in parsed:
+                if mail.attachments:
+                    self.save_attachments(mail)
+                yield mail
+
+    def _fetch_batch(self, services, parser, mail_ids: list, format: str) -> list:
+        """ One batch of messages.get, parsed mails are returned """
+        extra = {'metadataHeaders': METADATA_HEADERS} if format == 'metadata' else {}
+        parsed = []
+        rate_limited = {}       # mail_id -> HttpError
+
+        def callback(request_id, response, exception):
+            if isinstance(exception, HttpError) and is_retryable(exception.resp.status, str(exception.content)):
+                rate_limited[request_id] = exception
+                return
+            parsed_data = self._format(parser, request_id, response, exception, format)
+            if parsed_data:
+                parsed.append(parsed_data)
+
+        for attempt in range(config.GMAIL_MAX_RETRIES + 1):
+            batch = services.new_batch_http_request(callback=callback)
+            for mail_id in mail_ids:
+                batch.add(services.users().messages().get(userId='me', id=mail_id, format=format, **extra), request_id=mail_id)
+            self._execute(batch, 'messages.get', count=len(mail_ids))
+            if not rate_limited:
+                break
+            if attempt == config.GMAIL_MAX_RETRIES:
+                for mail_id, exception in rate_limited.items():
+                    self.fetch_errors.append({"mail_id": mail_id, "error": str(exception)})
+                break
+            error = next(iter(rate_limited.values()))
+            time.sleep(quota_limiter.backoff(attempt, retry_after_seconds(error.resp.get('retry-after')), error.resp.status))
+            mail_ids = list(rate_limited)
+            rate_limited.clear()
+        return parsed
+
+    def _attachments_to_store(self, mail: MailRecord) -> list:
+        """ (index, AttachmentRef) of the attachments to download, ones without id or over ATTACHMENT_MAX_BYTES are left out """
+        if get_attachment_store() is None:
+            return []
+        return [(index, ref) for index, ref in enumerate(mail.attachments)
+                if ref.attachment_id and ref.size <= config.ATTACHMENT_MAX_BYTES]
+
+    def save_attachments(self, mail: MailRecord):
+        """ Download the mail's attachments into the attachment store and set their sha256,
+        failures are recorded in self.fetch_errors """
+        if not self.valid:
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Google authentication required")
+        for index, ref in self._attachments_to_store(mail):
+            writer = get_attachment_store().writer()
+            decoder = AttachmentDecoder()
+            try:
+                for chunk in self._stream_attachment(mail.mail_id, ref.attachment_id):
+                    writer.write(decoder.feed(chunk))
+                writer.write(decoder.close())
+                mail.attachments[index] = ref._replace(sha256=writer.commit())
+            except Exception as e:
+                writer.abort()
+                self.fetch_errors.append({"mail_id": mail.mail_id, "attachment": ref.filename, "error": str(e)})
+
+    def _stream_attachment(self, message_id: str, attachment_id: str):
+        """ messages.attachments.get as raw response chunks, the discovery client would parse the whole body """
+        url = f"{config.GMAIL_API_URL.rstrip('/')}/gmail/v1/users/me/messages/{message_id}/attachments/{attachment_id}"
+        for attempt in range(config.GMAIL_MAX_RETRIES + 1):
+            quota_limiter.acquire(self.user_id, 'messages.attachments.get')
+            token = credential_manager.get(self.user_id, self.secret).token
+            with httpx.stream("GET", url, headers={"Authorization": f"Bearer {token}"}, timeout=30.0) as response:
+                if response.status_code < 400:
+                    yield from response.iter_bytes()
+                    return
+                response.read()
+            error = GmailAPIError(
+                response.status_code, response.text[:500],
+                retry_after=retry_after_seconds(response.headers.get("Retry-After"))
+            )
+            if attempt == config.GMAIL_MAX_RETRIES or not is_retryable(error.status_code, error.detail):
+                raise error
+            time.sleep(quota_limiter.backoff(attempt, error.retry_after, error.status_code))
+
+    def _format(self, parser, mail_id: str, response: dict, exception: Exception, format: str):
+        """ Parse one fetched message, failures are recorded in self.fetch_errors """
+        if exception is not None:
+            self.fetch_errors.append({"mail_id": mail_id, "error": str(exception)})
+            return None
         try:
-            results = services.users().history().list(
-                userId='me',
-                startHistoryId=history_id,
-                # historyTypes=['messageAdded']
-            ).execute()
-
-            history_records = results.get('history', [])
-            
-            print("All records are: ", results, history_id)
-            if not history_records:
-                new_history_id = results.get('historyId')
-                check_duplicate = self.db.query(WatchHistory).filter(WatchHistory.history_id==new_history_id).filter(WatchHistory.user_id == self.user_id).first()
-                if not check_duplicate:
-                    print("No new mail found, updating history id to ", new_history_id)
-                    add_history = WatchHistory(
-                        history_id = new_history_id,
-                        added_by = "hook",
-                        user_id = self.user_id
-                    )
-                    self.db.add(add_history)
-                    self.db.commit()
-                return []
-            
-            message_ids = []
-            for record in history_records:
-                for msg in record.get('messagesAdded', []):
-                    message_id = msg['message']['id']
-                    message_ids.append(message_id)
-                    print("="*30, "\n\n")
-                    break
-            return message_ids
+            parsed_data = parser.gmail_messages(response)
         except Exception as e:
-            print(5, str(e))
-            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
-    
+            self.fetch_errors.append({"mail_id": mail_id, "error": str(e)})
+            return None
+        parsed_data.user_id = self.user_id
+        parsed_data.body_fetched = format == 'full'
+        return parsed_data
 
-    def fetch_and_format_mails(self, mail_ids:List[int]) -> List[dict]:
+    def iter_mails_two_phase(self, mail_ids, needs_body=None, batch_size: int = config.GMAIL_BATCH_SIZE):
+        """
+        Fetch the headers of every mail first and the full mail only for the
+        ones needs_body asks for, mails that don't need it are yielded right
+        after the metadata phase with an empty document.
+
+        args:
+            mail_ids (Iterable[str]): Mail ids, may be a generator
+            needs_body (Callable[[MailRecord], bool]): Decides on the parsed metadata, util.needs_body by default
+        """
+        needs_body = needs_body or util.needs_body
+        for chunk in util.chunked(mail_ids, batch_size):
+            full_ids = []
+            for mail in self.iter_mails(chunk, batch_size=batch_size, format='metadata'):
+                if needs_body(mail):
+                    full_ids.append(mail.mail_id)
+                else:
+                    yield mail
+            yield from self.iter_mails(full_ids, batch_size=batch_size, format='full')
+
+    def fetch_and_format_mails(self, mail_ids:List[int]) -> List[MailRecord]:
         """
         Fetch mail details by mail ids and format them in chromadb format.
+        Mails that could not be fetched are listed in self.fetch_errors.
 
         args:
             mail_ids (List[int]): List of mail ids
 
         """
-        services = self.services or self.build_service("gmail", "v1")
-        formatted_mails = []
         try:
-            for mail_id in mail_ids:
-                    message = services.users().messages().get(userId='me', id=mail_id, format='full').execute()
-                    parsed_data = util.ParseUtil().gmail_messages(message)
-                    parsed_data['metadata']["user_id"] = self.user_id
-                    formatted_mails.append(parsed_data)
-                    print("Storing mail data:", parsed_data)
-            return formatted_mails
+            return list(self.iter_mails(mail_ids))
         except Exception as e:
             print(6, str(e))
-            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
+            raise gmail_http_exception(e)
     
     def decode(self, data, encoding='UTF-8') -> str:
         """ Decode base64 encoded data"""
@@ -182,35 +389,155 @@ class Services:
             print(2, str(e))
             raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
     
-    def manage_hook(self, history_id: int):
-        """ Manage incoming webhook from google pubsub service"""
-        # services = self.services or self.build_service("gmail", "v1")
-
+    def update_cursor(self, cursor_id: int):
+        """ Store the history id as the users WatchHistory cursor, the cursor only moves forward """
         try:
-            # maintain history id in the database
-            check_history = self.db.query(WatchHistory.id).filter(WatchHistory.history_id==history_id)\
-                                .filter(WatchHistory.user_id == self.user_id).first()
+            latest_history = self.db.query(WatchHistory.history_id).filter(WatchHistory.user_id == self.user_id)\
+                                .order_by(WatchHistory.id.desc()).first()
         except SQLAlchemyError:
             self.db.rollback()
-            check_history = None
+            latest_history = None
 
-        if not check_history:
+        if not latest_history or int(latest_history.history_id) < int(cursor_id):
             update_watch_history = WatchHistory(
-                history_id = history_id, 
+                history_id = str(cursor_id), 
                 added_by = "hook",
                 user_id = self.user_id
             )
             self.db.add(update_watch_history)
             self.db.commit()
 
+    def manage_hook(self, history_id: int, end_history_id: int = None):
+        """ Manage incoming webhook from google pubsub service
+        Args:
+            history_id int: History Id to start the scan from
+            end_history_id int: Highest History Id of a coalesced burst of notifications, stored as cursor
+        """
+        return list(self.iter_hook(history_id, end_history_id))
 
+    def iter_hook(self, history_id: int, end_history_id: int = None):
+        """ Streaming manage_hook, mails are fetched while the history is still being walked """
+        self.update_cursor(end_history_id or history_id)
         try:
-            message_ids = self.get_mail_ids(history_id)
-            message = self.fetch_and_format_mails(message_ids)
-            return message
+            mail_ids = self.iter_mail_ids(history_id)
+            if config.GMAIL_TWO_PHASE_FETCH:
+                yield from self.iter_mails_two_phase(mail_ids)
+            else:
+                yield from self.iter_mails(mail_ids)
+        except HTTPException:
+            raise
         except Exception as e:
             print('1', str(e))
-            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
+            raise gmail_http_exception(e)
+
+    # ---------------------
+    # Async variants, on the pooled asyncio client (utils/gmail_async.py)
+    # Database work is pushed to the threadpool, the event loop never blocks
+    # ---------------------
+    async def _token(self) -> str:
+        if not self.valid:
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Google authentication required")
+        tokens = await run_in_threadpool(credential_manager.get, self.user_id, self.secret)
+        return tokens.token
+
+    async def aiter_mail_ids(self, history_id: int, labels: list[str] = ["INBOX"], seen_limit: int = 10000):
+        """ Async iter_mail_ids """
+        client = get_async_gmail()
+        label_filter = None if len(labels) == 1 else set(labels)
+        seen = OrderedDict()
+        found = False
+        page_token = None
+        while True:
+            results = await client.history_list(
+                await self._token(),
+                start_history_id=history_id,
+                history_types=['messageAdded'],
+                label_id=labels[0] if label_filter is None else None,
+                page_token=page_token,
+                user_id=self.user_id
+            )
+            for message_id in self._added_ids(results, seen, label_filter, seen_limit):
+                found = True
+                yield message_id
+
+            page_token = results.get('nextPageToken')
+            if not page_token:
+                break
+
+        if not found:
+            await run_in_threadpool(self.record_idle_history, results.get('historyId'))
+
+    async def aiter_mails(self, mail_ids, batch_size: int = config.GMAIL_BATCH_SIZE, format: str = 'full'):
+        """ Async iter_mails, each chunk of ids is fetched concurrently (bounded by the client) """
+        client = get_async_gmail()
+        parser = util.ParseUtil()
+        metadata_headers = METADATA_HEADERS if format == 'metadata' else None
+
+        async for chunk in util.achunked(mail_ids, batch_size):
+            token = await self._token()
+            chunk = list(dict.fromkeys(chunk))
+            sizes = []
+            responses = await asyncio.gather(
+                *[client.messages_get(token, mail_id, format=format, metadata_headers=metadata_headers, user_id=self.user_id,
+                                      sizes=sizes) for mail_id in chunk],
+                return_exceptions=True
+            )
+            self.transfer_stats[format] = self.transfer_stats.get(format, 0) + sum(sizes)
+            TRANSFER_STATS[format] = TRANSFER_STATS.get(format, 0) + sum(sizes)
+            parsed = []
+            for mail_id, response in zip(chunk, responses):
+                exception = response if isinstance(response, Exception) else None
+                parsed_data = self._format(parser, mail_id, None if exception else response, exception, format)
+                if parsed_data:
+                    parsed.append(parsed_data)
+            await asyncio.gather(*[self.asave_attachments(mail) for mail in parsed if mail.attachments])
+            for mail in parsed:
+                yield mail
+
+    async def asave_attachments(self, mail: MailRecord):
+        """ Async save_attachments, every attachment is streamed from the response to disk """
+        client = get_async_gmail()
+
+        async def save(index, ref):
+            writer = get_attachment_store().writer()
+            decoder = AttachmentDecoder()
+            try:
+                async for chunk in client.stream_attachment(await self._token(), mail.mail_id, ref.attachment_id, user_id=self.user_id):
+                    writer.write(decoder.feed(chunk))
+                writer.write(decoder.close())
+                mail.attachments[index] = ref._replace(sha256=writer.commit())
+            except Exception as e:
+                writer.abort()
+                self.fetch_errors.append({"mail_id": mail.mail_id, "attachment": ref.filename, "error": str(e)})
+
+        await asyncio.gather(*[save(index, ref) for index, ref in self._attachments_to_store(mail)])
+
+    async def aiter_mails_two_phase(self, mail_ids, needs_body=None, batch_size: int = config.GMAIL_BATCH_SIZE):
+        """ Async iter_mails_two_phase """
+        needs_body = needs_body or util.needs_body
+        async for chunk in util.achunked(mail_ids, batch_size):
+            full_ids = []
+            async for mail in self.aiter_mails(chunk, batch_size=batch_size, format='metadata'):
+                if needs_body(mail):
+                    full_ids.append(mail.mail_id)
+                else:
+                    yield mail
+            async for mail in self.aiter_mails(full_ids, batch_size=batch_size, format='full'):
+                yield mail
+
+    async def aiter_hook(self, history_id: int, end_history_id: int = None):
+        """ Async iter_hook """
+        await run_in_threadpool(self.update_cursor, end_history_id or history_id)
+        try:
+            mail_ids = self.aiter_mail_ids(history_id)
+            mails = self.aiter_mails_two_phase(mail_ids) if config.GMAIL_TWO_PHASE_FETCH else self.aiter_mails(mail_ids)
+            async for mail in mails:
+                yield mail
+        except HTTPException:
+            raise
+        except Exception as e:
+            print('1', str(e))
+            raise gmail_http_exception(e)
         
 
 
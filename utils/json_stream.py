@@ -0,0 +1,61 @@
+"""
+Incremental JSON boundary detection on a token stream.
+
+The model's answer arrives in small pieces. JsonStream tracks brackets and
+strings as they come in and says when the first top-level object or array is
+complete, so the client can close the stream right there instead of waiting
+for trailing whitespace, a second object or an explanation after the JSON.
+It does not build the value, json.loads of .text does that once.
+"""
+
+
+class JsonStream:
+    """ Feed pieces of text, complete once the first top-level {...} or [...] is closed """
+
+    def __init__(self):
+        self._pieces = []
+        self._depth = 0
+        self._in_string = False
+        self._escaped = False
+        self._started = False
+        self.complete = False
+
+    def feed(self, piece: str) -> bool:
+        """ Add a piece of the answer, True once the top-level value is complete (the rest of piece is dropped) """
+        if self.complete:
+            return True
+        if not self._started:
+            # text before the JSON
+            starts = [index for index in (piece.find("{"), piece.find("[")) if index >= 0]
+            if not starts:
+                return False
+            self._started = True
+            piece = piece[min(starts):]
+        return self._scan(piece)
+
+    def _scan(self, piece: str) -> bool:
+        for index, char in enumerate(piece):
+            if self._in_string:
+                if self._escaped:
+                    self._escaped = False
+                elif char == "\\":
+                    self._escaped = True
+                elif char == '"':
+                    self._in_string = False
+            elif char == '"':
+                self._in_string = True
+            elif char in "{[":
+                self._depth += 1
+            elif char in "}]":
+                self._depth -= 1
+                if self._depth == 0:
+                    self._pieces.append(piece[:index + 1])
+                    self.complete = True
+                    return True
+        self._pieces.append(piece)
+        return False
+
+    @property
+    def text(self) -> str:
+        """ The JSON so far, the whole value once complete """
+        return "".join(self._pieces)
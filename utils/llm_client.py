@@ -0,0 +1,148 @@
+import asyncio
+import json
+import time
+import httpx
+from typing import Optional
+from env_secrets import config
+from utils.json_stream import JsonStream
+
+
+"""
+Asyncio client for the Ollama HTTP API used by MailAgent.
+
+One pooled httpx.AsyncClient per backend URL, shared by every agent of the
+process. Requests in flight per backend are bounded by a semaphore so a
+burst of mails queues here instead of overloading the model server.
+Cancelling the awaiting task closes the stream and frees the slot.
+With stop_at_json the stream is closed as soon as the answer's JSON value is
+complete (utils/json_stream.py), the server stops generating with it.
+"""
+
+
+class LLMError(Exception):
+    """ Non 2xx answer of the model server """
+
+    def __init__(self, status_code: int, detail: str):
+        super().__init__(f"Agent API request failed with status code {status_code}: {detail}")
+        self.status_code = status_code
+        self.detail = detail
+
+
+class LLMClient:
+    """ Streaming /api/generate over a shared connection pool """
+
+    def __init__(self, base_url: str, max_in_flight: int = config.AGENT_MAX_IN_FLIGHT,
+                 timeout: float = config.AGENT_TIMEOUT, transport: httpx.AsyncBaseTransport = None):
+        self.base_url = base_url.rstrip("/")
+        self._client = httpx.AsyncClient(
+            base_url=self.base_url,
+            # generation can take long, connecting must not
+            timeout=httpx.Timeout(timeout, connect=config.AGENT_CONNECT_TIMEOUT),
+            limits=httpx.Limits(max_connections=max_in_flight, max_keepalive_connections=max_in_flight),
+            transport=transport
+        )
+        self._in_flight = asyncio.Semaphore(max_in_flight)
+        self.stats = {"requests": 0, "failures": 0, "in_flight": 0, "first_token_seconds": 0.0, "prompt_eval_tokens": 0,
+                      "output_tokens": 0, "early_stops": 0}
+        self._context_lengths = {}
+
+    async def generate(self, payload: dict, timings: dict = None, stop_at_json: bool = False) -> str:
+        """ POST /api/generate and return the streamed response text
+        Args:
+            payload dict: Ollama generate request (model, prompt, system, options, keep_alive ...)
+            timings dict: Filled with first_token_seconds, prompt_eval_count, output_tokens, load_seconds
+                and early_stop of the request
+            stop_at_json bool: Stop once the first JSON object / array is complete and return only it
+        """
+        timings = {} if timings is None else timings
+        async with self._in_flight:
+            self.stats["requests"] += 1
+            self.stats["in_flight"] += 1
+            started = time.perf_counter()
+            try:
+                async with self._client.stream("POST", "/api/generate", json=payload) as response:
+                    if response.status_code != 200:
+                        await response.aread()
+                        raise LLMError(response.status_code, response.text[:500])
+                    # collect the pieces, one join at the end instead of quadratic concatenation
+                    pieces = []
+                    json_stream = JsonStream() if stop_at_json else None
+                    output_tokens = 0
+                    async for line in response.aiter_lines():
+                        if not line:
+                            continue
+                        try:
+                            chunk = json.loads(line)
+                        except json.JSONDecodeError:
+                            print("Failed to decode chunk:", line)
+                            continue
+                        if chunk.get("response") and "first_token_seconds" not in timings:
+                            timings["first_token_seconds"] = time.perf_counter() - started
+                        piece = chunk.get("response", "")
+                        pieces.append(piece)
+                        # one streamed chunk per generated token
+                        output_tokens += bool(piece)
+                        complete = json_stream is not None and json_stream.feed(piece)
+                        if chunk.get("done"):
+                            # prompt_eval_count only counts prompt tokens the server did not have cached
+                            timings["prompt_eval_count"] = chunk.get("prompt_eval_count", 0)
+                            timings["load_seconds"] = chunk.get("load_duration", 0) / 1e9
+                            output_tokens = chunk.get("eval_count", output_tokens)
+                            break
+                        if complete:
+                            # leaving the stream closes the connection, no tokens are generated after the JSON
+                            timings["early_stop"] = True
+                            self.stats["early_stops"] += 1
+                            break
+                    timings["output_tokens"] = output_tokens
+                    self.stats["first_token_seconds"] += timings.get("first_token_seconds", 0.0)
+                    self.stats["prompt_eval_tokens"] += timings.get("prompt_eval_count", 0)
+                    self.stats["output_tokens"] += output_tokens
+                    if json_stream is not None and json_stream.complete:
+                        return json_stream.text
+                    return "".join(pieces)
+            except Exception:
+                self.stats["failures"] += 1
+                raise
+            finally:
+                self.stats["in_flight"] -= 1
+
+    async def context_length(self, model: str) -> Optional[int]:
+        """ Context window of the model from /api/show, None when the server does not say """
+        if model not in self._context_lengths:
+            length = None
+            try:
+                response = await self._client.post("/api/show", json={"model": model})
+                if response.status_code == 200:
+                    info = response.json().get("model_info") or {}
+                    length = next((int(value) for key, value in info.items() if key.endswith(".context_length")), None)
+            except (httpx.HTTPError, ValueError) as e:
+                print("Failed to read the context length of", model, e)
+            self._context_lengths[model] = length
+        return self._context_lengths[model]
+
+    async def close(self):
+        await self._client.aclose()
+
+
+_llm_clients = {}
+
+def get_llm_client(base_url: str = config.AGENT_URL) -> LLMClient:
+    """ Process wide client of a backend, created on first use inside the running loop """
+    if base_url not in _llm_clients:
+        _llm_clients[base_url] = LLMClient(base_url)
+    return _llm_clients[base_url]
+
+
+def llm_stats() -> dict:
+    """ Counters of every backend in use, with the generated tokens per request """
+    return {base_url: {**client.stats,
+                       "output_tokens_per_request": round(client.stats["output_tokens"] / client.stats["requests"], 1)
+                       if client.stats["requests"] else 0.0}
+            for base_url, client in _llm_clients.items()}
+
+
+async def close_llm_clients():
+    for client in list(_llm_clients.values()):
+        await client.close()
+    _llm_clients.clear()
@@ -0,0 +1,120 @@
+import html
+import re
+from base64 import urlsafe_b64decode
+from env_secrets import config
+
+
+"""
+Body extraction from Gmail's MIME tree (format='full' payloads).
+
+The tree is walked recursively: text/plain is preferred inside every
+multipart/alternative, HTML is only converted to text when a part has no
+plain alternative. Attachments are never decoded. Part bodies are base64
+decoded lazily and only up to max_bytes per message, so a huge newsletter
+costs no more than the cap.
+"""
+
+_BLOCK_TAGS = re.compile(r"<\s*(br|/p|/div|/tr|/h[1-6]|li|/li|/table|hr)\b[^>]*>", re.I)
+_DROP_BLOCKS = re.compile(r"<(script|style|head|title)\b.*?</\1\s*>", re.I | re.S)
+_COMMENTS = re.compile(r"<!--.*?-->", re.S)
+_TAGS = re.compile(r"<[^>]+>")
+_SPACES = re.compile(r"[ \t\r\f\v]+")
+_BLANK_LINES = re.compile(r"\n\s*\n+")
+_CHARSET = re.compile(r'charset="?([\w.:-]+)', re.I)
+
+
+def html_to_text(markup: str) -> str:
+    """ Fast, regex based HTML to text: drops scripts/styles, keeps block breaks """
+    markup = _COMMENTS.sub("", markup)
+    markup = _DROP_BLOCKS.sub("", markup)
+    markup = _BLOCK_TAGS.sub("\n", markup)
+    text = html.unescape(_TAGS.sub("", markup))
+    text = _SPACES.sub(" ", text)
+    return _BLANK_LINES.sub("\n\n", text).strip()
+
+
+def is_attachment(part: dict) -> bool:
+    body = part.get("body", {})
+    if part.get("filename") or body.get("attachmentId"):
+        return True
+    for header in part.get("headers", []):
+        if header["name"].lower() == "content-disposition" and header["value"].lower().startswith("attachment"):
+            return True
+    return False
+
+
+def text_parts(part: dict):
+    """ Yield the text/plain and text/html leaves to read, in document order
+    Args:
+        part dict: Gmail payload or one of its parts
+    """
+    if is_attachment(part):
+        return
+    mime_type = part.get("mimeType", "").lower()
+    children = part.get("parts") or []
+    if mime_type == "multipart/alternative" and children:
+        # one rendition only, plain text when there is one, otherwise the richest (last) one
+        plain = [child for child in children if child.get("mimeType", "").lower() == "text/plain"]
+        yield from text_parts(plain[0] if plain else children[-1])
+    elif children:
+        for child in children:
+            yield from text_parts(child)
+    elif mime_type in ("text/plain", "text/html") or (not mime_type and part.get("body", {}).get("data")):
+        yield part
+
+
+def attachment_parts(part: dict):
+    """ Yield every attachment part of the tree (parts with a filename or an attachmentId) """
+    if is_attachment(part):
+        yield part
+        return
+    for child in part.get("parts") or []:
+        yield from attachment_parts(child)
+
+
+def _charset(part: dict) -> str:
+    for header in part.get("headers", []):
+        if header["name"].lower() == "content-type":
+            match = _CHARSET.search(header["value"])
+            if match:
+                return match.group(1)
+    return "utf-8"
+
+
+def decode_part(part: dict, max_bytes: int) -> tuple[str, bool]:
+    """ Decode at most max_bytes of the part's body. Returns (text, truncated) """
+    data = part.get("body", {}).get("data") or ""
+    # 4 base64 characters hold 3 bytes, decode only the prefix that is needed
+    limit = -(-max_bytes // 3) * 4
+    truncated = len(data) > limit
+    raw = urlsafe_b64decode(data[:limit] + "=" * (-min(len(data), limit) % 4))[:max_bytes]
+    try:
+        text = raw.decode(_charset(part), errors="ignore")
+    except LookupError:
+        text = raw.decode("utf-8", errors="ignore")
+    if part.get("mimeType", "").lower() == "text/html":
+        text = html_to_text(text)
+    return text, truncated
+
+
+def extract_body(payload: dict, max_bytes: int = config.MAIL_MAX_BODY_BYTES) -> tuple[str, bool]:
+    """ Readable text of a Gmail payload, at most max_bytes decoded
+    Args:
+        payload dict: message['payload'] of a format='full' message
+        max_bytes int: Decoded bytes allowed for the whole message
+    Returns:
+        tuple[str, bool]: Body text and whether it was cut at max_bytes
+    """
+    texts = []
+    budget = max_bytes
+    truncated = False
+    for part in text_parts(payload):
+        if budget <= 0:
+            truncated = True
+            break
+        text, cut = decode_part(part, budget)
+        budget -= part.get("body", {}).get("size") or len(text)
+        truncated = truncated or cut
+        if text.strip():
+            texts.append(text.strip())
+    return "\n\n".join(texts), truncated
@@ -0,0 +1,126 @@
+import re
+from urllib.parse import urlsplit
+from env_secrets import config
+
+
+"""
+Mail body normalisation before it goes into a prompt.
+
+Quoted reply history, signatures and boilerplate footers are removed, long
+URLs are collapsed to their host and whitespace is squeezed. What is left is
+cut to a token budget: the head of the mail is kept, and from the rest only
+the lines carrying amounts or dates, which the finance and event steps need.
+"""
+
+# Start of quoted history, everything from here on is dropped
+_REPLY_MARKERS = re.compile(
+    r"^(On\b.{0,300}?\bwrote:\s*$"                          # Gmail / Apple Mail, may wrap over two lines
+    r"|-{2,}\s*Original Message\s*-{2,}"                      # Outlook
+    r"|From:\s[^\n]+\n(Sent|Date):\s"                         # Outlook header block
+    r"|_{20,}\s*$)",
+    re.I | re.M | re.S
+)
+# Signature delimiter and mobile footers, everything from here on is dropped
+_SIGNATURE_MARKERS = re.compile(r"^(--\s*$|Sent from my \w+|Get Outlook for \w+)", re.I | re.M)
+# Valediction, dropped with what follows when it is in the last lines of the mail
+_VALEDICTION = re.compile(r"^(best|kind|warm)?\s*(regards|thanks|thank you|cheers|sincerely|best)\s*,?\s*$", re.I | re.M)
+# Boilerplate lines, removed wherever they are
+_BOILERPLATE = re.compile(
+    r"^.*(unsubscribe|view (it |this email )?in (your )?browser|you are receiving this|intended recipient"
+    r"|this (e-?mail|message) (and any attachments? )?(is|are|may be) confidential|privacy policy"
+    r"|all rights reserved|manage (your )?(preferences|subscription)).*$",
+    re.I | re.M
+)
+_URL = re.compile(r"https?://\S+")
+_SPACES = re.compile(r"[ \t\f\v\u00a0]+")
+_BLANK_LINES = re.compile(r"\n\s*\n+")
+
+_MONTH = r"(jan|feb|mar|apr|may|jun|jul|aug|sep|sept|oct|nov|dec)[a-z]*\.?"
+_AMOUNT_OR_DATE = re.compile(
+    r"([$€£₹¥]\s?\d[\d,]*(\.\d+)?|\b\d[\d,]*(\.\d+)?\s?(usd|eur|gbp|inr|rs\.?|rupees|dollars)\b|\b(rs\.?|inr|usd)\s?\d"
+    r"|\b\d{1,2}[/.-]\d{1,2}[/.-]\d{2,4}\b|\b\d{4}-\d{2}-\d{2}\b"
+    rf"|\b\d{{1,2}}(st|nd|rd|th)?\s+{_MONTH}|\b{_MONTH}\s+\d{{1,2}}\b"
+    r"|\b(mon|tue|wed|thu|fri|sat|sun)[a-z]*day\b|\b\d{1,2}(:\d{2})?\s?(am|pm)\b)",
+    re.I
+)
+
+NORMALISE_STATS = {"mails": 0, "tokens_in": 0, "tokens_out": 0}
+
+
+def estimate_tokens(text: str) -> int:
+    """ Rough token count (about 4 characters per token for English text) """
+    return (len(text) + 3) // 4
+
+
+def _collapse_url(match: re.Match) -> str:
+    url = match.group(0)
+    if len(url) <= 40:
+        return url
+    return f"<{urlsplit(url).hostname or 'link'}>"
+
+
+def strip_quoted(text: str) -> str:
+    """ Drop quoted reply history, '>' lines and the signature """
+    original = text
+    match = _REPLY_MARKERS.search(text)
+    if match:
+        text = text[:match.start()]
+    text = "\n".join(line for line in text.split("\n") if not line.lstrip().startswith(">"))
+    match = _SIGNATURE_MARKERS.search(text)
+    if match:
+        text = text[:match.start()]
+    # "Regards,\nName\nTitle" at the very end, not a "Thanks" opening the mail
+    for match in _VALEDICTION.finditer(text):
+        if text[:match.start()].strip() and _signature_tail(text[match.end():]):
+            text = text[:match.start()]
+            break
+    return text if text.strip() else original
+
+
+def _signature_tail(tail: str) -> bool:
+    """ A few short lines without amounts or dates, a name and a title """
+    lines = [line.strip() for line in tail.strip().split("\n") if line.strip()]
+    return len(lines) <= 4 and all(len(line) <= 60 and not _AMOUNT_OR_DATE.search(line) for line in lines)
+
+
+def truncate_to_budget(text: str, max_tokens: int) -> str:
+    """ Keep the head of the text and, from the rest, the lines with amounts or dates """
+    if estimate_tokens(text) <= max_tokens:
+        return text
+    budget = max_tokens * 4
+    head = text[:budget * 3 // 4]
+    cut = head.rfind(" ")
+    if cut > len(head) // 2:
+        head = head[:cut]
+    rest = text[len(head):]
+    kept = []
+    budget -= len(head)
+    for line in rest.split("\n"):
+        line = line.strip()
+        if line and _AMOUNT_OR_DATE.search(line):
+            if len(line) > budget:
+                break
+            kept.append(line)
+            budget -= len(line) + 1
+    return head + " ...\n" + "\n".join(kept) if kept else head + " ..."
+
+
+def normalise_body(text: str, max_tokens: int = config.MAIL_BODY_TOKEN_BUDGET) -> str:
+    """ Prompt ready mail body
+    Args:
+        text str: Decoded body (MailRecord.document)
+        max_tokens int: Token budget of the result, 0 to disable the cut
+    """
+    tokens_in = estimate_tokens(text)
+    text = strip_quoted(text)
+    text = _BOILERPLATE.sub("", text)
+    text = _URL.sub(_collapse_url, text)
+    text = _SPACES.sub(" ", text)
+    text = _BLANK_LINES.sub("\n\n", text).strip()
+    if max_tokens:
+        text = truncate_to_budget(text, max_tokens)
+
+    NORMALISE_STATS["mails"] += 1
+    NORMALISE_STATS["tokens_in"] += tokens_in
+    NORMALISE_STATS["tokens_out"] += estimate_tokens(text)
+    return text
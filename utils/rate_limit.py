@@ -0,0 +1,121 @@
+import asyncio
+import random
+import threading
+import time
+from collections import OrderedDict
+from env_secrets import config
+
+
+"""
+Gmail quota aware rate limiting, shared by the discovery client (threads)
+and the asyncio client.
+
+Gmail charges quota units per method, per user and per project. Every call
+first reserves its units in the user's bucket and in the global one and
+waits until both can pay. Calls rejected anyway (429, 403 rate limit, 5xx)
+are retried with jittered exponential backoff, honouring Retry-After.
+"""
+
+# https://developers.google.com/gmail/api/reference/quota
+METHOD_COSTS = {
+    "history.list": 2,
+    "messages.list": 5,
+    "messages.get": 5,
+    "messages.modify": 5,
+    "messages.attachments.get": 5,
+    "drafts.create": 10,
+    "watch": 100,
+    "stop": 50,
+}
+RETRY_STATUS = {429, 500, 502, 503, 504}
+RATE_LIMIT_REASONS = ("rateLimitExceeded", "userRateLimitExceeded", "quotaExceeded")
+
+
+class TokenBucket:
+    """ Thread safe token bucket, callers reserve units and get the time to wait back """
+
+    def __init__(self, rate: float, capacity: float = None):
+        self.rate = rate                        # units per second
+        self.capacity = capacity or rate        # burst size
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self, units: float) -> float:
+        """ Take units now (the balance may go negative), returns seconds until they are covered """
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= units
+            return max(0.0, -self.tokens / self.rate)
+
+
+class QuotaLimiter:
+    """ Per user and global (project) buckets priced with METHOD_COSTS """
+
+    def __init__(self, user_rate: float = config.GMAIL_USER_QUOTA_PER_SECOND,
+                 project_rate: float = config.GMAIL_PROJECT_QUOTA_PER_SECOND, max_users: int = 10000):
+        self.user_rate = user_rate
+        self.project = TokenBucket(project_rate)
+        self.max_users = max_users
+        self.stats = {"calls": 0, "units": 0, "throttled_seconds": 0.0, "retries": 0, "rate_limited": 0}
+        self._users = OrderedDict()             # user_id -> TokenBucket, least recently used first
+        self._lock = threading.Lock()
+
+    def _user_bucket(self, user_id) -> TokenBucket:
+        with self._lock:
+            bucket = self._users.get(user_id)
+            if bucket is None:
+                bucket = self._users[user_id] = TokenBucket(self.user_rate)
+                if len(self._users) > self.max_users:
+                    self._users.popitem(last=False)
+            self._users.move_to_end(user_id)
+            return bucket
+
+    def reserve(self, user_id, method: str, count: int = 1) -> float:
+        units = METHOD_COSTS.get(method, 5) * count
+        self.stats["calls"] += count
+        self.stats["units"] += units
+        wait = max(self._user_bucket(user_id).reserve(units), self.project.reserve(units))
+        self.stats["throttled_seconds"] += wait
+        return wait
+
+    def acquire(self, user_id, method: str, count: int = 1):
+        """ Blocking acquire, for the discovery client running in threads """
+        wait = self.reserve(user_id, method, count)
+        if wait:
+            time.sleep(wait)
+
+    async def aacquire(self, user_id, method: str, count: int = 1):
+        wait = self.reserve(user_id, method, count)
+        if wait:
+            await asyncio.sleep(wait)
+
+    def backoff(self, attempt: int, retry_after: float = None, status_code: int = None) -> float:
+        """ Seconds to wait before retry number attempt (0 based) of a call that failed with status_code """
+        self.stats["retries"] += 1
+        if status_code in (403, 429):
+            self.stats["rate_limited"] += 1
+        if retry_after:
+            return retry_after + random.uniform(0, 1)
+        # full jitter, capped
+        return random.uniform(0, min(config.GMAIL_BACKOFF_CAP, config.GMAIL_BACKOFF_BASE * 2 ** attempt))
+
+
+def is_retryable(status_code: int, detail: str = "") -> bool:
+    """ Whether a failed Gmail call is worth retrying (rate limits and server errors) """
+    if status_code in RETRY_STATUS:
+        return True
+    return status_code == 403 and any(reason in (detail or "") for reason in RATE_LIMIT_REASONS)
+
+
+def retry_after_seconds(value) -> float:
+    """ Retry-After header as seconds, None when missing or an HTTP date """
+    try:
+        return float(value) if value is not None else None
+    except (TypeError, ValueError):
+        return None
+
+
+quota_limiter = QuotaLimiter()
@@ -0,0 +1,161 @@
+import re
+import threading
+import time
+from collections import defaultdict
+from email.utils import parseaddr
+from typing import Optional
+from models.vector_schema import MailRecord
+from models.relational_models import LabelRule
+
+
+"""
+Per user labelling rules (label_rule table, /users/me/rules endpoints).
+
+A mail from a bank's alert address, a newsletter with a List-Unsubscribe
+header or a subject like "Invoice #" does not need a model to be labelled.
+The rules of a user are compiled once into one matcher:
+    sender_domain            -> dict lookup of the sender's domain and its parents
+    sender, subject, list_id,
+    list_unsubscribe         -> one combined regex per field, every rule a named group
+so a mail is matched with at most one regex search per field, however many
+rules there are. The highest priority matching rule wins, MailAgent.run then
+skips classification entirely.
+"""
+
+FIELDS = ("sender_domain", "sender", "subject", "list_id", "list_unsubscribe")
+MAX_PATTERN_LENGTH = 500
+_BACKREFERENCE = re.compile(r"\\\d|\(\?P=")
+
+RULE_STATS = {"messages": 0, "matched": 0, "match_seconds": 0.0, "max_match_seconds": 0.0, "hits": defaultdict(int)}
+
+
+def validate_rule(field: str, pattern: str, is_regex: bool):
+    """ Raise ValueError when a rule can not be compiled """
+    if field not in FIELDS:
+        raise ValueError(f"field must be one of {', '.join(FIELDS)}")
+    if len(pattern or "") > MAX_PATTERN_LENGTH:
+        raise ValueError(f"pattern longer than {MAX_PATTERN_LENGTH} characters")
+    if field == "sender_domain" and not (pattern or "").strip().lower().lstrip("@."):
+        # every other field matches any non empty value with an empty pattern, a domain can not
+        raise ValueError("sender_domain needs a domain")
+    if is_regex:
+        # it must still work as one alternative of the combined regex
+        try:
+            compiled = re.compile(f"(?P<r0>{pattern})|(?P<r1>x)")
+        except re.error as e:
+            raise ValueError(f"invalid regex: {e}")
+        if set(compiled.groupindex) != {"r0", "r1"} or _BACKREFERENCE.search(pattern):
+            raise ValueError("named groups and backreferences are not supported")
+
+
+def sender_domain(sent_by: str) -> str:
+    return parseaddr(sent_by or "")[1].rpartition("@")[2].lower()
+
+
+class CompiledRules:
+    """ Matcher of one user's enabled rules """
+
+    def __init__(self, rules: list):
+        """
+        Args:
+            rules list: LabelRule rows (id, field, pattern, is_regex, label_name, priority, enabled)
+        """
+        rules = sorted((rule for rule in rules if rule.enabled and self._valid(rule)), key=lambda rule: (-rule.priority, rule.id))
+        self.size = len(rules)
+        self._rules = {rule.id: (rule.label_name, rule.priority, rule.field, rule.pattern) for rule in rules}
+        self._domains = {}
+        self._present = {}          # field -> rule id matching any non empty value (empty pattern)
+        self._patterns = {}
+        alternatives = defaultdict(list)
+        for rule in rules:
+            if rule.field == "sender_domain":
+                self._domains.setdefault(rule.pattern.strip().lower().lstrip("@."), rule.id)
+            elif not rule.pattern:
+                self._present.setdefault(rule.field, rule.id)
+            else:
+                # alternatives are ordered by priority, the first one matching at a position wins. Each is a
+                # lookahead so a match consumes nothing and a rule overlapping an earlier match is still found
+                pattern = rule.pattern if rule.is_regex else re.escape(rule.pattern)
+                alternatives[rule.field].append(f"(?=(?P<r{rule.id}>{pattern}))")
+        for field, parts in alternatives.items():
+            self._patterns[field] = re.compile("|".join(parts), re.I)
+
+    @staticmethod
+    def _valid(rule) -> bool:
+        try:
+            validate_rule(rule.field, rule.pattern, rule.is_regex)
+            return True
+        except ValueError as e:
+            print(f"Skipping label rule {rule.id}:", e)
+            return False
+
+    def _candidates(self, mail: MailRecord):
+        domain = sender_domain(mail.sent_by)
+        while domain:
+            if domain in self._domains:
+                yield self._domains[domain]
+            domain = domain.partition(".")[2]
+        values = {"sender": mail.sent_by, "subject": mail.subject, "list_id": mail.list_id,
+                  "list_unsubscribe": mail.list_unsubscribe}
+        for field, value in values.items():
+            if not value:
+                continue
+            if field in self._present:
+                yield self._present[field]
+            pattern = self._patterns.get(field)
+            if pattern is not None:
+                for match in pattern.finditer(value):
+                    yield int(match.lastgroup[1:])
+
+    def match(self, mail: MailRecord) -> Optional[dict]:
+        """ Classification of the highest priority matching rule, None when no rule matches """
+        started = time.perf_counter()
+        best = None
+        for rule_id in self._candidates(mail):
+            if best is None or self._rules[rule_id][1] > self._rules[best][1]:
+                best = rule_id
+        elapsed = time.perf_counter() - started
+
+        RULE_STATS["messages"] += 1
+        RULE_STATS["match_seconds"] += elapsed
+        RULE_STATS["max_match_seconds"] = max(RULE_STATS["max_match_seconds"], elapsed)
+        if best is None:
+            return None
+        RULE_STATS["matched"] += 1
+        RULE_STATS["hits"][best] += 1
+        label, _, field, pattern = self._rules[best]
+        return {"label": label, "confidence": 1.0, "source": "rule", "rule_id": best,
+                "reason": f"rule {best}: {field} matches {pattern!r}" if pattern else f"rule {best}: has {field}"}
+
+
+_compiled = {}
+_lock = threading.Lock()
+
+def get_user_rules(db, user_id: int) -> CompiledRules:
+    """ Compiled rules of a user, built on first use and kept until the rules are edited """
+    with _lock:
+        compiled = _compiled.get(user_id)
+    if compiled is None:
+        compiled = CompiledRules(db.query(LabelRule).filter(LabelRule.user_id == user_id).all())
+        with _lock:
+            _compiled[user_id] = compiled
+    return compiled
+
+
+def invalidate_user_rules(user_id: int):
+    """ Drop the compiled rules of a user, called by every rule endpoint that writes """
+    with _lock:
+        _compiled.pop(user_id, None)
+
+
+def rule_stats(rule_ids: list = None) -> dict:
+    """ Match counters, hits limited to rule_ids when given """
+    messages = RULE_STATS["messages"]
+    hits = RULE_STATS["hits"]
+    return {
+        "messages": messages,
+        "matched": RULE_STATS["matched"],
+        "avg_match_us": round(RULE_STATS["match_seconds"] / messages * 1e6, 2) if messages else 0.0,
+        "max_match_us": round(RULE_STATS["max_match_seconds"] * 1e6, 2),
+        "hits": {rule_id: hits[rule_id] for rule_id in rule_ids} if rule_ids is not None else dict(hits),
+    }
@@ -0,0 +1,82 @@
+import asyncio
+import heapq
+import itertools
+
+
+class UserScheduler:
+    """ Run jobs in history order per user, and in parallel across users
+
+    Every user gets a lane (a heap ordered by history id). A lane is owned by
+    at most one worker at a time, so the mails of a mailbox are never handled
+    concurrently and the WatchHistory cursor only moves forward. Lanes take
+    turns round robin: after `quantum` jobs a busy lane goes to the back of
+    the line, so one heavy mailbox can't starve the others.
+    """
+
+    def __init__(self, handler, concurrency: int = 4, quantum: int = 1, max_pending: int = None):
+        self.handler = handler                  # async handler(user_id, item)
+        self.concurrency = concurrency
+        self.quantum = quantum
+        self.max_pending = max_pending or concurrency * 8
+        self.stats = {"submitted": 0, "completed": 0, "failed": 0}
+
+        self._lanes = {}                        # user_id -> heap of (history_id, seq, item, future)
+        self._ready = asyncio.Queue()           # user ids with work, waiting for a worker
+        self._slots = asyncio.Semaphore(self.max_pending)
+        self._seq = itertools.count()
+        self._tasks = []
+
+    @property
+    def pending(self) -> int:
+        return sum(len(lane) for lane in self._lanes.values())
+
+    def start(self):
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.concurrency)]
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    async def submit(self, user_id: int, history_id: int, item) -> asyncio.Future:
+        """ Queue an item on the user's lane, waits while max_pending items are queued
+        Returns:
+            asyncio.Future: resolved with the handler result once the item ran
+        """
+        await self._slots.acquire()
+        future = asyncio.get_running_loop().create_future()
+        lane = self._lanes.get(user_id)
+        if lane is None:
+            # idle user, nobody owns the lane yet
+            lane = self._lanes[user_id] = []
+            self._ready.put_nowait(user_id)
+        heapq.heappush(lane, (int(history_id), next(self._seq), item, future))
+        self.stats["submitted"] += 1
+        return future
+
+    async def _worker(self):
+        while True:
+            user_id = await self._ready.get()
+            lane = self._lanes[user_id]
+            for _ in range(self.quantum):
+                if not lane:
+                    break
+                _, _, item, future = heapq.heappop(lane)
+                self._slots.release()
+                try:
+                    result = await self.handler(user_id, item)
+                    self.stats["completed"] += 1
+                    if not future.done():
+                        future.set_result(result)
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    self.stats["failed"] += 1
+                    if not future.done():
+                        future.set_exception(e)
+
+            if lane:
+                self._ready.put_nowait(user_id)     # back of the line
+            else:
+                del self._lanes[user_id]
@@ -0,0 +1,111 @@
+import json
+import threading
+from collections import OrderedDict
+from googleapiclient import discovery_cache
+from googleapiclient.discovery import build_from_document
+from googleapiclient.http import build_http
+from google_auth_httplib2 import AuthorizedHttp
+from env_secrets import config
+
+
+"""
+Process wide cache of built Google API clients.
+
+`build()` parses the ~150 KB discovery document and creates a new HTTP
+transport every time. Here the document is loaded once from the static copy
+shipped with google-api-python-client, and the authorized clients are kept
+per user in a bounded LRU. A client is rebuilt when the stored credentials
+of its user change.
+
+Built clients are not thread safe (httplib2), they must not be used by two
+threads at the same time. The per user scheduler never runs one mailbox on
+two workers, so a user's client is only ever used by one of them at a time.
+"""
+
+_documents = {}
+_documents_lock = threading.Lock()
+
+
+def get_discovery_document(service_name: str, version: str, root_url: str = None) -> dict:
+    """ Parsed discovery document, read once per process from the local static copy
+    Args:
+        root_url str: Replaces the document's rootUrl, eg. to talk to a local fake server
+    """
+    key = (service_name, version, root_url)
+    if key not in _documents:
+        with _documents_lock:
+            if key not in _documents:
+                document = discovery_cache.get_static_doc(service_name, version)
+                if document is None:
+                    raise RuntimeError(f"No static discovery document for {service_name} {version}")
+                # build_from_document accepts the parsed dict, which skips json parsing on every build.
+                # It fills in the standard parameters in place, which is idempotent, so sharing is safe.
+                document = json.loads(document)
+                if root_url:
+                    document["rootUrl"] = root_url
+                _documents[key] = document
+    return _documents[key]
+
+
+class TransferCounter:
+    """ httplib2.Http wrapper counting the bytes of every response body """
+
+    def __init__(self, http):
+        self.http = http
+        self.requests = 0
+        self.bytes_received = 0
+
+    def request(self, *args, **kwargs):
+        response, content = self.http.request(*args, **kwargs)
+        self.requests += 1
+        self.bytes_received += len(content or b"")
+        return response, content
+
+    def __getattr__(self, name):
+        return getattr(self.http, name)
+
+
+class ServiceCache:
+    """ Bounded LRU of authorized API clients keyed by user """
+
+    def __init__(self, maxsize: int = 256):
+        self.maxsize = maxsize
+        self.stats = {"hits": 0, "misses": 0}
+        self._services = OrderedDict()      # (user_id, service_name, version) -> (fingerprint, service)
+        self._lock = threading.Lock()
+
+    def get(self, user_id: int, service_name: str, version: str, credentials, fingerprint: str):
+        """ Cached client of the user, built when missing or when the fingerprint changed
+        Args:
+            credentials: Callable returning the google credentials, only called on a miss
+            fingerprint str: Identifies the credentials the client was built with
+        """
+        key = (user_id, service_name, version)
+        with self._lock:
+            entry = self._services.get(key)
+            if entry and entry[0] == fingerprint:
+                self._services.move_to_end(key)
+                self.stats["hits"] += 1
+                return entry[1]
+
+        self.stats["misses"] += 1
+        # same transport build() would create, with a byte counter underneath (service.transfer)
+        counter = TransferCounter(build_http())
+        root_url = config.GMAIL_API_URL.rstrip("/") + "/" if service_name == "gmail" else None
+        service = build_from_document(get_discovery_document(service_name, version, root_url), http=AuthorizedHttp(credentials(), http=counter))
+        service.transfer = counter
+        with self._lock:
+            self._services[key] = (fingerprint, service)
+            self._services.move_to_end(key)
+            while len(self._services) > self.maxsize:
+                self._services.popitem(last=False)
+        return service
+
+    def invalidate(self, user_id: int):
+        """ Drop every client of the user, eg. after re-authentication """
+        with self._lock:
+            for key in [key for key in self._services if key[0] == user_id]:
+                del self._services[key]
+
+
+service_cache = ServiceCache(maxsize=config.GMAIL_SERVICE_CACHE_SIZE)
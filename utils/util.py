@@ -1,8 +1,11 @@
 import base64
 import json
 from fastapi import HTTPException, status
-from base64 import urlsafe_b64decode
 from datetime import datetime
+from itertools import islice
+from utils.mime import extract_body, attachment_parts
+from models.vector_schema import MailRecord, AttachmentRef
+from env_secrets import config
 
 """
 {
@@ -26,6 +29,29 @@ from datetime import datetime
 
 
 
+def chunked(iterable, size: int):
+    """ Yield lists of up to size items, works on generators without materialising them """
+    iterator = iter(iterable)
+    while chunk := list(islice(iterator, size)):
+        yield chunk
+
+
+async def achunked(iterable, size: int):
+    """ chunked for async iterables (plain iterables are accepted too) """
+    if not hasattr(iterable, "__aiter__"):
+        for chunk in chunked(iterable, size):
+            yield chunk
+        return
+    chunk = []
+    async for item in iterable:
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
 def decode_mail(data, encoding='UTF-8'):
     try:
         return base64.b64decode(data).decode(encoding)
@@ -43,6 +69,14 @@ def get_start_history():
         return historyId
 
 
+def needs_body(mail: MailRecord) -> bool:
+    """ Default rule of the two phase fetch: bulk mail (newsletters, mailing lists)
+    is classified on its headers, everything else needs the body """
+    if mail.list_unsubscribe or mail.list_id:
+        return False
+    return mail.precedence.lower() not in ("bulk", "list", "junk")
+
+
 class VectorStore:
     def __init__(self, client, collection_name):
         self.client = client
@@ -59,53 +93,51 @@ class VectorStore:
 
 
 
+# header name (lower case) -> MailRecord field
+HEADER_FIELDS = {
+    "from": "sent_by",
+    "to": "sent_to",
+    "subject": "subject",
+    "x-header": "header",      # Custom header if any
+    "cc": "cc",
+    "bcc": "bcc",
+    "list-unsubscribe": "list_unsubscribe",
+    "list-id": "list_id",
+    "precedence": "precedence",
+}
+
+
 class ParseUtil:
     """Parse documents or requests"""
 
-    def gmail_messages(self, message:dict) -> dict:
-        """ Extract message details from gmail service """
-        extracted_data = {}
-
+    def gmail_messages(self, message:dict, max_body_bytes: int = config.MAIL_MAX_BODY_BYTES) -> MailRecord:
+        """ Extract message details from gmail service, the body is read from the whole MIME tree (utils/mime.py) """
         payload = message.get('payload', {})
-        headers = payload.get('headers', [])
-        parts = payload.get('parts', [])
-
-        print("message is ", message)
-
-        def get_header(name):
-            for header in headers:
-                if header['name'].lower() == name.lower():
-                    return header['value']
-            return None
-
-        # Decode message body
-        def decode_body():
-            if 'data' in payload.get('body', {}):
-                return urlsafe_b64decode(payload['body']['data']).decode('utf-8', errors='ignore')
-            for part in parts:
-                if part.get('mimeType') == 'text/plain' and 'data' in part.get('body', {}):
-                    return urlsafe_b64decode(part['body']['data']).decode('utf-8', errors='ignore')
-            return ""
-
-        extracted_data= {
-            "document": decode_body(),
-            "metadata": {
-                # "user_id": user_id,
-                "mail_id": message.get('id'),
-                "history_id": message.get('historyId'),
-                "created_at": datetime.utcfromtimestamp(int(message.get('internalDate')) / 1000).strftime('%Y-%m-%d %H:%M:%S'),
-                "updated_at": datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S'),
-                "stored_at": datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S'),
-                "sent_by": get_header('From'),
-                "sent_to": get_header('To'),
-                "subject": get_header('Subject'),
-                "header": get_header('X-Header') or "",  # Custom header if any
-                "cc": get_header('Cc') or "",
-                "bcc": get_header('Bcc') or ""
-            }
-        }
-
-        return extracted_data
+
+        # single pass over the headers, the first occurrence of a header wins
+        values = {}
+        for header in payload.get('headers', []):
+            field = HEADER_FIELDS.get(header['name'].lower())
+            if field and field not in values:
+                values[field] = header['value']
+
+        document, truncated = extract_body(payload, max_body_bytes)
+        now = datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S')
+
+        return MailRecord(
+            mail_id=message.get('id'),
+            history_id=message.get('historyId') or "",
+            document=document,
+            created_at=datetime.utcfromtimestamp(int(message.get('internalDate')) / 1000).strftime('%Y-%m-%d %H:%M:%S'),
+            updated_at=now,
+            stored_at=now,
+            body_truncated=truncated,
+            attachments=[
+                AttachmentRef(part["body"].get("attachmentId", ""), part.get("filename", ""), part.get("mimeType", ""), part["body"].get("size", 0))
+                for part in attachment_parts(payload)
+            ],
+            **values
+        )
 
 # Usage
 # service = build('gmail', 'v1', credentials=your_credentials)
@@ -0,0 +1,175 @@
+import asyncio
+from fastapi.concurrency import run_in_threadpool
+from db.relational_db import SessionLocal
+from db.mail_queue import get_mail_queue
+from utils.coalescer import NotificationCoalescer
+from utils.scheduler import UserScheduler
+from models.relational_models import User, UserLabels
+from models.relational_schema import UserLabelSchema
+from utils.google import Services
+from agents.ai_agent import MailAgent
+from utils.rules import get_user_rules
+from env_secrets import config
+
+
+async def process_notification(user_id: int, history_id: int, end_history_id: int = None) -> list:
+    """ Run the full mail pipeline for one (or a coalesced burst of) Pub/Sub notification
+    Args:
+        user_id int: Owner of the mailbox
+        history_id int: History Id sent by the pubsub, lowest one of a burst
+        end_history_id int: Highest History Id of a coalesced burst
+    Returns:
+        list: Summary of every processed mail
+    """
+    db = SessionLocal()
+    try:
+        services = await run_in_threadpool(Services, db, user_id)
+
+        user_labels = await run_in_threadpool(lambda: db.query(UserLabels).filter(UserLabels.user_id == user_id).all())
+        user_labels = [UserLabelSchema.from_orm(label).model_dump() for label in user_labels]
+
+        rules = await run_in_threadpool(get_user_rules, db, user_id)
+        agent = MailAgent(db, user_id, rules=rules)
+        outputs = []
+        # mails are streamed off the history walk, a large gap never sits in memory at once
+        batch = []
+        async for mail in stream_mails(services, history_id, end_history_id):
+            batch.append(mail)
+            # a burst of mails is classified in batched LLM requests
+            if len(batch) >= agent.batch_size:
+                outputs += await agent.run_batch(batch, user_labels=user_labels)
+                batch = []
+        if batch:
+            outputs += await agent.run_batch(batch, user_labels=user_labels)
+        for output in outputs:
+            print("Mail processed:", output)
+
+        if services.fetch_errors:
+            print("Mails not fetched:", services.fetch_errors)
+        return outputs
+    finally:
+        db.close()
+
+
+async def stream_mails(services: Services, history_id: int, end_history_id: int = None):
+    """ New mails of the notification, from the asyncio Gmail client or the discovery client in the threadpool """
+    if config.GMAIL_ASYNC_CLIENT:
+        async for mail in services.aiter_hook(history_id, end_history_id):
+            yield mail
+        return
+    mails = services.iter_hook(history_id, end_history_id)
+    while (mail := await run_in_threadpool(next, mails, None)) is not None:
+        yield mail
+
+
+def lookup_user_id(email: str):
+    """ User id of a Gmail address, None for unknown users """
+    db = SessionLocal()
+    try:
+        user = db.query(User.id).filter(User.email == email).first()
+        return user.id if user else None
+    finally:
+        db.close()
+
+
+class MailWorkerPool:
+    """ Drain the mail queue and process notifications on the per user scheduler
+
+    Dispatchers take notifications off the queue, coalesce them and hand them
+    to the UserScheduler, which runs up to `workers` mailboxes in parallel
+    while keeping every mailbox in history order.
+    """
+
+    def __init__(self, queue=None, workers: int = config.MAIL_WORKERS, coalesce_window: float = config.MAIL_COALESCE_WINDOW,
+                 quantum: int = config.MAIL_USER_QUANTUM):
+        self.queue = queue or get_mail_queue()
+        self.workers = workers
+        self.coalescer = NotificationCoalescer(self.queue, self._submit, window=coalesce_window, max_open=workers * 4)
+        self.scheduler = UserScheduler(self._run, concurrency=workers, quantum=quantum)
+        self._user_ids = {}         # email -> user id
+        self._tasks = []
+        self._running = False
+
+    async def start(self):
+        self._running = True
+        await self.queue.recover()
+        self.scheduler.start()
+        self._tasks = [asyncio.create_task(self._dispatch(n)) for n in range(self.workers)]
+        self._tasks.append(asyncio.create_task(self._keep_alive()))
+
+    async def stop(self):
+        self._running = False
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        await self.coalescer.stop()
+        await self.scheduler.stop()
+
+    @property
+    def stats(self) -> dict:
+        return {**self.coalescer.stats, **self.scheduler.stats, "scheduled": self.scheduler.pending}
+
+    async def _user_id(self, email: str):
+        if email not in self._user_ids:
+            user_id = await run_in_threadpool(lookup_user_id, email)
+            if user_id is None:
+                return None
+            self._user_ids[email] = user_id
+        return self._user_ids[email]
+
+    async def _dispatch(self, n: int):
+        while self._running:
+            try:
+                job = await self.queue.dequeue()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"dispatcher {n}: queue unavailable", str(e))
+                await asyncio.sleep(1)
+                continue
+            if job is None:
+                continue
+            # waits in its mailbox's coalescing window, _submit is called when it closes
+            await self.coalescer.add(job)
+
+    async def _keep_alive(self):
+        """ Renew the queue's hold on the claimed jobs, so jobs still waiting in the scheduler
+        or running LLM calls are not handed out a second time """
+        while self._running:
+            await asyncio.sleep(self.queue.visibility_timeout / 3)
+            try:
+                await self.queue.keep_alive()
+            except Exception as e:
+                print("queue keep alive failed", str(e))
+
+    async def _submit(self, notification):
+        try:
+            user_id = await self._user_id(notification.email)
+        except Exception as e:
+            print(f"{notification.email}: user lookup failed", str(e))
+            await self._settle(notification, ok=False)
+            return
+        if user_id is None:
+            print("Notification for unknown user, dropped:", notification.email)
+            await self._settle(notification, ok=True)
+            return
+        await self.scheduler.submit(user_id, notification.start_history_id, notification)
+
+    async def _run(self, user_id: int, notification):
+        try:
+            await process_notification(user_id, notification.start_history_id, notification.end_history_id)
+            await self._settle(notification, ok=True)
+        except asyncio.CancelledError:
+            # shutting down, leave the jobs to be recovered on next start
+            raise
+        except Exception as e:
+            print(f"user {user_id}: notification {notification.start_history_id} failed", str(e))
+            await self._settle(notification, ok=False)
+
+    async def _settle(self, notification, ok: bool):
+        for claimed in notification.jobs:
+            if ok:
+                await self.queue.ack(claimed)
+            else:
+                await self.queue.nack(claimed)